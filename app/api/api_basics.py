@@ -55,8 +55,9 @@ class HaivenBaseApi:
             options=ChatOptions(category=chat_category),
         )
 
+        # Async generators are iterated on the event loop, sync ones in a thread each
         return StreamingResponse(
-            chat_session.run(prompt),
+            chat_session.arun(prompt),
             media_type=streaming_media_type(),
             headers=streaming_headers(chat_session_key_value),
         )
@@ -64,17 +65,17 @@ class HaivenBaseApi:
     def stream_text_chat(
         self, prompt, chat_category, chat_session_key_value=None, document_key=None
     ):
-        def stream(chat_session: StreamingChat, prompt):
+        async def stream(chat_session: StreamingChat, prompt):
             if document_key:
                 sources = ""
-                for chunk, sources in chat_session.run_with_document(
+                async for chunk, sources in chat_session.arun_with_document(
                     document_key, None, prompt
                 ):
                     sources = sources
                     yield chunk
                 yield "\n\n" + sources
             else:
-                for chunk in chat_session.run(prompt):
+                async for chunk in chat_session.arun(prompt):
                     yield chunk
 
         chat_session_key_value, chat_session = self.chat_manager.streaming_chat(
@@ -154,6 +155,10 @@ class ApiBasics(HaivenBaseApi):
 
             return JSONResponse(response_data)
 
+        @app.post("/api/knowledge/reload")
+        def reload_knowledge(request: Request):
+            return JSONResponse(knowledge_manager.reload())
+
         @app.post("/api/prompt")
         def chat(prompt_data: PromptRequestBody):
             if prompt_data.promptid:
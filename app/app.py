@@ -1,8 +1,11 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
 import gradio as gr
 from api.boba_api import BobaApi
+from knowledge.watcher import KnowledgePackWatcher
 from knowledge_manager import KnowledgeManager
-from llms.chats import ChatManager, ServerChatSessionMemory
+from llms.chat_history import ChatHistoryCompactor
+from llms.chats import CHAT_TYPES, ChatManager, ServerChatSessionMemory
 from llms.image_description_service import ImageDescriptionService
 from llms.clients import ChatClientFactory
 from llms.model import Model
@@ -27,12 +30,21 @@ class App:
 
         knowledge_pack_path = config_service.load_knowledge_pack_path()
         knowledge_manager = KnowledgeManager(config_service=config_service)
+        self.knowledge_pack_watcher = KnowledgePackWatcher.from_env(knowledge_manager)
+        if self.knowledge_pack_watcher is not None:
+            self.knowledge_pack_watcher.start()
 
         prompts_factory = PromptsFactory(knowledge_pack_path)
-        chat_session_memory = ServerChatSessionMemory()
+        chat_session_memory = ServerChatSessionMemory.from_env()
+        chat_session_memory.start_sweeper()
         llm_chat_factory = ChatClientFactory(config_service)
         chat_manager = ChatManager(
-            config_service, chat_session_memory, llm_chat_factory, knowledge_manager
+            config_service,
+            chat_session_memory,
+            llm_chat_factory,
+            knowledge_manager,
+            ChatHistoryCompactor.from_env(CHAT_TYPES),
+            os.environ.get("CHAT_PRECOMPUTE_SEARCH_SUMMARIES") == "true",
         )
 
         image_service = self.create_image_service(config_service)
@@ -0,0 +1,368 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+"""
+Benchmarks knowledge retrieval on a synthetic knowledge pack, without any model provider:
+chunks are random words, vectors come from a seeded random generator, query embeddings
+from langchain's DeterministicFakeEmbedding, and the LLM of DocumentsChat is a fake that
+returns a fixed answer. The same arguments always create the same pack.
+
+Measures the time and memory needed to load the pack, and the latency of
+similarity_search, similarity_search_on_single_document and DocumentsChat.run,
+and writes the results to a JSON report that can be compared across releases.
+
+Run from the app folder:
+    python -m benchmark.knowledge_retrieval --documents 20 --chunks 500 --dimension 384 --output benchmark_report.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Callable
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from embeddings.cache import EmbeddingsCache
+from embeddings.client import EmbeddingsClient
+from embeddings.docstores import save_mapped_docstore
+from embeddings.model import EmbeddingModel
+from knowledge.documents import KnowledgeBaseDocuments
+from llms.chats import DocumentsChat
+
+BENCHMARK_REPORT_VERSION = 1
+BENCHMARK_PROVIDER = "benchmark"
+DOCSTORE_FORMATS = ["compact", "pickle"]
+
+_WORDS = (
+    "agile architecture backlog build cloud code customer data delivery deploy design "
+    "developer domain feedback feature incident infrastructure integration iteration "
+    "latency metric model monitoring pipeline platform product quality release "
+    "requirement retrospective risk security service stakeholder story team test "
+    "threat user value velocity workflow"
+).split()
+
+
+def create_synthetic_knowledge_pack(
+    path: str,
+    documents: int,
+    chunks: int,
+    dimension: int,
+    chunk_words: int = 60,
+    seed: int = 0,
+    docstore_format: str = "compact",
+) -> str:
+    """
+    Writes a knowledge pack with documents x chunks random chunks of chunk_words words,
+    with random vectors of the given dimension.
+
+    Parameters:
+        path (str): The folder of the knowledge pack, created if it does not exist.
+        documents (int): The number of documents (.md + .kb folder).
+        chunks (int): The number of chunks per document.
+        dimension (int): The dimension of the vectors.
+        chunk_words (int): The number of words per chunk.
+        seed (int): The seed of the random text and vectors.
+        docstore_format (str): "compact" for the docstore_* files, "pickle" for index.pkl.
+
+    Returns:
+        str: The path of the embeddings folder of the pack.
+    """
+    if docstore_format not in DOCSTORE_FORMATS:
+        raise ValueError(f"docstore_format needs to be one of {DOCSTORE_FORMATS}")
+
+    embeddings_path = os.path.join(path, "embeddings")
+    os.makedirs(embeddings_path, exist_ok=True)
+    text_random = random.Random(seed)
+    vector_random = np.random.default_rng(seed)
+    embedding_function = DeterministicFakeEmbedding(size=dimension)
+
+    for document_number in range(documents):
+        key = f"benchmark-document-{document_number}"
+        kb_path = os.path.join(embeddings_path, f"{key}.kb")
+        texts = [
+            " ".join(text_random.choices(_WORDS, k=chunk_words)) for _ in range(chunks)
+        ]
+        metadatas = [
+            {"source": f"{key}.pdf", "title": key, "page": chunk_number // 10}
+            for chunk_number in range(chunks)
+        ]
+        vectors = vector_random.random((chunks, dimension), dtype=np.float32)
+
+        if docstore_format == "pickle":
+            FAISS.from_embeddings(
+                zip(texts, vectors.tolist()), embedding_function, metadatas=metadatas
+            ).save_local(kb_path)
+        else:
+            os.makedirs(kb_path, exist_ok=True)
+            index = faiss.IndexFlatL2(dimension)
+            index.add(vectors)
+            faiss.write_index(index, os.path.join(kb_path, "index.faiss"))
+            save_mapped_docstore(
+                kb_path,
+                [
+                    Document(page_content=text, metadata=metadata)
+                    for text, metadata in zip(texts, metadatas)
+                ],
+            )
+
+        with open(os.path.join(embeddings_path, f"{key}.md"), "w") as f:
+            f.write(
+                "---\n"
+                f"key: {key}\n"
+                f"title: Benchmark document {document_number}\n"
+                f"source: {key}.pdf\n"
+                f"path: {key}.kb\n"
+                f"provider: {BENCHMARK_PROVIDER}\n"
+                "---\n"
+            )
+
+    return embeddings_path
+
+
+def create_embeddings_client(dimension: int, use_mmap: bool = False):
+    return EmbeddingsClient(
+        EmbeddingModel(
+            id=BENCHMARK_PROVIDER,
+            name="Benchmark embeddings",
+            provider=BENCHMARK_PROVIDER,
+            config={},
+        ),
+        query_cache=EmbeddingsCache(max_entries=0),
+        use_mmap=use_mmap,
+        embeddings_provider=DeterministicFakeEmbedding(size=dimension),
+    )
+
+
+def measure_latencies(
+    function: Callable[[int], object], iterations: int, warmup: int = 1
+) -> dict:
+    """
+    Calls function(iteration) iterations times, after warmup calls that are not measured,
+    and returns latency percentiles in milliseconds.
+    """
+    for iteration in range(warmup):
+        function(iteration)
+
+    latencies = []
+    for iteration in range(warmup, warmup + iterations):
+        started_at = time.perf_counter()
+        function(iteration)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "p50_ms": _percentile(latencies, 50),
+        "p99_ms": _percentile(latencies, 99),
+        "mean_ms": statistics.fmean(latencies),
+        "min_ms": latencies[0],
+        "max_ms": latencies[-1],
+    }
+
+
+def run_benchmark(
+    documents: int = 10,
+    chunks: int = 200,
+    dimension: int = 384,
+    queries: int = 100,
+    chat_runs: int = 20,
+    seed: int = 0,
+    docstore_format: str = "compact",
+    use_mmap: bool = False,
+    memory_budget_mb: float = 0,
+    pack_path: str = None,
+) -> dict:
+    """
+    Creates a synthetic knowledge pack, loads it and measures searches and chats on it.
+
+    Returns:
+        dict: The benchmark report.
+    """
+    with tempfile.TemporaryDirectory() as temporary_path:
+        pack_path = pack_path or temporary_path
+
+        started_at = time.perf_counter()
+        embeddings_path = create_synthetic_knowledge_pack(
+            pack_path,
+            documents,
+            chunks,
+            dimension,
+            seed=seed,
+            docstore_format=docstore_format,
+        )
+        pack_creation_seconds = time.perf_counter() - started_at
+
+        rss_before_load = _get_rss_bytes()
+        started_at = time.perf_counter()
+        knowledge_base_documents = KnowledgeBaseDocuments(
+            config_service=None,
+            embeddings_provider=create_embeddings_client(dimension, use_mmap),
+            memory_budget_mb=memory_budget_mb,
+        )
+        knowledge_base_documents.load_documents_for_base(embeddings_path)
+        load_seconds = time.perf_counter() - started_at
+        rss_after_load = _get_rss_bytes()
+
+        document_keys = [
+            document.key for document in knowledge_base_documents.get_documents()
+        ]
+        document_random = random.Random(seed)
+
+        similarity_search = measure_latencies(
+            lambda iteration: knowledge_base_documents.similarity_search(
+                query=f"benchmark question {iteration}", context=None, k=10
+            ),
+            queries,
+        )
+        similarity_search_on_single_document = measure_latencies(
+            lambda iteration: (
+                knowledge_base_documents.similarity_search_on_single_document(
+                    query=f"benchmark question {iteration}",
+                    document_key=document_random.choice(document_keys),
+                    context="base",
+                )
+            ),
+            queries,
+        )
+
+        knowledge_manager = SimpleNamespace(
+            knowledge_base_documents=knowledge_base_documents
+        )
+        chat_client = FakeListChatModel(responses=["A benchmark answer."])
+        documents_chat_run = measure_latencies(
+            lambda iteration: DocumentsChat(
+                chat_client, knowledge_manager, knowledge="all", context=None
+            ).run(f"benchmark question {iteration}"),
+            chat_runs,
+        )
+
+    return {
+        "version": BENCHMARK_REPORT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": _get_git_commit(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "faiss": faiss.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": {
+            "documents": documents,
+            "chunks": chunks,
+            "dimension": dimension,
+            "queries": queries,
+            "chat_runs": chat_runs,
+            "seed": seed,
+            "docstore_format": docstore_format,
+            "use_mmap": use_mmap,
+            "memory_budget_mb": memory_budget_mb,
+        },
+        "pack_creation_seconds": pack_creation_seconds,
+        "load": {
+            "seconds": load_seconds,
+            "rss_bytes": rss_after_load,
+            "rss_increase_bytes": rss_after_load - rss_before_load,
+        },
+        "similarity_search": similarity_search,
+        "similarity_search_on_single_document": similarity_search_on_single_document,
+        "documents_chat_run": documents_chat_run,
+    }
+
+
+def _percentile(sorted_values: list[float], percentile: float) -> float:
+    # Nearest rank, so that p99 of a small sample is one of the measured values
+    rank = max(0, int(np.ceil(percentile / 100 * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+def _get_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak rather than current usage, reported in kilobytes on Linux and bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _get_git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark knowledge retrieval on a synthetic knowledge pack."
+    )
+    parser.add_argument("--documents", type=int, default=10)
+    parser.add_argument("--chunks", type=int, default=200, help="Chunks per document")
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--chat-runs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--docstore-format", choices=DOCSTORE_FORMATS, default="compact"
+    )
+    parser.add_argument("--mmap", action="store_true", help="Memory-map the indexes")
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=float,
+        default=0,
+        help="Load the indexes lazily within this budget",
+    )
+    parser.add_argument(
+        "--pack-path",
+        default=None,
+        help="Where to create the pack, a temporary folder by default",
+    )
+    parser.add_argument("--output", default="benchmark_report.json")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        documents=args.documents,
+        chunks=args.chunks,
+        dimension=args.dimension,
+        queries=args.queries,
+        chat_runs=args.chat_runs,
+        seed=args.seed,
+        docstore_format=args.docstore_format,
+        use_mmap=args.mmap,
+        memory_budget_mb=args.memory_budget_mb,
+        pack_path=args.pack_path,
+    )
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Benchmark report written to {args.output}")
+    for name in [
+        "similarity_search",
+        "similarity_search_on_single_document",
+        "documents_chat_run",
+    ]:
+        print(
+            f"{name}: p50 {report[name]['p50_ms']:.2f} ms, p99 {report[name]['p99_ms']:.2f} ms"
+        )
+    print(f"load: {report['load']['seconds']:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
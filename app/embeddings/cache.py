@@ -0,0 +1,166 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Tuple
+
+from logger import HaivenLogger
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+class EmbeddingsCache:
+    """
+    A bounded, thread-safe LRU cache for query embeddings, keyed by the normalized text
+    and the id of the embedding model that produced the vector.
+
+    Entries are evicted when the cache grows beyond max_entries (least recently used first),
+    or when they are older than ttl_seconds. If a persistence_path is given, the cache is
+    loaded from that file on creation and can be written back with save().
+
+    Attributes:
+        max_entries (int): The maximum number of vectors to keep, 0 disables the cache.
+        ttl_seconds (float): The maximum age of an entry, None means entries never expire.
+        persistence_path (str): Optional path of a JSON file to load and save the cache.
+        hits (int): The number of lookups that were answered from the cache.
+        misses (int): The number of lookups that were not in the cache.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: float = 24 * 60 * 60,
+        persistence_path: str = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persistence_path = persistence_path
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Tuple[str, str], Tuple[float, List[float]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+        if self.persistence_path and os.path.exists(self.persistence_path):
+            self.load()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Creates a cache configured with the EMBEDDINGS_CACHE_MAX_ENTRIES,
+        EMBEDDINGS_CACHE_TTL_SECONDS and EMBEDDINGS_CACHE_PATH environment variables.
+        All the callers get the same cache for an EMBEDDINGS_CACHE_PATH, which is saved
+        once when the process exits.
+        """
+        persistence_path = os.environ.get("EMBEDDINGS_CACHE_PATH") or None
+        with _shared_caches_lock:
+            if persistence_path in _shared_caches:
+                return _shared_caches[persistence_path]
+
+            cache = cls(
+                max_entries=int(os.environ.get("EMBEDDINGS_CACHE_MAX_ENTRIES", 1000)),
+                ttl_seconds=float(
+                    os.environ.get("EMBEDDINGS_CACHE_TTL_SECONDS", 24 * 60 * 60)
+                ),
+                persistence_path=persistence_path,
+            )
+            if persistence_path:
+                _shared_caches[persistence_path] = cache
+                atexit.register(cache.save)
+            return cache
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def get(self, text: str, model_id: str) -> List[float]:
+        key = (EmbeddingsCache.normalize(text), model_id)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and self._is_expired(entry[0]):
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, text: str, model_id: str, embedding: List[float]) -> None:
+        if self.max_entries <= 0:
+            return
+
+        key = (EmbeddingsCache.normalize(text), model_id)
+        with self._lock:
+            self._entries[key] = (time.time(), list(embedding))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def save(self) -> None:
+        if not self.persistence_path:
+            return
+
+        with self._lock:
+            entries = [
+                {
+                    "text": text,
+                    "model_id": model_id,
+                    "created_at": created_at,
+                    "embedding": embedding,
+                }
+                for (text, model_id), (created_at, embedding) in self._entries.items()
+                if not self._is_expired(created_at)
+            ]
+
+        temporary_path = f"{self.persistence_path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(entries, file)
+        os.replace(temporary_path, self.persistence_path)
+
+    def load(self) -> None:
+        with open(self.persistence_path, "r") as file:
+            try:
+                entries = json.load(file)
+            except json.JSONDecodeError as exc:
+                HaivenLogger.get().analytics(
+                    "EmbeddingsCacheFileIgnored",
+                    {"path": self.persistence_path, "error": str(exc)},
+                )
+                return
+
+        with self._lock:
+            for entry in entries:
+                if self._is_expired(entry["created_at"]):
+                    continue
+                key = (entry["text"], entry["model_id"])
+                self._entries[key] = (entry["created_at"], entry["embedding"])
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _is_expired(self, created_at: float) -> bool:
+        return (
+            self.ttl_seconds is not None and created_at < time.time() - self.ttl_seconds
+        )
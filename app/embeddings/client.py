@@ -1,23 +1,48 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
+import pickle
+from typing import Dict, List
 
-import tiktoken
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import faiss
 from langchain_community.embeddings import BedrockEmbeddings, OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
 from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
+from embeddings.cache import EmbeddingsCache
+from embeddings.docstores import (
+    MappedDocstore,
+    MergedDocstore,
+    PositionalIds,
+    has_mapped_docstore,
+)
+from embeddings.splitters import TokenBoundaryTextSplitter
+from embeddings.tokens import TokenCounter
 from embeddings.model import EmbeddingModel
 
 
 class EmbeddingsClient:
     CONST_INVALID_CONFIG_ERROR = "Invalid config for the given embedding model"
 
-    def __init__(self, embedding_model: EmbeddingModel):
+    def __init__(
+        self,
+        embedding_model: EmbeddingModel,
+        query_cache: EmbeddingsCache = None,
+        use_mmap: bool = None,
+        embeddings_provider: Embeddings = None,
+    ):
         self.embedding_model: EmbeddingModel = embedding_model
+        self.use_mmap = (
+            use_mmap
+            if use_mmap is not None
+            else os.environ.get("KNOWLEDGE_MMAP") == "true"
+        )
         self.__text_splitter = self._load_text_splitter()
         self.__embeddings_provider = None
+        self.query_cache = query_cache or EmbeddingsCache.from_env()
 
-        if self.embedding_model.provider.lower() == "openai":
+        if embeddings_provider is not None:
+            self.__embeddings_provider = embeddings_provider
+        elif self.embedding_model.provider.lower() == "openai":
             self.__embeddings_provider = self._load_openai_embeddings()
         elif self.embedding_model.provider.lower() == "azure":
             self.__embeddings_provider = self._load_azure_embeddings()
@@ -35,11 +60,11 @@ class EmbeddingsClient:
         return self.__embeddings_provider
 
     def _load_text_splitter(self):
-        return RecursiveCharacterTextSplitter(
+        return TokenBoundaryTextSplitter(
             chunk_size=500,
             chunk_overlap=80,
-            length_function=self._tiktoken_len,
             separators=["\n\n", "\n", " ", ""],
+            tokenizer=TokenCounter.get("cl100k_base"),
         )
 
     def _is_valid_aws_config(self) -> bool:
@@ -92,18 +117,103 @@ class EmbeddingsClient:
         if not self.embedding_model.config.get(key):
             raise ValueError(f"{key} config is not set for the given embedding model")
 
-    def _tiktoken_len(self, text) -> int:
-        tokenizer = tiktoken.get_encoding("cl100k_base")
-        tokens = tokenizer.encode(text, disallowed_special=())
-        return len(tokens)
+    def embed_query(self, text: str) -> List[float]:
+        embedding = self.query_cache.get(text, self.embedding_model.id)
+        if embedding is None:
+            embedding = self.__embeddings_provider.embed_query(text)
+            self.query_cache.put(text, self.embedding_model.id, embedding)
+
+        return embedding
+
+    def query_cache_stats(self) -> dict:
+        return self.query_cache.stats()
 
     def generate_from_documents(self, text, metadata):
         chunks = self.__text_splitter.create_documents(text, metadatas=metadata)
         return FAISS.from_documents(chunks, self.__embeddings_provider)
 
     def generate_from_filesystem(self, kb_folder_path):
+        if self.use_mmap or has_mapped_docstore(kb_folder_path):
+            return self._load_index_and_docstore(kb_folder_path)
+
+        # Knowledge packs indexed before the compact docstore format
         return FAISS.load_local(
             folder_path=kb_folder_path,
             embeddings=self.__embeddings_provider,
             allow_dangerous_deserialization=True,
         )
+
+    def _load_index_and_docstore(self, kb_folder_path) -> FAISS:
+        index_path = os.path.join(kb_folder_path, "index.faiss")
+        if self.use_mmap:
+            # Flat indexes are only mapped on FAISS versions that support IO_FLAG_MMAP_IFC
+            index = faiss.read_index(
+                index_path,
+                getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+                | faiss.IO_FLAG_READ_ONLY,
+            )
+        else:
+            index = faiss.read_index(index_path)
+
+        if has_mapped_docstore(kb_folder_path):
+            docstore = MappedDocstore(kb_folder_path)
+            index_to_docstore_id = PositionalIds(len(docstore))
+        else:
+            with open(os.path.join(kb_folder_path, "index.pkl"), "rb") as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+
+        return FAISS(
+            embedding_function=self.__embeddings_provider,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
+
+    def generate_from_retrievers(self, retrievers: Dict[str, FAISS]) -> FAISS:
+        """
+        Merges several FAISS stores into a single index, so that one query embedding
+        and one top-k scan can answer a search across all of them. The merged index
+        refers to the indexes and docstores of the source stores instead of copying them.
+        The key of each source store is added to the "document_key" metadata of its chunks.
+
+        Args:
+            retrievers (Dict[str, FAISS]): The stores to merge, by document key.
+
+        Returns:
+            FAISS: The merged store, or None if there was nothing to merge.
+        """
+        retrievers = {
+            key: retriever
+            for key, retriever in retrievers.items()
+            if retriever.index.ntotal > 0
+        }
+        if len(retrievers) == 0:
+            return None
+
+        first_retriever = next(iter(retrievers.values()))
+        dimension = first_retriever.index.d
+        metric_type = first_retriever.index.metric_type
+
+        merged_index = faiss.IndexShards(dimension, False, True)
+        merged_docstore = MergedDocstore()
+
+        for document_key, retriever in retrievers.items():
+            if (
+                retriever.index.d != dimension
+                or retriever.index.metric_type != metric_type
+            ):
+                raise ValueError(
+                    f"Cannot merge {document_key}, its index is not compatible with the other documents"
+                )
+
+            merged_index.add_shard(retriever.index)
+            merged_docstore.add_store(document_key, retriever)
+
+        return FAISS(
+            embedding_function=self.__embeddings_provider,
+            index=merged_index,
+            docstore=merged_docstore,
+            index_to_docstore_id=PositionalIds(len(merged_docstore)),
+            normalize_L2=first_retriever._normalize_L2,
+            distance_strategy=first_retriever.distance_strategy,
+        )
@@ -0,0 +1,178 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import mmap
+import os
+from bisect import bisect_right
+from collections.abc import Mapping
+from typing import Iterator, List, Union
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+
+MAPPED_DOCSTORE_TEXT_FILE = "docstore_text.bin"
+MAPPED_DOCSTORE_OFFSETS_FILE = "docstore_offsets.npy"
+MAPPED_DOCSTORE_METADATA_FILE = "docstore_metadata.json"
+MAPPED_DOCSTORE_METADATA_LOG_FILE = "docstore_metadata.jsonl"
+MAPPED_DOCSTORE_VERSION = 1
+
+
+class PositionalIds(Mapping):
+    """
+    The index_to_docstore_id of stores whose docstore ids are the positions in the index,
+    without keeping a dictionary entry per chunk.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+
+    def __getitem__(self, position: int) -> str:
+        if position < 0 or position >= self._size:
+            raise KeyError(position)
+        return str(position)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self._size))
+
+    def __len__(self) -> int:
+        return self._size
+
+
+class MappedDocstore(Docstore):
+    """
+    Read-only docstore for the compact chunk format of a knowledge base folder:
+    - docstore_text.bin: the UTF-8 text of all chunks, concatenated
+    - docstore_offsets.npy: one (start, end, metadata id) row per chunk, in index order
+    - docstore_metadata.json: the table of distinct metadata dictionaries
+    - docstore_metadata.jsonl: the metadata dictionaries the CLI appended to the table
+      while indexing, if the indexing was interrupted
+
+    The text and the offsets are memory-mapped, so processes that load the same
+    knowledge pack share the pages instead of each holding a copy of the chunks.
+    """
+
+    def __init__(self, folder_path: str):
+        self._offsets = np.load(
+            os.path.join(folder_path, MAPPED_DOCSTORE_OFFSETS_FILE), mmap_mode="r"
+        )
+
+        with open(os.path.join(folder_path, MAPPED_DOCSTORE_METADATA_FILE), "r") as f:
+            metadata_file = json.load(f)
+        if metadata_file.get("version") != MAPPED_DOCSTORE_VERSION:
+            raise ValueError(
+                f"Unsupported docstore version {metadata_file.get('version')} in {folder_path}"
+            )
+        self._metadata = metadata_file["metadata"]
+        metadata_log_path = os.path.join(folder_path, MAPPED_DOCSTORE_METADATA_LOG_FILE)
+        if os.path.exists(metadata_log_path):
+            with open(metadata_log_path, "r") as f:
+                for line in f:
+                    try:
+                        self._metadata.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted save, no chunk refers to it
+                        break
+
+        self._text = b""
+        text_path = os.path.join(folder_path, MAPPED_DOCSTORE_TEXT_FILE)
+        if os.path.getsize(text_path) > 0:
+            with open(text_path, "rb") as f:
+                self._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def search(self, search: str) -> Union[str, Document]:
+        position = int(search)
+        if position < 0 or position >= len(self._offsets):
+            return f"ID {search} not found."
+
+        start, end, metadata_id = self._offsets[position]
+        return Document(
+            page_content=self._text[start:end].decode("utf-8"),
+            metadata=dict(self._metadata[metadata_id]),
+        )
+
+
+def has_mapped_docstore(folder_path: str) -> bool:
+    return all(
+        os.path.exists(os.path.join(folder_path, filename))
+        for filename in [
+            MAPPED_DOCSTORE_TEXT_FILE,
+            MAPPED_DOCSTORE_OFFSETS_FILE,
+            MAPPED_DOCSTORE_METADATA_FILE,
+        ]
+    )
+
+
+def save_mapped_docstore(folder_path: str, documents: List[Document]) -> None:
+    """
+    Writes documents in the compact chunk format read by MappedDocstore.
+    The documents have to be in the same order as their vectors in the index.
+    """
+    metadata_table = []
+    metadata_ids = {}
+    offsets = []
+    position = 0
+
+    with open(os.path.join(folder_path, MAPPED_DOCSTORE_TEXT_FILE), "wb") as f:
+        for document in documents:
+            encoded_text = document.page_content.encode("utf-8")
+            f.write(encoded_text)
+
+            metadata_key = json.dumps(document.metadata, sort_keys=True, default=str)
+            if metadata_key not in metadata_ids:
+                metadata_ids[metadata_key] = len(metadata_table)
+                metadata_table.append(json.loads(metadata_key))
+
+            offsets.append(
+                (position, position + len(encoded_text), metadata_ids[metadata_key])
+            )
+            position += len(encoded_text)
+
+    np.save(
+        os.path.join(folder_path, MAPPED_DOCSTORE_OFFSETS_FILE),
+        np.array(offsets, dtype=np.int64).reshape(-1, 3),
+    )
+    with open(os.path.join(folder_path, MAPPED_DOCSTORE_METADATA_FILE), "w") as f:
+        json.dump({"version": MAPPED_DOCSTORE_VERSION, "metadata": metadata_table}, f)
+
+
+class MergedDocstore(Docstore):
+    """
+    Resolves the chunks of a merged index from the docstores of the stores it was merged from,
+    without copying them. The key of the source store is added as "document_key" metadata.
+    """
+
+    def __init__(self):
+        self._start_positions = []
+        self._stores = []
+
+    def add_store(self, document_key: str, retriever: FAISS) -> None:
+        self._start_positions.append(len(self))
+        self._stores.append((document_key, retriever))
+
+    def __len__(self) -> int:
+        if len(self._stores) == 0:
+            return 0
+        return self._start_positions[-1] + self._stores[-1][1].index.ntotal
+
+    def search(self, search: str) -> Union[str, Document]:
+        position = int(search)
+        if position < 0 or position >= len(self):
+            return f"ID {search} not found."
+
+        store_number = bisect_right(self._start_positions, position) - 1
+        document_key, retriever = self._stores[store_number]
+        docstore_id = retriever.index_to_docstore_id[
+            position - self._start_positions[store_number]
+        ]
+        document = retriever.docstore.search(docstore_id)
+        if not isinstance(document, Document):
+            return document
+
+        return Document(
+            page_content=document.page_content,
+            metadata={**document.metadata, "document_key": document_key},
+        )
@@ -1,6 +1,6 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 from langchain_community.vectorstores import FAISS
-from typing import List
+from typing import Callable, List
 from langchain.docstore.document import Document
 
 
@@ -15,9 +15,11 @@ class KnowledgeDocument:
         description: str,
         context: str,
         provider: str,
+        retriever_loader: Callable[[], FAISS] = None,
     ):
         self.key = key
-        self.retriever = retriever
+        self._retriever = retriever
+        self._retriever_loader = retriever_loader
         self.title = title
         self.source = source
         self.sample_question = sample_question
@@ -25,6 +27,13 @@ class KnowledgeDocument:
         self.provider = provider
         self.context = context
 
+    @property
+    def retriever(self) -> FAISS:
+        # Lazily loaded documents only materialize their index when it is searched
+        if self._retriever_loader is not None:
+            return self._retriever_loader()
+        return self._retriever
+
     def get_source_title_link(self) -> str:
         document_metadata = vars(self)
         return DocumentsUtils.get_source_title_link(document_metadata)
@@ -0,0 +1,96 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+from collections import OrderedDict
+from typing import Callable, Tuple
+
+from langchain_community.vectorstores import FAISS
+
+
+def estimate_retriever_size(retriever: FAISS) -> int:
+    """
+    Estimates the memory used by a FAISS store in bytes: the float32 vectors of the
+    index plus the text of the chunks in its docstore.
+    """
+    if retriever is None:
+        return 0
+
+    vectors_size = retriever.index.ntotal * retriever.index.d * 4
+    documents = getattr(retriever.docstore, "_dict", {})
+    text_size = sum(len(document.page_content) for document in documents.values())
+    return vectors_size + text_size
+
+
+class RetrieverCache:
+    """
+    Keeps loaded FAISS stores in memory, and evicts the least recently used ones when
+    their estimated size goes beyond the memory budget. A store that is bigger than the
+    whole budget is still kept, as long as it is the only one in the cache.
+
+    Attributes:
+        memory_budget_bytes (int): The maximum estimated size of all cached stores.
+        hits (int): The number of lookups that found a loaded store.
+        misses (int): The number of lookups that had to load the store.
+        evictions (int): The number of stores that were removed to stay within budget.
+    """
+
+    def __init__(self, memory_budget_bytes: int):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size_bytes = 0
+        self._entries: OrderedDict[str, Tuple[FAISS, int]] = OrderedDict()
+        self._loading_locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: str, loader: Callable[[], FAISS]) -> FAISS:
+        with self._lock:
+            if key in self._entries:
+                return self._hit(key)
+            loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given store, the others wait for it
+        with loading_lock:
+            with self._lock:
+                if key in self._entries:
+                    return self._hit(key)
+                self.misses += 1
+
+            retriever = loader()
+            size = estimate_retriever_size(retriever)
+
+            with self._lock:
+                self._entries[key] = (retriever, size)
+                self._size_bytes += size
+                self._loading_locks.pop(key, None)
+                self._evict_over_budget()
+
+        return retriever
+
+    def evict(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                _, size = self._entries.pop(key)
+                self._size_bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size_bytes": self._size_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+            }
+
+    def _hit(self, key: str) -> FAISS:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][0]
+
+    def _evict_over_budget(self) -> None:
+        while self._size_bytes > self.memory_budget_bytes and len(self._entries) > 1:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._size_bytes -= size
+            self.evictions += 1
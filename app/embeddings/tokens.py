@@ -0,0 +1,123 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+import tiktoken
+
+
+class TokenCounter:
+    """
+    Counts tiktoken tokens with one encoder that is created on first use, and remembers the counts of
+    recently counted texts. Text splitters count the same fragments many times while they
+    merge and overlap splits, so most of their calls are answered from memory.
+
+    Use TokenCounter.get(encoding) to share one counter per encoding.
+
+    Attributes:
+        encoding (str): The name of the tiktoken encoding.
+        max_entries (int): The maximum number of counts to remember.
+        max_text_length (int): Counts of longer texts are not remembered, they are rarely counted twice.
+        hits (int): The number of counts that were answered from memory.
+        misses (int): The number of counts that needed the encoder.
+    """
+
+    _instances: dict[str, "TokenCounter"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(
+        self,
+        encoding: str = "cl100k_base",
+        max_entries: int = 50000,
+        max_text_length: int = 4000,
+    ):
+        self.encoding = encoding
+        self.max_entries = max_entries
+        self.max_text_length = max_text_length
+        self.hits = 0
+        self.misses = 0
+        self._encoder = None
+        self._counts: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, encoding: str = "cl100k_base") -> "TokenCounter":
+        with cls._instances_lock:
+            if encoding not in cls._instances:
+                cls._instances[encoding] = cls(encoding)
+            return cls._instances[encoding]
+
+    def count(self, text: str) -> int:
+        count = self._get_count(text)
+        if count is None:
+            count = len(self._get_encoder().encode(text, disallowed_special=()))
+            self._put_count(text, count)
+
+        return count
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        """
+        Counts the tokens of several texts, encoding the ones that are not remembered
+        in one encode_batch call, which runs on several threads outside of the GIL.
+        """
+        counts = [self._get_count(text) for text in texts]
+        missing_texts = list(
+            dict.fromkeys(text for text, count in zip(texts, counts) if count is None)
+        )
+        if missing_texts:
+            encoded_texts = self._get_encoder().encode_batch(
+                missing_texts, disallowed_special=()
+            )
+            missing_counts = {}
+            for text, tokens in zip(missing_texts, encoded_texts):
+                missing_counts[text] = len(tokens)
+                self._put_count(text, len(tokens))
+            counts = [
+                count if count is not None else missing_counts[text]
+                for text, count in zip(texts, counts)
+            ]
+
+        return counts
+
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        return self._get_encoder().encode_batch(texts, disallowed_special=())
+
+    def decode_with_offsets(self, tokens: List[int]) -> Tuple[str, List[int]]:
+        """
+        Decodes tokens, and returns the text with the character offset where each token starts.
+        """
+        return self._get_encoder().decode_with_offsets(tokens)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._counts),
+                "max_entries": self.max_entries,
+            }
+
+    def _get_encoder(self):
+        if self._encoder is None:
+            self._encoder = tiktoken.get_encoding(self.encoding)
+        return self._encoder
+
+    def _get_count(self, text: str) -> int:
+        with self._lock:
+            count = self._counts.get(text, None)
+            if count is None:
+                self.misses += 1
+                return None
+
+            self._counts.move_to_end(text)
+            self.hits += 1
+            return count
+
+    def _put_count(self, text: str, count: int) -> None:
+        if self.max_entries <= 0 or len(text) > self.max_text_length:
+            return
+
+        with self._lock:
+            self._counts[text] = count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
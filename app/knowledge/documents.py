@@ -1,7 +1,10 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, List, Mapping, Tuple
 
 import frontmatter
 from langchain.docstore.document import Document
@@ -10,6 +13,9 @@ from embeddings.client import EmbeddingsClient
 from embeddings.documents import KnowledgeDocument
 from config_service import ConfigService
 from embeddings.in_memory import InMemoryEmbeddingsDB
+from embeddings.retriever_cache import RetrieverCache
+from knowledge.snapshot import KnowledgeDocumentsSnapshot
+from logger import HaivenLogger
 
 
 class KnowledgeBaseDocuments:
@@ -18,17 +24,23 @@ class KnowledgeBaseDocuments:
     It provides functionalities to load and store the embeddings, and perform similarity searches on documents.
     The class uses an embeddings provider to generate embeddings and an in-memory database to store and retrieve embeddings.
 
+    The loaded documents are kept in an immutable KnowledgeDocumentsSnapshot. Loading documents builds a new snapshot and replaces
+    the current one at once, so searches running on other threads never see a half loaded state and never wait for a lock.
+
     Attributes:
-        _embeddings_stores (dict[str, InMemoryEmbeddingsDB]): The in-memory database for storing embeddings.
+        _snapshot (KnowledgeDocumentsSnapshot): The documents by context, and one merged index per context (base + context documents), used to search "all documents" in a single scan.
         _embeddings_provider (Embeddings): The provider used for generating embeddings.
+        _loader_workers (int): The number of threads used to load documents from disk, read from KNOWLEDGE_LOADER_WORKERS if not given.
+        _retriever_cache (RetrieverCache): Set when a memory budget is configured (KNOWLEDGE_MEMORY_BUDGET_MB). Indexes are then loaded on their first search, and evicted when the budget is exceeded. No merged indexes are kept in that mode.
+        load_report (dict): Loading times in seconds, per context and per document.
     """
 
-    _document_stores: dict[str, InMemoryEmbeddingsDB] = None
-
     def __init__(
         self,
         config_service: ConfigService,
         embeddings_provider: EmbeddingsClient = None,
+        loader_workers: int = None,
+        memory_budget_mb: float = None,
     ):
         if embeddings_provider is None:
             embedding_model = config_service.load_embedding_model()
@@ -36,9 +48,23 @@ class KnowledgeBaseDocuments:
         else:
             self._embeddings_provider = embeddings_provider
 
-        if self._document_stores is None:
-            self._document_stores = {}
-            self._document_stores["base"] = InMemoryEmbeddingsDB()
+        self._snapshot = KnowledgeDocumentsSnapshot()
+        self._generation = 0
+        # Only serializes the writers, readers use whatever snapshot is current
+        self._write_lock = threading.Lock()
+        self._loader_workers = loader_workers or int(
+            os.environ.get("KNOWLEDGE_LOADER_WORKERS", 0)
+        )
+        self.load_report = {"seconds": 0, "contexts": {}}
+
+        memory_budget_mb = memory_budget_mb or float(
+            os.environ.get("KNOWLEDGE_MEMORY_BUDGET_MB", 0)
+        )
+        self._retriever_cache = (
+            RetrieverCache(int(memory_budget_mb * 1024 * 1024))
+            if memory_budget_mb > 0
+            else None
+        )
 
     def load_documents_for_base(self, knowledge_pack_path: str) -> None:
         """
@@ -59,6 +85,43 @@ class KnowledgeBaseDocuments:
         """
         self._load_documents(path=context_path, name=context_name)
 
+    def load_documents_for_contexts(
+        self, context_paths: dict[str, str]
+    ) -> dict[str, FileNotFoundError]:
+        """
+        Loads the documents of several contexts at once, sharing one pool of loader threads across all of them.
+
+        Parameters:
+            context_paths (dict[str, str]): The file system path to the documents directory, by context name.
+
+        Returns:
+            dict[str, FileNotFoundError]: The errors for the contexts whose path does not exist, by context name.
+        """
+        return self._load_stores(context_paths)
+
+    def reload_documents(
+        self, context_paths: dict[str, str]
+    ) -> dict[str, FileNotFoundError]:
+        """
+        Brings the loaded documents in line with the knowledge pack on disk. Only documents whose file or .kb folder changed since they were loaded are read again, and contexts that are not in context_paths are removed. The new stores replace the current ones at once, without blocking searches that are in progress.
+
+        Parameters:
+            context_paths (dict[str, str]): The file system path to the documents directory, by context name, including "base".
+
+        Returns:
+            dict[str, FileNotFoundError]: The errors for the contexts whose path does not exist, by context name.
+        """
+        return self._load_stores(context_paths, replace_all=True)
+
+    def get_snapshot(self) -> KnowledgeDocumentsSnapshot:
+        """
+        Returns the documents that are currently loaded. Taking the snapshot once and reading everything from it gives a consistent view, even if documents are reloaded in the meantime.
+
+        Returns:
+            KnowledgeDocumentsSnapshot: The current documents, by context.
+        """
+        return self._snapshot
+
     def get_document(self, document_key: str) -> KnowledgeDocument:
         """
         Retrieves a specific document embedding by its key. This method is useful for accessing the embedding of a previously loaded or generated document.
@@ -69,12 +132,7 @@ class KnowledgeBaseDocuments:
         Returns:
             DocumentEmbedding: The embedding of the specified document.
         """
-        for _, store in self._document_stores.items():
-            embedding = store.get_document(document_key)
-            if embedding is not None:
-                return embedding
-
-        return None
+        return self._snapshot.get_document(document_key)
 
     def get_documents(
         self, context: str = None, include_base_context=True
@@ -88,25 +146,7 @@ class KnowledgeBaseDocuments:
         Returns:
             List[DocumentEmbedding]: A list of all document embeddings stored in the service.
         """
-        all_embeddings = []
-
-        if include_base_context:
-            store = self._document_stores["base"]
-            all_embeddings.extend(store.get_documents())
-
-        if context is not None and context != "":
-            store = self._document_stores[context]
-            all_embeddings.extend(store.get_documents())
-
-        return all_embeddings
-
-    def _get_or_create_embeddings_db_for_context(
-        self, context: str
-    ) -> InMemoryEmbeddingsDB:
-        if context not in self._document_stores:
-            self._document_stores[context] = InMemoryEmbeddingsDB()
-
-        return self._document_stores[context]
+        return self._snapshot.get_documents(context, include_base_context)
 
     def _get_retriever_from_file(self, kb_path: str) -> FAISS:
         path = Path(kb_path)
@@ -116,32 +156,257 @@ class KnowledgeBaseDocuments:
         return faiss
 
     def _load_documents(self, path: str, name: str) -> None:
-        if not os.path.exists(path):
-            raise FileNotFoundError(
-                f"The specified path does not exist, no embeddings will be loaded: {path}"
+        errors = self._load_stores({name: path})
+        if name in errors:
+            raise errors[name]
+
+    def _load_stores(
+        self, context_paths: dict[str, str], replace_all: bool = False
+    ) -> dict[str, FileNotFoundError]:
+        with self._write_lock:
+            return self._load_stores_into_new_snapshot(context_paths, replace_all)
+
+    def _load_stores_into_new_snapshot(
+        self, context_paths: dict[str, str], replace_all: bool
+    ) -> dict[str, FileNotFoundError]:
+        snapshot = self._snapshot
+        errors = {}
+        loading = {}
+        started_at = time.perf_counter()
+
+        # Reading the frontmatter and deserializing the FAISS indexes is I/O and
+        # native code, so the documents of all contexts are loaded concurrently
+        with ThreadPoolExecutor(max_workers=self._loader_workers or None) as executor:
+            for name, path in context_paths.items():
+                if not os.path.exists(path):
+                    errors[name] = FileNotFoundError(
+                        f"The specified path does not exist, no embeddings will be loaded: {path}"
+                    )
+                    continue
+
+                knowledge_document_files = sorted(
+                    [
+                        f
+                        for f in os.listdir(path)
+                        if f.endswith(".md") and f != "README.md"
+                    ]
+                )
+                previous_files = snapshot.document_files.get(name, {})
+                loading[name] = []
+                for filename in knowledge_document_files:
+                    document_path = os.path.join(path, filename)
+                    loading[name].append(
+                        executor.submit(
+                            self._load_document,
+                            document_path,
+                            name,
+                            previous_files.get(document_path, None),
+                        )
+                    )
+
+            document_stores = (
+                {"base": InMemoryEmbeddingsDB()}
+                if replace_all
+                else dict(snapshot.document_stores)
+            )
+            document_files = {} if replace_all else dict(snapshot.document_files)
+            changed_contexts = []
+            for name, futures in loading.items():
+                store = InMemoryEmbeddingsDB()
+                files = {}
+                document_timings = {}
+                finished_at = started_at
+                any_loaded = False
+                for future in futures:
+                    (
+                        document_path,
+                        (fingerprint, kb_path, knowledge_document),
+                        loaded,
+                        document_finished_at,
+                        seconds,
+                    ) = future.result()
+                    if loaded:
+                        any_loaded = True
+                        finished_at = max(finished_at, document_finished_at)
+                        if knowledge_document is not None:
+                            document_timings[knowledge_document.key] = seconds
+                    if knowledge_document is not None:
+                        store.add_embedding(knowledge_document.key, knowledge_document)
+                    files[document_path] = (fingerprint, kb_path, knowledge_document)
+
+                self.load_report["contexts"][name] = {
+                    "seconds": finished_at - started_at,
+                    "documents": document_timings,
+                }
+
+                unchanged = (
+                    name in snapshot.document_stores
+                    and not any_loaded
+                    and files.keys() == snapshot.document_files.get(name, {}).keys()
+                )
+                if unchanged:
+                    document_stores[name] = snapshot.document_stores[name]
+                else:
+                    document_stores[name] = store
+                    changed_contexts.append(name)
+                document_files[name] = files
+
+        if replace_all:
+            # Contexts that were removed, or whose path is gone, also changed
+            changed_contexts.extend(
+                name
+                for name in set(snapshot.document_stores) | set(document_stores)
+                if name not in loading
+                and snapshot.document_stores.get(name) is not document_stores.get(name)
             )
 
-        knowledge_document_files = sorted(
-            [f for f in os.listdir(path) if f.endswith(".md") and f != "README.md"]
+        self._snapshot = self._create_snapshot(
+            snapshot, document_stores, document_files, changed_contexts
         )
+        self._evict_replaced_retrievers(snapshot, self._snapshot)
+
+        self.load_report["seconds"] += time.perf_counter() - started_at
 
-        if knowledge_document_files is not None:
-            self._document_stores[name] = InMemoryEmbeddingsDB()
+        return errors
 
-        for knowledge_document_file in knowledge_document_files:
-            self._load_document_into_store(
-                document_path=os.path.join(path, knowledge_document_file), context=name
+    def _create_snapshot(
+        self,
+        previous_snapshot: KnowledgeDocumentsSnapshot,
+        document_stores: dict[str, InMemoryEmbeddingsDB],
+        document_files: dict[str, dict],
+        changed_contexts: List[str],
+    ) -> KnowledgeDocumentsSnapshot:
+        # The base documents are part of every context's merged index
+        if "base" in changed_contexts:
+            contexts_to_update = list(document_stores.keys())
+        else:
+            contexts_to_update = [
+                name for name in changed_contexts if name in document_stores
+            ]
+
+        self._generation += 1
+        generations = {
+            context: previous_snapshot.generations.get(context, 0)
+            for context in document_stores.keys()
+        }
+        merged_retrievers = {
+            context: retriever
+            for context, retriever in previous_snapshot.merged_retrievers.items()
+            if context in document_stores
+        }
+        for context in contexts_to_update:
+            generations[context] = self._generation
+            if self._retriever_cache is None:
+                merged_retrievers[context] = self._create_merged_retriever(
+                    context, document_stores
+                )
+
+        return KnowledgeDocumentsSnapshot(
+            document_stores=document_stores,
+            merged_retrievers=merged_retrievers,
+            document_files=document_files,
+            generations=generations,
+        )
+
+    def _evict_replaced_retrievers(
+        self,
+        previous_snapshot: KnowledgeDocumentsSnapshot,
+        snapshot: KnowledgeDocumentsSnapshot,
+    ) -> None:
+        if self._retriever_cache is None:
+            return
+
+        current_kb_paths = {
+            (kb_path, fingerprint)
+            for files in snapshot.document_files.values()
+            for fingerprint, kb_path, _ in files.values()
+        }
+        for files in previous_snapshot.document_files.values():
+            for fingerprint, kb_path, _ in files.values():
+                if (kb_path, fingerprint) not in current_kb_paths:
+                    self._retriever_cache.evict(kb_path)
+
+    def _get_document_fingerprint(
+        self, document_path: str, document: frontmatter.Post
+    ) -> Tuple[str, tuple]:
+        """
+        Returns the path of the document's .kb folder, and the modification times and sizes
+        of the document file and of the files in that folder.
+        """
+        files = [document_path]
+        kb_path = None
+        if document.metadata.get("path"):
+            kb_path = os.path.join(
+                Path(document_path).parent, document.metadata["path"]
+            )
+            if os.path.isdir(kb_path):
+                files.extend(
+                    sorted(os.path.join(kb_path, f) for f in os.listdir(kb_path))
+                )
+
+        fingerprint = []
+        for file in files:
+            stat = os.stat(file)
+            fingerprint.append((file, stat.st_mtime_ns, stat.st_size))
+
+        return kb_path, tuple(fingerprint)
+
+    def _get_merged_retriever(
+        self, context: str, snapshot: KnowledgeDocumentsSnapshot
+    ) -> FAISS:
+        # With a memory budget there are no merged indexes: they would keep every index of
+        # the context in memory, so the documents are searched one by one through the cache
+        return snapshot.merged_retrievers.get(context, None)
+
+    def _create_merged_retriever(
+        self, context: str, document_stores: Mapping[str, InMemoryEmbeddingsDB]
+    ) -> FAISS:
+        documents = document_stores["base"].get_documents()
+        if context != "base":
+            documents.extend(document_stores[context].get_documents())
+        retrievers = {document.key: document.retriever for document in documents}
+
+        try:
+            return self._embeddings_provider.generate_from_retrievers(retrievers)
+        except ValueError as e:
+            HaivenLogger.get().analytics(
+                "KnowledgeMergedIndexNotCreated", {"context": context, "error": str(e)}
             )
+            return None
+
+    def _create_lazy_retriever_loader(self, kb_path: str) -> Callable[[], FAISS]:
+        return lambda: self._retriever_cache.get_or_load(
+            kb_path, lambda: self._get_retriever_from_file(kb_path)
+        )
+
+    def _load_document(
+        self, document_path: str, context: str, previous: tuple = None
+    ) -> Tuple[str, tuple, bool, float, float]:
+        """
+        Loads a document, unless it did not change since it was loaded before.
+
+        Parameters:
+            document_path (str): The path of the document's markdown file.
+            context (str): The context of the document.
+            previous (tuple, optional): The (fingerprint, kb_path, knowledge_document) the document was loaded with before.
+
+        Returns:
+            Tuple[str, tuple, bool, float, float]: The document path, its (fingerprint, kb_path, knowledge_document), whether it was loaded again, and when and in how many seconds it was loaded.
+        """
+        started_at = time.perf_counter()
+        knowledge_document = None
 
-    def _load_document_into_store(self, document_path: str, context: str) -> None:
         document = frontmatter.load(document_path)
+        kb_path, fingerprint = self._get_document_fingerprint(document_path, document)
+        if previous is not None and previous[0] == fingerprint:
+            # Unchanged since it was loaded, the document is reused as it is
+            finished_at = time.perf_counter()
+            return document_path, previous, False, finished_at, 0
+
         if (
             document.metadata.get("provider")
             == self._embeddings_provider.embedding_model.provider.lower()
         ):
-            folder_path = Path(document_path).parent
-            kb_path = document.metadata["path"]
-            kb_full_path = os.path.join(folder_path, kb_path)
             knowledge_document = KnowledgeDocument(
                 context=context,
                 key=document.metadata["key"],
@@ -150,12 +415,22 @@ class KnowledgeBaseDocuments:
                 sample_question=document.metadata.get("sample_question", ""),
                 description=document.metadata.get("description", ""),
                 provider=document.metadata.get("provider", ""),
-                retriever=self._get_retriever_from_file(kb_full_path),
+                retriever=None
+                if self._retriever_cache
+                else self._get_retriever_from_file(kb_path),
+                retriever_loader=self._create_lazy_retriever_loader(kb_path)
+                if self._retriever_cache
+                else None,
             )
 
-            store_for_context = self._get_or_create_embeddings_db_for_context(context)
-
-            store_for_context.add_embedding(knowledge_document.key, knowledge_document)
+        finished_at = time.perf_counter()
+        return (
+            document_path,
+            (fingerprint, kb_path, knowledge_document),
+            True,
+            finished_at,
+            finished_at - started_at,
+        )
 
     def similarity_search_with_scores(
         self, query: str, context: str, k: int = 5, score_threshold: float = None
@@ -172,19 +447,51 @@ class KnowledgeBaseDocuments:
         Returns:
             List[Tuple[Document, float]]: A list of tuples, each containing a Document and its similarity score.
         """
+        embedding = self._embeddings_provider.embed_query(query)
+        return self.similarity_search_by_vector_with_scores(
+            embedding, context, k, score_threshold
+        )
+
+    def similarity_search_by_vector_with_scores(
+        self,
+        embedding: List[float],
+        context: str,
+        k: int = 5,
+        score_threshold: float = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Same as similarity_search_with_scores, but with an already embedded query. The vector is reused for every document store that is searched, so the embeddings provider is not called again.
+
+        Parameters:
+            embedding (List[float]): The embedded search query.
+            context (str): The context to search within.
+            k (int, optional): The number of results to return. Defaults to 5.
+            score_threshold (float, optional): The minimum similarity score for a document to be included in the results. Defaults to None.
+
+        Returns:
+            List[Tuple[Document, float]]: A list of tuples, each containing a Document and its similarity score.
+        """
+        # Every store is read from the same snapshot, even if documents are reloaded meanwhile
+        snapshot = self._snapshot
+        merged_retriever = self._get_merged_retriever(context or "base", snapshot)
+        if merged_retriever is not None:
+            return merged_retriever.similarity_search_with_score_by_vector(
+                embedding, k=k, score_threshold=score_threshold
+            )
+
         similar_documents = []
 
         stores_to_search_in = {}
-        stores_to_search_in["base"] = self._document_stores["base"]
+        stores_to_search_in["base"] = snapshot.document_stores["base"]
 
         if context is not None and context != "":
-            stores_to_search_in[context] = self._document_stores[context]
+            stores_to_search_in[context] = snapshot.document_stores[context]
 
         for context, store in stores_to_search_in.items():
             for embedding_key in store.get_keys():
                 partial_results = (
-                    self._similarity_search_on_single_document_with_scores(
-                        query, embedding_key, context, k, score_threshold
+                    self._similarity_search_on_single_document_by_vector_with_scores(
+                        embedding, embedding_key, context, k, score_threshold, snapshot
                     )
                 )
                 similar_documents.extend(partial_results)
@@ -203,17 +510,38 @@ class KnowledgeBaseDocuments:
         k: int = 5,
         score_threshold: float = None,
     ) -> List[Tuple[Document, float]]:
-        store = self._document_stores.get(context, None)
+        snapshot = self._snapshot
+        store = snapshot.get_store(context)
+        if store is None or store.get_document(document_key) is None:
+            return []
+
+        embedding = self._embeddings_provider.embed_query(query)
+        return self._similarity_search_on_single_document_by_vector_with_scores(
+            embedding, document_key, context, k, score_threshold, snapshot
+        )
+
+    def _similarity_search_on_single_document_by_vector_with_scores(
+        self,
+        embedding: List[float],
+        document_key: str,
+        context: str,
+        k: int = 5,
+        score_threshold: float = None,
+        snapshot: KnowledgeDocumentsSnapshot = None,
+    ) -> List[Tuple[Document, float]]:
+        store = (snapshot or self._snapshot).get_store(context)
         if store is None:
             return []
 
-        embedding = store.get_document(document_key)
+        knowledge_document = store.get_document(document_key)
 
-        if embedding is None:
+        if knowledge_document is None:
             return []
 
-        similar_documents = embedding.retriever.similarity_search_with_score(
-            query=query, k=k, score_threshold=score_threshold
+        similar_documents = (
+            knowledge_document.retriever.similarity_search_with_score_by_vector(
+                embedding, k=k, score_threshold=score_threshold
+            )
         )
         return similar_documents
 
@@ -15,6 +15,21 @@ class KnowledgeBaseMarkdown:
 
     def __init__(self):
         self._knowledge = {}
+        self._fingerprints: dict[str, tuple] = {}
+
+    def _get_fingerprint(self, path: str) -> tuple:
+        fingerprint = []
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith(".md") and filename != "README.md":
+                stat = os.stat(os.path.join(path, filename))
+                fingerprint.append((filename, stat.st_mtime_ns, stat.st_size))
+        return tuple(fingerprint)
+
+    def _set_context(self, context: str, content: list[KnowledgeMarkdown]):
+        # Replaced rather than changed in place, for readers that are iterating over it
+        knowledge = dict(self._knowledge)
+        knowledge[context] = content
+        self._knowledge = knowledge
 
     def _load_context(self, path: str) -> list[KnowledgeMarkdown]:
         knowledge_files = sorted(
@@ -41,8 +56,8 @@ class KnowledgeBaseMarkdown:
                 f"The specified path does not exist, no knowledge will be loaded: {path}"
             )
 
-        base_content = self._load_context(path)
-        self._knowledge["base"] = base_content
+        self._fingerprints["base"] = self._get_fingerprint(path)
+        self._set_context("base", self._load_context(path))
 
     def load_for_context(self, context: str, path: str):
         if not os.path.exists(path):
@@ -50,8 +65,47 @@ class KnowledgeBaseMarkdown:
                 f"The specified path does not exist, no knowledge will be loaded: {path}"
             )
 
-        context_content = self._load_context(path)
-        self._knowledge[context] = context_content
+        self._fingerprints[context] = self._get_fingerprint(path)
+        self._set_context(context, self._load_context(path))
+
+    def reload(self, context_paths: dict[str, str]) -> list[str]:
+        """
+        Reloads the contexts whose markdown files changed since they were loaded, and removes
+        the contexts that are not in context_paths or whose path does not exist anymore.
+
+        Parameters:
+            context_paths (dict[str, str]): The path of each context, by context name, including "base".
+
+        Returns:
+            list[str]: The names of the contexts that were loaded, changed or removed.
+        """
+        knowledge = {}
+        fingerprints = {}
+        changed_contexts = []
+
+        for context, path in context_paths.items():
+            if not os.path.exists(path):
+                continue
+
+            fingerprint = self._get_fingerprint(path)
+            if (
+                context in self._knowledge
+                and self._fingerprints.get(context) == fingerprint
+            ):
+                knowledge[context] = self._knowledge[context]
+            else:
+                knowledge[context] = self._load_context(path)
+                changed_contexts.append(context)
+            fingerprints[context] = fingerprint
+
+        changed_contexts.extend(
+            context for context in self._knowledge if context not in knowledge
+        )
+
+        self._knowledge = knowledge
+        self._fingerprints = fingerprints
+
+        return changed_contexts
 
     def get_knowledge_document(
         self, context: str, knowledge_key: str
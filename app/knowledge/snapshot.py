@@ -0,0 +1,79 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from types import MappingProxyType
+from typing import List, Mapping
+
+from langchain_community.vectorstores import FAISS
+from embeddings.documents import KnowledgeDocument
+from embeddings.in_memory import InMemoryEmbeddingsDB
+
+
+class KnowledgeDocumentsSnapshot:
+    """
+    An immutable view of the loaded documents: contexts -> documents -> retrievers, and the
+    merged retriever of each context. KnowledgeBaseDocuments never changes a snapshot, it
+    replaces it as a whole when documents are loaded. A reader that takes the current
+    snapshot once sees one consistent state for the whole request, without a lock.
+
+    The stores in a snapshot must not be changed after the snapshot was created.
+
+    Attributes:
+        document_stores (Mapping[str, InMemoryEmbeddingsDB]): The documents, by context. There is always a "base" context.
+        merged_retrievers (Mapping[str, FAISS]): The merged index of each context, when they are created eagerly.
+        document_files (Mapping[str, dict]): The fingerprint, .kb path and loaded document per document file, by context.
+        generations (Mapping[str, int]): A number per context that changes every time the context, or the base context, is loaded again.
+    """
+
+    def __init__(
+        self,
+        document_stores: dict[str, InMemoryEmbeddingsDB] = None,
+        merged_retrievers: dict[str, FAISS] = None,
+        document_files: dict[str, dict] = None,
+        generations: dict[str, int] = None,
+    ):
+        if document_stores is None:
+            document_stores = {"base": InMemoryEmbeddingsDB()}
+
+        self._document_stores = MappingProxyType(dict(document_stores))
+        self._merged_retrievers = MappingProxyType(dict(merged_retrievers or {}))
+        self._document_files = MappingProxyType(dict(document_files or {}))
+        self._generations = MappingProxyType(dict(generations or {}))
+
+    @property
+    def document_stores(self) -> Mapping[str, InMemoryEmbeddingsDB]:
+        return self._document_stores
+
+    @property
+    def merged_retrievers(self) -> Mapping[str, FAISS]:
+        return self._merged_retrievers
+
+    @property
+    def document_files(self) -> Mapping[str, dict]:
+        return self._document_files
+
+    @property
+    def generations(self) -> Mapping[str, int]:
+        return self._generations
+
+    def get_store(self, context: str) -> InMemoryEmbeddingsDB:
+        return self._document_stores.get(context, None)
+
+    def get_document(self, document_key: str) -> KnowledgeDocument:
+        for store in self._document_stores.values():
+            document = store.get_document(document_key)
+            if document is not None:
+                return document
+
+        return None
+
+    def get_documents(
+        self, context: str = None, include_base_context=True
+    ) -> List[KnowledgeDocument]:
+        documents = []
+
+        if include_base_context:
+            documents.extend(self._document_stores["base"].get_documents())
+
+        if context is not None and context != "":
+            documents.extend(self._document_stores[context].get_documents())
+
+        return documents
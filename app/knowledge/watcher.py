@@ -0,0 +1,61 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+import threading
+
+from logger import HaivenLogger
+
+
+class KnowledgePackWatcher:
+    """
+    Checks the knowledge pack for changes at a fixed interval, in a background thread,
+    and reloads what changed through KnowledgeManager.reload. Files are compared by
+    modification time and size, so a check where nothing changed only reads file metadata
+    and the frontmatter of the documents.
+
+    Attributes:
+        knowledge_manager (KnowledgeManager): The knowledge manager to reload.
+        interval_seconds (float): The time between two checks.
+    """
+
+    def __init__(self, knowledge_manager, interval_seconds: float):
+        self.knowledge_manager = knowledge_manager
+        self.interval_seconds = interval_seconds
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, knowledge_manager):
+        """
+        Creates a watcher with the interval set in KNOWLEDGE_RELOAD_INTERVAL_SECONDS,
+        or returns None if it is not set.
+        """
+        interval_seconds = float(os.environ.get("KNOWLEDGE_RELOAD_INTERVAL_SECONDS", 0))
+        if interval_seconds <= 0:
+            return None
+
+        return cls(knowledge_manager, interval_seconds)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="knowledge-pack-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_seconds):
+            try:
+                self.knowledge_manager.reload()
+            except Exception as e:
+                HaivenLogger.get().analytics(
+                    "KnowledgePackReloadFailed", {"error": str(e)}
+                )
@@ -1,4 +1,6 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+
 from config_service import ConfigService
 from logger import HaivenLogger
 
@@ -19,6 +21,8 @@ class KnowledgeManager:
             config_service.load_knowledge_pack_path()
         )
         self.active_knowledge_context = None
+        self._reload_lock = threading.Lock()
+        self._missing_embeddings = set()
 
         self.knowledge_base_markdown = self._load_base_markdown_knowledge()
         self._load_context_markdown_knowledge()
@@ -52,6 +56,7 @@ class KnowledgeManager:
             HaivenLogger.get().analytics(
                 "KnowledgePackEmbeddingsNotFound", {"error": str(e)}
             )
+            self._missing_embeddings.add(str(e))
 
         return knowledge_base_documents
 
@@ -77,29 +82,103 @@ class KnowledgeManager:
             )
 
     def _load_context_documents_knowledge(self):
-        for context in self.knowledge_pack_definition.contexts:
-            self._load_context_embeddings(context)
+        context_paths = {
+            knowledge_context.name: self._get_context_embeddings_path(knowledge_context)
+            for knowledge_context in self.knowledge_pack_definition.contexts
+            if knowledge_context is not None
+        }
+
+        errors = self.knowledge_base_documents.load_documents_for_contexts(
+            context_paths
+        )
+        for error in errors.values():
+            HaivenLogger.get().analytics(
+                "KnowledgePackEmbeddingsNotFound", {"error": str(error)}
+            )
+            self._missing_embeddings.add(str(error))
 
-    def _load_context_embeddings(self, knowledge_context: KnowledgeContext):
-        if knowledge_context is None:
-            return
+        HaivenLogger.get().analytics(
+            "KnowledgePackEmbeddingsLoaded",
+            {"report": self.knowledge_base_documents.load_report},
+        )
 
-        context_embeddings_path = (
-            self.knowledge_pack_definition.path
+    def reload(self) -> dict:
+        """
+        Reloads what changed in the knowledge pack since it was loaded: markdown contexts, and
+        documents whose file or .kb folder was added, changed or removed. Searches and prompts
+        keep working on the previous knowledge until the new one is swapped in.
+
+        Returns:
+            dict: The names of the reloaded markdown contexts, and the keys of the reloaded documents by context.
+        """
+        with self._reload_lock:
+            knowledge_pack_definition = KnowledgePack(
+                self._config_service.load_knowledge_pack_path()
+            )
+            contexts = [
+                knowledge_context
+                for knowledge_context in knowledge_pack_definition.contexts
+                if knowledge_context is not None
+            ]
+
+            markdown_paths = {"base": knowledge_pack_definition.path}
+            documents_paths = {"base": knowledge_pack_definition.path + "/embeddings"}
+            for knowledge_context in contexts:
+                markdown_paths[knowledge_context.name] = (
+                    knowledge_pack_definition.path
+                    + "/contexts/"
+                    + knowledge_context.path
+                )
+                documents_paths[knowledge_context.name] = (
+                    self._get_context_embeddings_path(
+                        knowledge_context, knowledge_pack_definition
+                    )
+                )
+
+            changed_markdown = self.knowledge_base_markdown.reload(markdown_paths)
+            errors = self.knowledge_base_documents.reload_documents(documents_paths)
+            self.knowledge_pack_definition = knowledge_pack_definition
+
+            # The watcher reloads every few seconds, embeddings that stay missing are
+            # only logged when they go missing
+            missing_embeddings = {str(error) for error in errors.values()}
+            for error in sorted(missing_embeddings - self._missing_embeddings):
+                HaivenLogger.get().analytics(
+                    "KnowledgePackEmbeddingsNotFound", {"error": error}
+                )
+            self._missing_embeddings = missing_embeddings
+
+            report = {
+                "markdown": changed_markdown,
+                "documents": {
+                    name: list(
+                        self.knowledge_base_documents.load_report["contexts"][name][
+                            "documents"
+                        ].keys()
+                    )
+                    for name in documents_paths.keys()
+                    if name not in errors
+                },
+            }
+            HaivenLogger.get().analytics("KnowledgePackReloaded", {"report": report})
+
+            return report
+
+    def _get_context_embeddings_path(
+        self,
+        knowledge_context: KnowledgeContext,
+        knowledge_pack_definition: KnowledgePack = None,
+    ):
+        knowledge_pack_definition = (
+            knowledge_pack_definition or self.knowledge_pack_definition
+        )
+        return (
+            knowledge_pack_definition.path
             + "/contexts/"
             + knowledge_context.path
             + "/embeddings"
         )
 
-        try:
-            self.knowledge_base_documents.load_documents_for_context(
-                knowledge_context.name, context_embeddings_path
-            )
-        except FileNotFoundError as e:
-            HaivenLogger.get().analytics(
-                "KnowledgePackEmbeddingsNotFound", {"error": str(e)}
-            )
-
     def on_context_selected(self, context_name: str) -> str:
         self.active_knowledge_context = context_name
 
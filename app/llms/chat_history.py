@@ -0,0 +1,213 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain.schema import HumanMessage, SystemMessage
+
+from embeddings.tokens import TokenCounter
+from logger import HaivenLogger
+
+DEFAULT_HISTORY_MAX_TOKENS = 8000
+SUMMARY_HEADING = "Summary of the earlier conversation:"
+
+_compaction_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="chat-history-compactor"
+)
+
+
+class ChatHistoryCompactor:
+    """
+    Keeps the memory of chats within a token budget, for the chat types that send their
+    memory to the model with every message (replays_memory): the others would pay for
+    summaries they never send. When a change to the memory of a chat takes it over the
+    budget of its chat type, the older turns are summarised in a
+    background thread, and replaced by the summary once it is ready. The system message
+    and the most recent turns are kept verbatim, and the summary is appended to the
+    system message, where it is updated by the next compactions.
+
+    Attributes:
+        budgets (dict): The maximum number of tokens of the memory by chat type name, 0 to
+            keep the whole memory of a chat type.
+        default_budget (int): The budget of the chat types that are not in budgets.
+        recent_share (float): The share of the budget kept for the most recent turns.
+        token_counter (TokenCounter): Counts the tokens of the messages.
+    """
+
+    def __init__(
+        self,
+        budgets: dict = None,
+        default_budget: int = DEFAULT_HISTORY_MAX_TOKENS,
+        recent_share: float = 0.5,
+        token_counter: TokenCounter = None,
+        executor=None,
+    ):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.recent_share = recent_share
+        self.token_counter = token_counter or TokenCounter.get("cl100k_base")
+        self._executor = executor or _compaction_executor
+        self._compacting = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, chat_types):
+        """
+        Creates a compactor with the budget set in CHAT_HISTORY_MAX_TOKENS, and the budgets of
+        single chat types in CHAT_HISTORY_MAX_TOKENS_<CHAT TYPE IN UPPER CASE>, like
+        CHAT_HISTORY_MAX_TOKENS_STREAMINGCHAT. A budget of 0 turns compaction off.
+        """
+        default_budget = int(
+            os.environ.get("CHAT_HISTORY_MAX_TOKENS", DEFAULT_HISTORY_MAX_TOKENS)
+        )
+        budgets = {}
+        for chat_type in chat_types:
+            budget = os.environ.get(f"CHAT_HISTORY_MAX_TOKENS_{chat_type.upper()}")
+            if budget is not None:
+                budgets[chat_type] = int(budget)
+
+        return cls(budgets, default_budget)
+
+    def attach(self, chat):
+        if chat.replays_memory:
+            chat.add_memory_listener(self.compact_if_over_budget)
+
+    def budget_of(self, chat) -> int:
+        return self.budgets.get(chat.__class__.__name__, self.default_budget)
+
+    def compact_if_over_budget(self, chat):
+        """
+        Starts the compaction of the older turns of a chat in the background, if its memory
+        is over budget and no compaction of the chat is running.
+        """
+        budget = self.budget_of(chat)
+        if budget <= 0:
+            return
+
+        memory = list(chat.memory)
+        counts = self.token_counter.count_batch([message.content for message in memory])
+        if sum(counts) <= budget:
+            return
+
+        first_recent_message = self._find_first_recent_message(
+            memory, counts, budget * self.recent_share
+        )
+        if first_recent_message <= 1:
+            return
+
+        with self._lock:
+            if id(chat) in self._compacting:
+                return
+            self._compacting.add(id(chat))
+
+        self._executor.submit(self._compact, chat, memory[:first_recent_message])
+
+    def _find_first_recent_message(self, memory, counts, recent_budget) -> int:
+        """
+        Returns the index of the first message kept verbatim: the start of the oldest turn
+        from which the memory fits in recent_budget, and at least the start of the last turn.
+        """
+        turn_starts = {
+            index
+            for index, message in enumerate(memory)
+            if index > 0 and isinstance(message, HumanMessage)
+        }
+        if not turn_starts:
+            return 0
+
+        recent_tokens = 0
+        first_recent_message = max(turn_starts)
+        for index in range(len(memory) - 1, 0, -1):
+            recent_tokens += counts[index]
+            if recent_tokens > recent_budget:
+                break
+            if index in turn_starts:
+                first_recent_message = index
+        return first_recent_message
+
+    def _compact(self, chat, compacted_messages):
+        try:
+            summary = chat.chat_client.invoke(
+                self._summary_request(chat, compacted_messages)
+            ).content
+
+            # Messages are only appended while the summary is created, so the compacted
+            # messages are still at the start of the memory, unless it was replaced
+            if not all(
+                message is compacted_message
+                for message, compacted_message in zip(chat.memory, compacted_messages)
+            ):
+                return
+            summary_message = SystemMessage(
+                content=f"{chat.system}\n\n{SUMMARY_HEADING}\n{summary}"
+            )
+            chat.memory[: len(compacted_messages)] = [summary_message]
+        except Exception as e:
+            HaivenLogger.get().analytics(
+                "ChatHistoryCompactionFailed",
+                {"chat_type": chat.__class__.__name__, "error": str(e)},
+            )
+            return
+        finally:
+            with self._lock:
+                self._compacting.discard(id(chat))
+
+        chat._changed_in_background(
+            lambda chat_state: _apply_compaction(
+                chat_state, compacted_messages, summary_message
+            )
+        )
+
+    def _summary_request(self, chat, compacted_messages):
+        previous_summary = (
+            compacted_messages[0]
+            .content[len(chat.system) :]
+            .strip()
+            .removeprefix(SUMMARY_HEADING)
+            .strip()
+        )
+        conversation = "\n\n".join(
+            f"{message.type}: {message.content}" for message in compacted_messages[1:]
+        )
+        return [
+            HumanMessage(
+                content=f"""
+            Update the summary of a conversation with the messages that followed it.
+            Keep the facts, decisions, requirements, names and open questions that the
+            rest of the conversation might refer to, in maximum 3 paragraphs.
+
+            {previous_summary or "There is no summary yet."}
+
+            Messages:
+            {conversation}"""
+            )
+        ]
+
+
+def _apply_compaction(chat_state: dict, compacted_messages, summary_message) -> dict:
+    """
+    Replaces the compacted messages at the start of a chat state by the summary message,
+    or returns None if the state does not start with them anymore.
+    """
+    messages = chat_state["messages"]
+    if [
+        (message["type"], message["content"])
+        for message in messages[: len(compacted_messages)]
+    ] != [(message.type, message.content) for message in compacted_messages]:
+        return None
+
+    # The search summary keeps covering the same messages, unless they were compacted
+    summarised_messages = chat_state.get("summarised_messages", 0)
+    if summarised_messages > len(compacted_messages):
+        summarised_messages -= len(compacted_messages) - 1
+    else:
+        summarised_messages = 0
+
+    return {
+        **chat_state,
+        "messages": [
+            {"type": summary_message.type, "content": summary_message.content},
+            *messages[len(compacted_messages) :],
+        ],
+        "summarised_messages": summarised_messages,
+    }
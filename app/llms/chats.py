@@ -1,7 +1,11 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import json
+import os
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from langchain.chains.question_answering import load_qa_chain
 from langchain.prompts import PromptTemplate
@@ -11,11 +15,27 @@ from pydantic import BaseModel
 from config_service import ConfigService
 from knowledge_manager import KnowledgeManager
 from embeddings.documents import DocumentsUtils
-from llms.clients import ChatClientFactory
+from llms.chat_history import ChatHistoryCompactor
+from llms.clients import ChatClientConfig, ChatClientFactory
+from llms.session_stores import InMemorySessionStore, SessionStore, create_session_store
 from logger import HaivenLogger
 
+DEFAULT_SESSION_TTL_SECONDS = 30 * 60
+DEFAULT_MAX_SESSIONS = 10000
+DEFAULT_SESSION_SWEEP_INTERVAL_SECONDS = 60
+
+_MESSAGE_CLASSES = {"system": SystemMessage, "human": HumanMessage, "ai": AIMessage}
+
+_summary_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="search-summary"
+)
+
 
 class HaivenBaseChat:
+    # Whether the memory is sent to the model with every message, so that it is worth
+    # keeping it within a token budget, see ChatHistoryCompactor
+    replays_memory = False
+
     def __init__(
         self,
         chat_client: BaseChatModel,
@@ -26,6 +46,84 @@ class HaivenBaseChat:
         self.memory = [SystemMessage(content=system_message)]
         self.chat_client = chat_client
         self.knowledge_manager = knowledge_manager
+        # The service, temperature and stop of the chat client, to create it again on rehydration
+        self.client_settings = None
+        self.memory_listeners = []
+        self.background_change_listeners = []
+        # The summary of the conversation for similarity searches, up to _summarised_message
+        self.search_summary = None
+        self._summarised_message = None
+        self._summary_lock = threading.Lock()
+        self._summary_precompute = None
+        self._summary_executor = None
+
+    def add_memory_listener(self, listener):
+        """
+        Calls listener with the chat each time its memory changed: when a message and its
+        response were added, or when older messages were replaced by a summary.
+        """
+        self.memory_listeners.append(listener)
+
+    def _memory_changed(self):
+        for listener in self.memory_listeners:
+            listener(self)
+
+    def add_background_change_listener(self, listener):
+        """
+        Calls listener with the chat and a function each time a change that was made in the
+        background, like a summary, was applied to the chat. The function applies the same
+        change to a state of HaivenBaseChat.to_state, and returns the changed state, or None
+        if the state no longer has the messages the change was made for: other requests
+        can have continued the chat from a saved state in the meantime.
+        """
+        self.background_change_listeners.append(listener)
+
+    def _changed_in_background(self, apply_to_state):
+        for listener in self.background_change_listeners:
+            listener(self, apply_to_state)
+
+    def to_state(self) -> dict:
+        """
+        Returns what is needed to rehydrate the chat in another process: its type, the
+        options it was created with, the settings of its client, and its messages.
+        """
+        return {
+            "type": self.__class__.__name__,
+            "client": self.client_settings,
+            "options": self._options(),
+            "messages": [
+                {"type": message.type, "content": message.content}
+                for message in self.memory
+            ],
+            "search_summary": self.search_summary,
+            "summarised_messages": self._count_summarised_messages(),
+        }
+
+    @classmethod
+    def from_state(
+        cls,
+        state: dict,
+        chat_client: BaseChatModel,
+        knowledge_manager: KnowledgeManager,
+    ):
+        chat = cls._create(chat_client, knowledge_manager, state["options"])
+        chat.client_settings = state["client"]
+        chat.memory = [
+            _MESSAGE_CLASSES[message["type"]](content=message["content"])
+            for message in state["messages"]
+        ]
+        # Without summarised messages, the summary is updated with all the messages
+        chat.search_summary = state.get("search_summary")
+        if state.get("summarised_messages"):
+            chat._summarised_message = chat.memory[state["summarised_messages"] - 1]
+        return chat
+
+    def _options(self) -> dict:
+        return {"system_message": self.system}
+
+    @classmethod
+    def _create(cls, chat_client, knowledge_manager, options: dict):
+        return cls(chat_client, knowledge_manager, **options)
 
     def log_run(self, extra={}):
         class_name = self.__class__.__name__
@@ -40,21 +138,122 @@ class HaivenBaseChat:
     def memory_as_text(self):
         return "\n".join([str(message) for message in self.memory])
 
+    def precompute_search_summaries(self, executor=None):
+        """
+        Updates the summary of the conversation for similarity searches in the background
+        after each response, so that the next search does not wait for it.
+        """
+        self._summary_executor = executor or _summary_executor
+        self.add_memory_listener(lambda chat: chat._start_summary_precompute())
+
+    def _start_summary_precompute(self):
+        if len(self.memory) <= 2 or not isinstance(self.memory[-1], AIMessage):
+            return
+        if self._summary_precompute is not None and not self._summary_precompute.done():
+            return
+        if not self._messages_to_summarise():
+            return
+
+        self._summary_precompute = self._summary_executor.submit(
+            self._precompute_summary
+        )
+
+    def _precompute_summary(self):
+        summarised_message = self._summarised_message
+        try:
+            search_summary = self._summarise_conversation()
+        except Exception as e:
+            HaivenLogger.get().analytics(
+                "SearchSummaryPrecomputeFailed",
+                {"chat_type": self.__class__.__name__, "error": str(e)},
+            )
+            return
+        if self._summarised_message is summarised_message:
+            return
+
+        # The session was saved when the response finished, before the summary
+        summarised_message = self._summarised_message
+        summarised_messages = self._count_summarised_messages()
+        self._changed_in_background(
+            lambda chat_state: _apply_search_summary(
+                chat_state, search_summary, summarised_message, summarised_messages
+            )
+        )
+
+    def _count_summarised_messages(self) -> int:
+        # The number of messages up to the last one the search summary covers, looked up
+        # from the end of the memory, or 0 if it is not in the memory
+        for index in range(len(self.memory) - 1, 0, -1):
+            if self.memory[index] is self._summarised_message:
+                return index + 1
+        return 0
+
     def _summarise_conversation(self):
-        copy_of_history = []
-        copy_of_history.extend(self.memory)
-        copy_of_history.append(
-            HumanMessage(
-                content="""
-            Summarise the conversation we've had so far in maximum 2 paragraphs.
+        """
+        Returns the summary of the conversation for similarity searches. The summary is kept,
+        and later calls only summarise the messages that were added since, against it.
+        """
+        with self._summary_lock:
+            new_messages = self._messages_to_summarise()
+            if new_messages:
+                summary = self.chat_client(self._summary_request(new_messages))
+                self._remember_summary(summary.content, new_messages)
+            return self.search_summary
+
+    async def _asummarise_conversation(self):
+        if self._summary_precompute is not None:
+            # Waits for the summary of the precompute, rather than asking for it twice
+            await asyncio.wrap_future(self._summary_precompute)
+
+        new_messages = self._messages_to_summarise()
+        if new_messages:
+            summary = await self.chat_client.ainvoke(
+                self._summary_request(new_messages)
+            )
+            with self._summary_lock:
+                self._remember_summary(summary.content, new_messages)
+        return self.search_summary
+
+    def _messages_to_summarise(self):
+        # Older messages can be compacted away, and the summary updated with all the others
+        return self.memory[max(self._count_summarised_messages(), 1) :]
+
+    def _remember_summary(self, summary: str, summarised_messages):
+        self.search_summary = summary
+        self._summarised_message = summarised_messages[-1]
+
+    def _summary_request(self, new_messages):
+        instructions = """
             I want to use the summary to start a search for other relevant information for my task,
             so please make sure to include important key words and phrases that would help
             me find relevant information. It is not important that the summary is polished sentences,
             it is more important that a similarity search would find relevant information based on the summary."""
-            )
+
+        if self.search_summary is None:
+            return [
+                self.memory[0],
+                *new_messages,
+                HumanMessage(
+                    content=f"""
+            Summarise the conversation we've had so far in maximum 2 paragraphs.{instructions}"""
+                ),
+            ]
+
+        conversation = "\n\n".join(
+            f"{message.type}: {message.content}" for message in new_messages
         )
-        summary = self.chat_client(copy_of_history)
-        return summary.content
+        return [
+            HumanMessage(
+                content=f"""
+            Here is a summary of the conversation we've had so far:
+            {self.search_summary}
+
+            Here are the messages that followed it:
+            {conversation}
+
+            Update the summary with these messages, in maximum 2 paragraphs.{instructions}"""
+            )
+        ]
 
     def _similarity_search_based_on_history(
         self, message, knowledge_document_key, knowledge_context
@@ -64,6 +263,30 @@ class HaivenBaseChat:
         else:
             summary = "\n".join([message.content for message in self.memory])
 
+        return self._search_knowledge(
+            summary, message, knowledge_document_key, knowledge_context
+        )
+
+    async def _asimilarity_search_based_on_history(
+        self, message, knowledge_document_key, knowledge_context
+    ):
+        if len(self.memory) > 2:
+            summary = await self._asummarise_conversation()
+        else:
+            summary = "\n".join([message.content for message in self.memory])
+
+        # The vector search is CPU bound, it runs in a thread to keep the event loop free
+        return await asyncio.to_thread(
+            self._search_knowledge,
+            summary,
+            message,
+            knowledge_document_key,
+            knowledge_context,
+        )
+
+    def _search_knowledge(
+        self, summary, message, knowledge_document_key, knowledge_context
+    ):
         similarity_query = f"""
             {summary}
 
@@ -107,6 +330,8 @@ class HaivenBaseChat:
 
 
 class StreamingChat(HaivenBaseChat):
+    replays_memory = True
+
     def __init__(
         self,
         chat_client: BaseChatModel,
@@ -117,6 +342,12 @@ class StreamingChat(HaivenBaseChat):
         super().__init__(chat_client, knowledge_manager, system_message)
         self.stream_in_chunks = stream_in_chunks
 
+    def _options(self) -> dict:
+        return {
+            "system_message": self.system,
+            "stream_in_chunks": self.stream_in_chunks,
+        }
+
     def run(self, message: str):
         self.memory.append(HumanMessage(content=message))
         self.log_run()
@@ -127,6 +358,27 @@ class StreamingChat(HaivenBaseChat):
             self.memory[-1].content += chunk.content
             yield chunk.content
 
+        self._memory_changed()
+
+    async def arun(self, message: str):
+        """
+        Like run, but streams the response with the astream of the chat client, so that
+        waiting for the model does not hold a thread while the response is served.
+        """
+        self.memory.append(HumanMessage(content=message))
+        self.log_run()
+
+        is_first_chunk = True
+        async for chunk in self.chat_client.astream(self.memory):
+            if is_first_chunk:
+                self.memory.append(AIMessage(content=""))
+                is_first_chunk = False
+            self.memory[-1].content += chunk.content
+            yield chunk.content
+
+        # Listeners save the session to its store, which blocks
+        await asyncio.to_thread(self._memory_changed)
+
     def run_with_document(
         self,
         knowledge_document_key: str,
@@ -137,12 +389,33 @@ class StreamingChat(HaivenBaseChat):
             message, knowledge_document_key, knowledge_context
         )
 
+        # ask the LLM for the advice
+        for chunk in self.run(self._build_prompt(message, context_for_prompt)):
+            yield chunk, sources_markdown
+
+    async def arun_with_document(
+        self,
+        knowledge_document_key: str,
+        knowledge_context: str,
+        message: str = None,
+    ):
+        (
+            context_for_prompt,
+            sources_markdown,
+        ) = await self._asimilarity_search_based_on_history(
+            message, knowledge_document_key, knowledge_context
+        )
+
+        async for chunk in self.arun(self._build_prompt(message, context_for_prompt)):
+            yield chunk, sources_markdown
+
+    def _build_prompt(self, message: str, context_for_prompt: str) -> str:
         user_request = (
             message
             or "Based on our conversation so far, what do you think is relevant to me with the CONTEXT information I gathered?"
         )
 
-        prompt = f"""
+        return f"""
         
         {user_request}
 
@@ -153,10 +426,6 @@ class StreamingChat(HaivenBaseChat):
         Do not provide any advice that is outside of the CONTEXT I provided.
         """
 
-        # ask the LLM for the advice
-        for chunk in self.run(prompt):
-            yield chunk, sources_markdown
-
 
 class Q_A_ResponseParser:
     question_prefix: str = "<Question>"
@@ -178,6 +447,8 @@ class Q_A_ResponseParser:
 
 
 class Q_A_Chat(HaivenBaseChat):
+    replays_memory = True
+
     def __init__(
         self,
         chat_client: BaseChatModel,
@@ -189,6 +460,10 @@ class Q_A_Chat(HaivenBaseChat):
             system_message,
         )
 
+    @classmethod
+    def _create(cls, chat_client, knowledge_manager, options: dict):
+        return cls(chat_client, **options)
+
     def process_response(self, response: str):
         # TODO: How to NOT post-process when the Q&A time is over?
         # TODO: If the Q&A is very long, we could reset the history to only include the Q&A end result in the history, from that point on
@@ -202,6 +477,7 @@ class Q_A_Chat(HaivenBaseChat):
         ai_message = self.chat_client(self.memory)
         processed_response = self.process_response(ai_message.content)
         self.memory.append(AIMessage(content=processed_response))
+        self._memory_changed()
 
         return processed_response
 
@@ -231,6 +507,13 @@ class DocumentsChat(HaivenBaseChat):
         self.knowledge = knowledge
         self.chain = DocumentsChat._create_chain(self.chat_client)
 
+    def _options(self) -> dict:
+        return {
+            "system_message": self.system,
+            "knowledge": self.knowledge,
+            "context": self.context,
+        }
+
     @staticmethod
     def _create_chain(chat_client):
         return load_qa_chain(llm=chat_client, chain_type="stuff")
@@ -272,6 +555,7 @@ class DocumentsChat(HaivenBaseChat):
             )
         )
         self.memory.append(AIMessage(content=sources_markdown))
+        self._memory_changed()
 
         return ai_message["output_text"], sources_markdown
 
@@ -309,6 +593,16 @@ class JSONChat(HaivenBaseChat):
         # Transition to new frontend SSE implementation: Add "data: " and "[DONE]" vs not doing that
         self.event_stream_standard = event_stream_standard
 
+    def _options(self) -> dict:
+        return {
+            "system_message": self.system,
+            "event_stream_standard": self.event_stream_standard,
+        }
+
+    @classmethod
+    def _create(cls, chat_client, knowledge_manager, options: dict):
+        return cls(chat_client, **options)
+
     def stream_from_model(self, prompt):
         messages = [HumanMessage(content=prompt)]
         stream = self.chat_client.stream(
@@ -320,6 +614,14 @@ class JSONChat(HaivenBaseChat):
         if self.event_stream_standard:
             yield "[DONE]"
 
+    async def astream_from_model(self, prompt):
+        messages = [HumanMessage(content=prompt)]
+        async for chunk in self.chat_client.astream(messages):
+            yield chunk.content
+
+        if self.event_stream_standard:
+            yield "[DONE]"
+
     def run(self, message: str):
         self.memory.append(HumanMessage(content=message))
         data = enumerate(self.stream_from_model(message))
@@ -327,73 +629,199 @@ class JSONChat(HaivenBaseChat):
             if i == 0:
                 self.memory.append(AIMessage(content=""))
 
-            if chunk == "[DONE]":
-                yield f"data: {chunk}\n\n"
-            else:
-                self.memory[-1].content += chunk
-                if self.event_stream_standard:
-                    message = '{ "data": ' + json.dumps(chunk) + " }"
-                    yield f"data: {message}\n\n"
-                else:
-                    message = json.dumps({"data": chunk})
-                    yield f"{message}\n\n"
+            yield self._to_event(chunk)
+
+        self._memory_changed()
+
+    async def arun(self, message: str):
+        """
+        Like run, but streams the response with the astream of the chat client, so that
+        waiting for the model does not hold a thread while the response is served.
+        """
+        self.memory.append(HumanMessage(content=message))
+        is_first_chunk = True
+        async for chunk in self.astream_from_model(message):
+            if is_first_chunk:
+                self.memory.append(AIMessage(content=""))
+                is_first_chunk = False
+
+            yield self._to_event(chunk)
+
+        await asyncio.to_thread(self._memory_changed)
+
+    def _to_event(self, chunk: str) -> str:
+        if chunk == "[DONE]":
+            return f"data: {chunk}\n\n"
+
+        self.memory[-1].content += chunk
+        if self.event_stream_standard:
+            message = '{ "data": ' + json.dumps(chunk) + " }"
+            return f"data: {message}\n\n"
+        else:
+            message = json.dumps({"data": chunk})
+            return f"{message}\n\n"
 
 
 class ServerChatSessionMemory:
-    def __init__(self):
-        self.USER_CHATS = {}
-
-    def clear_old_entries(self):
-        allowed_age_in_minutes = 30
-        allowed_age_in_seconds = 60 * allowed_age_in_minutes
-        print(
-            f"CLEANUP: Removing chat sessions with age > {allowed_age_in_minutes} mins from memory. Currently {len(self.USER_CHATS)} entries in memory"
+    """
+    Keeps the chat sessions of the users in a SessionStore, in memory by default. With a
+    store that several workers share, a session is saved each time the memory of its chat
+    changes, and the chat is rehydrated with chat_loader by the worker that receives the
+    next request.
+
+    Sessions that were not accessed for ttl_seconds are removed by a sweeper thread, and
+    the least recently accessed sessions are evicted when a new session would exceed
+    max_sessions. The stores keep their sessions ordered or indexed by last access, so
+    neither looks at the sessions that stay.
+
+    Attributes:
+        store (SessionStore): Where the sessions are kept.
+        chat_loader: A function that creates a chat from the state of HaivenBaseChat.to_state,
+            set by the ChatManager.
+        ttl_seconds (float): The time after its last access at which a session expires.
+        max_sessions (int): The number of sessions kept at most, None for no limit.
+        expired (int): The number of sessions removed because they expired.
+        evicted (int): The number of sessions evicted to stay within max_sessions.
+    """
+
+    def __init__(
+        self,
+        store: SessionStore = None,
+        chat_loader=None,
+        ttl_seconds: float = DEFAULT_SESSION_TTL_SECONDS,
+        max_sessions: int = None,
+    ):
+        self.store = store or InMemorySessionStore()
+        self.chat_loader = chat_loader
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.expired = 0
+        self.evicted = 0
+        self._stopped = threading.Event()
+        self._sweeper = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        Creates the session memory with the store of CHAT_SESSION_STORE_URL, see
+        create_session_store, in memory if it is not set, and the expiry set in
+        CHAT_SESSION_TTL_SECONDS and CHAT_SESSION_MAX_SESSIONS (0 for no limit).
+        """
+        ttl_seconds = float(
+            os.environ.get("CHAT_SESSION_TTL_SECONDS", DEFAULT_SESSION_TTL_SECONDS)
+        )
+        max_sessions = int(
+            os.environ.get("CHAT_SESSION_MAX_SESSIONS", DEFAULT_MAX_SESSIONS)
+        )
+        return cls(
+            create_session_store(
+                os.environ.get("CHAT_SESSION_STORE_URL", ""), int(ttl_seconds)
+            ),
+            ttl_seconds=ttl_seconds,
+            max_sessions=max_sessions if max_sessions > 0 else None,
         )
 
-        entries_to_remove = list(
-            filter(
-                lambda key: self.USER_CHATS[key]["last_access"]
-                < time.time() - allowed_age_in_seconds,
-                self.USER_CHATS,
+    def start_sweeper(self, interval_seconds: float = None):
+        """
+        Starts a background thread that removes the expired sessions every interval_seconds,
+        CHAT_SESSION_SWEEP_INTERVAL_SECONDS by default.
+        """
+        if self._sweeper is not None:
+            return
+
+        if interval_seconds is None:
+            interval_seconds = float(
+                os.environ.get(
+                    "CHAT_SESSION_SWEEP_INTERVAL_SECONDS",
+                    DEFAULT_SESSION_SWEEP_INTERVAL_SECONDS,
+                )
             )
+        self._stopped.clear()
+        self._sweeper = threading.Thread(
+            target=self._run_sweeper,
+            args=(interval_seconds,),
+            name="chat-session-sweeper",
+            daemon=True,
         )
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stopped.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+    def sweep(self):
+        """
+        Removes the sessions that expired, and returns their keys.
+        """
+        session_keys = self.store.remove_older_than(time.time() - self.ttl_seconds)
+        self.expired += len(session_keys)
+        if session_keys:
+            HaivenLogger.get().analytics("ChatSessionsExpired", self.stats())
+        return session_keys
+
+    def stats(self) -> dict:
+        return {
+            "live_sessions": self.store.count(),
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
 
-        for key in entries_to_remove:
-            print("CLEANUP: Removing entry", key)
-            del self.USER_CHATS[key]
+    def _run_sweeper(self, interval_seconds: float):
+        while not self._stopped.wait(interval_seconds):
+            try:
+                self.sweep()
+            except Exception as e:
+                HaivenLogger.get().analytics(
+                    "ChatSessionSweepFailed", {"error": str(e)}
+                )
 
     def add_new_entry(self, category: str, user_identifier: str):
-        # Currently the crude rhythm of checking for old entries: whenever a new one gets created
-        self.clear_old_entries()
+        if self.max_sessions is not None:
+            # Makes room for the new session
+            self.evicted += len(
+                self.store.remove_least_recently_used(self.max_sessions - 1)
+            )
 
         session_key = category + "-" + str(uuid.uuid4())
 
         HaivenLogger.get().analytics(
             f"Creating a new chat session for category {category} with key {session_key} for user {user_identifier}"
         )
-        self.USER_CHATS[session_key] = {
-            "created_at": time.time(),
-            "last_access": time.time(),
-            "user": user_identifier,
-            "chat": None,
-        }
+        self.store.put(
+            session_key,
+            {
+                "created_at": time.time(),
+                "last_access": time.time(),
+                "user": user_identifier,
+                "chat": None,
+            },
+        )
         return session_key
 
     def store_chat(self, session_key: str, chat_session: HaivenBaseChat):
-        self.USER_CHATS[session_key]["chat"] = chat_session
+        self._save_chat(session_key, chat_session)
+        if not self.store.keeps_chat_objects:
+            self._save_changes_of_chat(session_key, chat_session)
 
     def get_chat(self, session_key: str):
-        if session_key not in self.USER_CHATS:
+        entry = self.store.get(session_key)
+        if entry is None:
             raise ValueError(
                 f"Invalid identifier {session_key}, your chat session might have expired"
             )
-        self.USER_CHATS[session_key]["last_access"] = time.time()
-        return self.USER_CHATS[session_key]["chat"]
+        self.store.touch(session_key, time.time())
+        if self.store.keeps_chat_objects or entry["chat"] is None:
+            return entry["chat"]
+
+        chat_session = self.chat_loader(entry["chat"])
+        self._save_changes_of_chat(session_key, chat_session)
+        return chat_session
 
     def delete_entry(self, session_key):
-        if session_key in self.USER_CHATS:
+        if self.store.delete(session_key):
             print("Discarding a chat session from memory", session_key)
-            del self.USER_CHATS[session_key]
 
     def get_or_create_chat(
         self,
@@ -413,14 +841,54 @@ class ServerChatSessionMemory:
         return chat_session_key_value, chat_session
 
     def dump_as_text(self, session_key: str, user_owner: str):
-        chat_session_data = self.USER_CHATS.get(session_key, None)
+        chat_session_data = self.store.get(session_key)
         if chat_session_data is None:
             return f"Chat session with ID {session_key} not found"
         if chat_session_data["user"] != user_owner:
             return f"Chat session with ID {session_key} not found for this user"
 
-        chat_session: HaivenBaseChat = chat_session_data["chat"]
-        return chat_session.memory_as_text()
+        if self.store.keeps_chat_objects:
+            chat_session: HaivenBaseChat = chat_session_data["chat"]
+            return chat_session.memory_as_text()
+
+        return "\n".join(
+            str(_MESSAGE_CLASSES[message["type"]](content=message["content"]))
+            for message in chat_session_data["chat"]["messages"]
+        )
+
+    def _save_chat(self, session_key: str, chat_session: HaivenBaseChat):
+        entry = self.store.get(session_key)
+        if entry is None:
+            return
+
+        entry["chat"] = (
+            chat_session if self.store.keeps_chat_objects else chat_session.to_state()
+        )
+        entry["last_access"] = time.time()
+        self.store.put(session_key, entry)
+
+    def _save_changes_of_chat(self, session_key: str, chat_session: HaivenBaseChat):
+        chat_session.add_memory_listener(
+            lambda chat: self._save_chat(session_key, chat)
+        )
+        chat_session.add_background_change_listener(
+            lambda chat, apply_to_state: self._apply_to_saved_chat(
+                session_key, apply_to_state
+            )
+        )
+
+    def _apply_to_saved_chat(self, session_key: str, apply_to_state):
+        # The chat object that made the change in the background can be older than the
+        # saved chat, so the change is applied to the saved state rather than saving the object
+        entry = self.store.get(session_key)
+        if entry is None or entry["chat"] is None:
+            return
+
+        chat_state = apply_to_state(entry["chat"])
+        if chat_state is None:
+            return
+        entry["chat"] = chat_state
+        self.store.put(session_key, entry)
 
 
 class ChatOptions(BaseModel):
@@ -437,11 +905,51 @@ class ChatManager:
         chat_session_memory: ServerChatSessionMemory,
         llm_chat_factory: ChatClientFactory,
         knowledge_manager: KnowledgeManager,
+        history_compactor: ChatHistoryCompactor = None,
+        precompute_search_summaries: bool = False,
     ):
         self.config_service = config_service
         self.chat_session_memory = chat_session_memory
         self.llm_chat_factory = llm_chat_factory
         self.knowledge_manager = knowledge_manager
+        self.history_compactor = history_compactor
+        self.precompute_search_summaries = precompute_search_summaries
+        self.chat_session_memory.chat_loader = self.load_chat
+
+    def load_chat(self, state: dict) -> HaivenBaseChat:
+        """
+        Rehydrates a chat from the state it was saved with, with a new client of the same settings.
+        """
+        client_settings = state["client"]
+        chat_client = self.llm_chat_factory.new_chat_client(
+            ChatClientConfig(
+                client_settings["service_name"], client_settings["temperature"]
+            ),
+            stop=client_settings["stop"],
+        )
+        chat = CHAT_TYPES[state["type"]].from_state(
+            state, chat_client, self.knowledge_manager
+        )
+        self._attach_history_services(chat)
+        return chat
+
+    def _prepare_chat(
+        self, chat: HaivenBaseChat, client_config: ChatClientConfig, stop: str = None
+    ) -> HaivenBaseChat:
+        chat.client_settings = {
+            "service_name": client_config.service_name,
+            "temperature": client_config.temperature,
+            "stop": stop,
+        }
+        self._attach_history_services(chat)
+        return chat
+
+    def _attach_history_services(self, chat: HaivenBaseChat):
+        if self.history_compactor is not None:
+            self.history_compactor.attach(chat)
+        # Only streaming chats search knowledge based on their history
+        if self.precompute_search_summaries and isinstance(chat, StreamingChat):
+            chat.precompute_search_summaries()
 
     def clear_session(self, session_id: str):
         self.chat_session_memory.delete_entry(session_id)
@@ -454,10 +962,13 @@ class ChatManager:
     ):
         chat_client = self.llm_chat_factory.new_chat_client(client_config)
         return self.chat_session_memory.get_or_create_chat(
-            lambda: StreamingChat(
-                chat_client,
-                self.knowledge_manager,
-                stream_in_chunks=options.in_chunks if options else None,
+            lambda: self._prepare_chat(
+                StreamingChat(
+                    chat_client,
+                    self.knowledge_manager,
+                    stream_in_chunks=options.in_chunks if options else None,
+                ),
+                client_config,
             ),
             chat_session_key_value=session_id,
             chat_category=options.category if options else None,
@@ -469,9 +980,12 @@ class ChatManager:
     ):
         chat_client = self.llm_chat_factory.new_chat_client(client_config)
         return self.chat_session_memory.get_or_create_chat(
-            lambda: JSONChat(
-                chat_client,
-                event_stream_standard=False,
+            lambda: self._prepare_chat(
+                JSONChat(
+                    chat_client,
+                    event_stream_standard=False,
+                ),
+                client_config,
             ),
             chat_session_key_value=session_id,
             chat_category=options.category if options else None,
@@ -485,7 +999,9 @@ class ChatManager:
             client_config, stop="</Answer>"
         )
         return self.chat_session_memory.get_or_create_chat(
-            lambda: Q_A_Chat(chat_client),
+            lambda: self._prepare_chat(
+                Q_A_Chat(chat_client), client_config, stop="</Answer>"
+            ),
             chat_session_key_value=session_id,
             chat_category=options.category if options else None,
             # TODO: Pass user identifier from session
@@ -501,11 +1017,14 @@ class ChatManager:
     ):
         chat_client = self.llm_chat_factory.new_chat_client(client_config)
         return self.chat_session_memory.get_or_create_chat(
-            lambda: DocumentsChat(
-                chat_client=chat_client,
-                knowledge_manager=self.knowledge_manager,
-                knowledge=knowledge_key,
-                context=knowledge_context,
+            lambda: self._prepare_chat(
+                DocumentsChat(
+                    chat_client=chat_client,
+                    knowledge_manager=self.knowledge_manager,
+                    knowledge=knowledge_key,
+                    context=knowledge_context,
+                ),
+                client_config,
             ),
             chat_session_key_value=session_id,
             chat_category=options.category if options else None,
@@ -513,6 +1032,39 @@ class ChatManager:
         )
 
 
+def _apply_search_summary(
+    chat_state: dict, search_summary: str, summarised_message, summarised_messages: int
+) -> dict:
+    """
+    Records a search summary in a chat state, or returns None if the state does not have
+    the summarised message at the same position, or has a summary of more messages.
+    """
+    messages = chat_state["messages"]
+    if (
+        len(messages) < summarised_messages
+        or chat_state.get("summarised_messages", 0) >= summarised_messages
+    ):
+        return None
+    last_message = messages[summarised_messages - 1]
+    if (last_message["type"], last_message["content"]) != (
+        summarised_message.type,
+        summarised_message.content,
+    ):
+        return None
+
+    return {
+        **chat_state,
+        "search_summary": search_summary,
+        "summarised_messages": summarised_messages,
+    }
+
+
+CHAT_TYPES = {
+    chat_type.__name__: chat_type
+    for chat_type in [StreamingChat, JSONChat, Q_A_Chat, DocumentsChat]
+}
+
+
 # Temporary class to wrap the StreamingChat for the GradioUI, which needs the chat_history as return value
 # This is not needed for other clients, who might handle chat history display in their interface elsewhere
 class UIStreamingChatWrapper:
@@ -61,6 +61,10 @@ class MockModelClient:
         for chunk in test_data:
             yield MockChunk(content=chunk)
 
+    async def astream(self, messages):
+        for chunk in self.stream(messages):
+            yield chunk
+
 
 class ChatClientFactory:
     def __init__(self, config_service: ConfigService):
@@ -0,0 +1,429 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+SQLITE_URL_PREFIX = "sqlite:///"
+REDIS_URL_PREFIXES = ("redis://", "rediss://", "unix://")
+
+
+class SessionStore(ABC):
+    """
+    Keeps the chat sessions of ServerChatSessionMemory by session key. A session is an
+    entry dictionary with "created_at", "last_access", "user" and "chat".
+
+    Stores that keep the chat objects themselves set keeps_chat_objects, the other stores
+    receive and return the "chat" of an entry as the dictionary of HaivenBaseChat.to_state,
+    so that a session can be continued by any process that shares the store.
+    """
+
+    keeps_chat_objects = False
+
+    @abstractmethod
+    def get(self, session_key: str) -> dict:
+        """
+        Returns the entry of a session, or None if there is no such session.
+        """
+
+    @abstractmethod
+    def put(self, session_key: str, entry: dict):
+        pass
+
+    @abstractmethod
+    def touch(self, session_key: str, last_access: float):
+        """
+        Records the last access of a session, without writing its chat again.
+        """
+
+    @abstractmethod
+    def delete(self, session_key: str) -> bool:
+        """
+        Removes a session, and returns whether it existed.
+        """
+
+    @abstractmethod
+    def remove_older_than(self, last_access: float) -> list:
+        """
+        Removes the sessions that were last accessed before last_access, and returns their keys.
+        """
+
+    @abstractmethod
+    def remove_least_recently_used(self, max_sessions: int) -> list:
+        """
+        Removes the least recently accessed sessions beyond the first max_sessions, and
+        returns their keys.
+        """
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    Keeps the sessions, with their chat objects, in a dictionary of the process, in the
+    order of their last access: expired and least recently used sessions are removed from
+    its start, without looking at the other sessions.
+    """
+
+    keeps_chat_objects = True
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_key: str) -> dict:
+        return self.entries.get(session_key)
+
+    def put(self, session_key: str, entry: dict):
+        with self._lock:
+            self.entries[session_key] = entry
+            self.entries.move_to_end(session_key)
+
+    def touch(self, session_key: str, last_access: float):
+        with self._lock:
+            if session_key in self.entries:
+                self.entries[session_key]["last_access"] = last_access
+                self.entries.move_to_end(session_key)
+
+    def delete(self, session_key: str) -> bool:
+        with self._lock:
+            return self.entries.pop(session_key, None) is not None
+
+    def remove_older_than(self, last_access: float) -> list:
+        session_keys = []
+        with self._lock:
+            while (
+                self.entries
+                and next(iter(self.entries.values()))["last_access"] < last_access
+            ):
+                session_keys.append(self.entries.popitem(last=False)[0])
+        return session_keys
+
+    def remove_least_recently_used(self, max_sessions: int) -> list:
+        session_keys = []
+        with self._lock:
+            while len(self.entries) > max_sessions:
+                session_keys.append(self.entries.popitem(last=False)[0])
+        return session_keys
+
+    def count(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keeps the sessions in a SQLite file, for the workers of a single node. The chat of a
+    session is stored as compressed JSON.
+
+    Attributes:
+        path (str): The SQLite file, created if it does not exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def get(self, session_key: str) -> dict:
+        with self._lock:
+            row = (
+                self._get_connection()
+                .execute(
+                    "SELECT created_at, last_access, user, chat FROM chat_sessions"
+                    " WHERE session_key = ?",
+                    (session_key,),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return None
+
+        created_at, last_access, user, chat = row
+        return {
+            "created_at": created_at,
+            "last_access": last_access,
+            "user": user,
+            "chat": decode_chat_state(chat),
+        }
+
+    def put(self, session_key: str, entry: dict):
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO chat_sessions"
+                " (session_key, created_at, last_access, user, chat) VALUES (?, ?, ?, ?, ?)",
+                (
+                    session_key,
+                    entry["created_at"],
+                    entry["last_access"],
+                    entry["user"],
+                    encode_chat_state(entry["chat"]),
+                ),
+            )
+            connection.commit()
+
+    def touch(self, session_key: str, last_access: float):
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "UPDATE chat_sessions SET last_access = ? WHERE session_key = ?",
+                (last_access, session_key),
+            )
+            connection.commit()
+
+    def delete(self, session_key: str) -> bool:
+        with self._lock:
+            connection = self._get_connection()
+            cursor = connection.execute(
+                "DELETE FROM chat_sessions WHERE session_key = ?", (session_key,)
+            )
+            connection.commit()
+        return cursor.rowcount > 0
+
+    def remove_older_than(self, last_access: float) -> list:
+        with self._lock:
+            connection = self._get_connection()
+            session_keys = [
+                session_key
+                for (session_key,) in connection.execute(
+                    "SELECT session_key FROM chat_sessions WHERE last_access < ?",
+                    (last_access,),
+                )
+            ]
+            connection.execute(
+                "DELETE FROM chat_sessions WHERE last_access < ?", (last_access,)
+            )
+            connection.commit()
+        return session_keys
+
+    def remove_least_recently_used(self, max_sessions: int) -> list:
+        with self._lock:
+            connection = self._get_connection()
+            (count,) = connection.execute(
+                "SELECT COUNT(*) FROM chat_sessions"
+            ).fetchone()
+            if count <= max_sessions:
+                return []
+
+            session_keys = [
+                session_key
+                for (session_key,) in connection.execute(
+                    "SELECT session_key FROM chat_sessions ORDER BY last_access LIMIT ?",
+                    (count - max_sessions,),
+                )
+            ]
+            connection.executemany(
+                "DELETE FROM chat_sessions WHERE session_key = ?",
+                [(session_key,) for session_key in session_keys],
+            )
+            connection.commit()
+        return session_keys
+
+    def count(self) -> int:
+        with self._lock:
+            return (
+                self._get_connection()
+                .execute("SELECT COUNT(*) FROM chat_sessions")
+                .fetchone()[0]
+            )
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(os.path.expanduser(self.path))
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(
+                os.path.expanduser(self.path), check_same_thread=False
+            )
+            # Several workers of the node read and write the file at the same time
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS chat_sessions ("
+                "session_key TEXT PRIMARY KEY, created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL, user TEXT, chat BLOB)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS chat_sessions_last_access"
+                " ON chat_sessions (last_access)"
+            )
+        return self._connection
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Keeps the sessions in Redis, or a server that speaks the Redis protocol, for the
+    workers of several nodes. Each session is one key with the compressed JSON of its
+    entry, which Redis expires ttl_seconds after the last access of the session.
+
+    The session keys are also kept in a sorted set by last access, so that the sessions
+    are counted, and the expired and least recently used ones found, without scanning
+    the keyspace. The sweep removes the keys Redis expired from the sorted set.
+
+    Attributes:
+        client: A client with the get, set, expire, delete, zadd, zrem, zcard, zrange
+            and zrangebyscore commands of redis-py.
+        ttl_seconds (int): The time after which Redis removes a session nobody accessed.
+        key_prefix (str): The prefix of the keys of the sessions.
+        last_access_key (str): The sorted set of the session keys by last access.
+    """
+
+    def __init__(
+        self,
+        client,
+        ttl_seconds: int = None,
+        key_prefix: str = "haiven:chat-session:",
+        last_access_key: str = "haiven:chat-sessions-by-last-access",
+    ):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+        self.last_access_key = last_access_key
+
+    @classmethod
+    def from_url(cls, url: str, ttl_seconds: int = None):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError(
+                "the redis package is needed to keep chat sessions in Redis, install it with 'pip install redis'"
+            )
+
+        return cls(redis.Redis.from_url(url), ttl_seconds)
+
+    def get(self, session_key: str) -> dict:
+        data = self.client.get(self.key_prefix + session_key)
+        if data is None:
+            return None
+
+        entry = json.loads(zlib.decompress(data))
+        entry["chat"] = entry["chat"] and _expand_chat_state(entry["chat"])
+        return entry
+
+    def put(self, session_key: str, entry: dict):
+        self.client.set(
+            self.key_prefix + session_key,
+            zlib.compress(
+                json.dumps(
+                    {
+                        **entry,
+                        "chat": entry["chat"] and _compact_chat_state(entry["chat"]),
+                    },
+                    separators=(",", ":"),
+                ).encode("utf-8")
+            ),
+            ex=self.ttl_seconds,
+        )
+        self.client.zadd(self.last_access_key, {session_key: entry["last_access"]})
+
+    def touch(self, session_key: str, last_access: float):
+        # The expiry of the key is its last access, the entry is not written again
+        if self.ttl_seconds:
+            self.client.expire(self.key_prefix + session_key, self.ttl_seconds)
+        self.client.zadd(self.last_access_key, {session_key: last_access}, xx=True)
+
+    def delete(self, session_key: str) -> bool:
+        self.client.zrem(self.last_access_key, session_key)
+        return self.client.delete(self.key_prefix + session_key) > 0
+
+    def remove_older_than(self, last_access: float) -> list:
+        # Redis may already have expired the keys, this also drops them from the sorted set
+        return self._remove(
+            self.client.zrangebyscore(self.last_access_key, "-inf", f"({last_access}")
+        )
+
+    def remove_least_recently_used(self, max_sessions: int) -> list:
+        count = self.client.zcard(self.last_access_key)
+        if count <= max_sessions:
+            return []
+
+        return self._remove(
+            self.client.zrange(self.last_access_key, 0, count - max_sessions - 1)
+        )
+
+    def count(self) -> int:
+        return self.client.zcard(self.last_access_key)
+
+    def _remove(self, session_keys: list) -> list:
+        session_keys = [
+            session_key.decode("utf-8")
+            if isinstance(session_key, bytes)
+            else session_key
+            for session_key in session_keys
+        ]
+        if session_keys:
+            self.client.delete(
+                *[self.key_prefix + session_key for session_key in session_keys]
+            )
+            self.client.zrem(self.last_access_key, *session_keys)
+        return session_keys
+
+
+def create_session_store(url: str, ttl_seconds: int = None) -> SessionStore:
+    """
+    Creates the session store of a URL: "sqlite:///path/to/sessions.db" for SQLite,
+    "redis://host:port/db" for Redis, or an empty URL to keep the sessions in memory.
+    """
+    if not url or url == "memory":
+        return InMemorySessionStore()
+    if url.startswith(SQLITE_URL_PREFIX):
+        return SQLiteSessionStore(url[len(SQLITE_URL_PREFIX) :])
+    if url.startswith(REDIS_URL_PREFIXES):
+        return RedisSessionStore.from_url(url, ttl_seconds)
+
+    raise ValueError(f"unsupported chat session store URL {url}")
+
+
+def encode_chat_state(chat_state: dict) -> bytes:
+    """
+    Encodes the state of a chat as compressed JSON, with one [role, content] pair per message.
+    """
+    if chat_state is None:
+        return None
+
+    return zlib.compress(
+        json.dumps(_compact_chat_state(chat_state), separators=(",", ":")).encode(
+            "utf-8"
+        )
+    )
+
+
+def decode_chat_state(data: bytes) -> dict:
+    if data is None:
+        return None
+
+    return _expand_chat_state(json.loads(zlib.decompress(data)))
+
+
+_ROLES = {"system": "s", "human": "h", "ai": "a"}
+_MESSAGE_TYPES = {role: message_type for message_type, role in _ROLES.items()}
+
+
+def _compact_chat_state(chat_state: dict) -> dict:
+    return {
+        **chat_state,
+        "messages": [
+            [_ROLES[message["type"]], message["content"]]
+            for message in chat_state["messages"]
+        ],
+    }
+
+
+def _expand_chat_state(chat_state: dict) -> dict:
+    return {
+        **chat_state,
+        "messages": [
+            {"type": _MESSAGE_TYPES[role], "content": content}
+            for role, content in chat_state["messages"]
+        ],
+    }
@@ -84,6 +84,32 @@ class TestApi(unittest.TestCase):
         assert response_data[2]["key"] == mock_doc_2.key
         assert response_data[2]["title"] == mock_doc_2.title
 
+    def test_reload_knowledge(self):
+        mock_knowledge_manager = MagicMock()
+        mock_knowledge_manager.reload.return_value = {
+            "markdown": ["context1"],
+            "documents": {"base": ["some-document"]},
+        }
+
+        ApiBasics(
+            self.app,
+            chat_manager=MagicMock(),
+            model_key="some_model_key",
+            prompts_guided=MagicMock(),
+            knowledge_manager=mock_knowledge_manager,
+            prompts_chat=MagicMock(),
+            image_service=MagicMock(),
+        )
+
+        response = self.client.post("/api/knowledge/reload")
+
+        assert response.status_code == 200
+        mock_knowledge_manager.reload.assert_called_once()
+        assert json.loads(response.content) == {
+            "markdown": ["context1"],
+            "documents": {"base": ["some-document"]},
+        }
+
     @patch("llms.chats.StreamingChat")
     @patch("llms.chats.ChatManager")
     @patch("prompts.prompts.PromptList")
@@ -93,7 +119,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_streaming_chat,
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
         mock_chat_manager.streaming_chat.return_value = (
             "some_key",
             mock_streaming_chat,
@@ -126,6 +154,46 @@ class TestApi(unittest.TestCase):
             warnings=ANY,
         )
 
+    @patch("llms.chats.StreamingChat")
+    @patch("llms.chats.ChatManager")
+    @patch("prompts.prompts.PromptList")
+    def test_prompting_with_document_streams_sources_after_response(
+        self,
+        mock_prompt_list,
+        mock_chat_manager,
+        mock_streaming_chat,
+    ):
+        mock_streaming_chat.arun_with_document.return_value = _async_iterate(
+            [("some response", "some sources"), (" from the model", "some sources")]
+        )
+        mock_chat_manager.streaming_chat.return_value = (
+            "some_key",
+            mock_streaming_chat,
+        )
+        ApiBasics(
+            self.app,
+            chat_manager=mock_chat_manager,
+            model_key="some_model_key",
+            prompts_guided=MagicMock(),
+            knowledge_manager=MagicMock(),
+            prompts_chat=mock_prompt_list,
+            image_service=MagicMock(),
+        )
+
+        response = self.client.post(
+            "/api/prompt",
+            json={"userinput": "some user input", "document": "some-document"},
+        )
+
+        assert response.status_code == 200
+        assert (
+            response.content.decode("utf-8")
+            == "some response from the model\n\nsome sources"
+        )
+        mock_streaming_chat.arun_with_document.assert_called_once_with(
+            "some-document", None, "some user input"
+        )
+
     @patch("llms.chats.JSONChat")
     @patch("llms.chats.ChatManager")
     @patch("prompts.prompts.PromptList")
@@ -135,7 +203,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_json_chat,
     ):
-        mock_json_chat.run.return_value = "some response from the model"
+        mock_json_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
         mock_chat_manager.json_chat.return_value = (
             "some_key",
             mock_json_chat,
@@ -180,7 +250,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_streaming_chat,
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
 
         mock_chat_manager.streaming_chat.return_value = (
             "some_key",
@@ -215,7 +287,9 @@ class TestApi(unittest.TestCase):
     def test_threat_modelling(
         self, mock_prompt_list, mock_chat_manager, mock_json_chat
     ):
-        mock_json_chat.run.return_value = "some response from the model"
+        mock_json_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
         mock_chat_manager.json_chat.return_value = (
             "some_key",
             mock_json_chat,
@@ -255,7 +329,9 @@ class TestApi(unittest.TestCase):
     def test_threat_modelling_explore(
         self, mock_prompt_list, mock_chat_manager, mock_streaming_chat
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
 
         mock_chat_manager.streaming_chat.return_value = (
             "some_key",
@@ -295,7 +371,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_json_chat,
     ):
-        mock_json_chat.run.return_value = "some response from the model"
+        mock_json_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
         mock_chat_manager.json_chat.return_value = (
             "some_key",
             mock_json_chat,
@@ -330,7 +408,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_streaming_chat,
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
 
         mock_chat_manager.streaming_chat.return_value = (
             "some_key",
@@ -370,7 +450,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_json_chat,
     ):
-        mock_json_chat.run.return_value = "some response from the model"
+        mock_json_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
         mock_chat_manager.json_chat.return_value = (
             "some_key",
             mock_json_chat,
@@ -411,7 +493,9 @@ class TestApi(unittest.TestCase):
         mock_prompt_list,
         mock_chat_manager,
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
         mock_chat_manager.streaming_chat.return_value = (
             "some_session_key",
             mock_streaming_chat,
@@ -437,8 +521,8 @@ class TestApi(unittest.TestCase):
         streamed_content = response.content.decode("utf-8")
         assert streamed_content == "some response from the model"
 
-        assert mock_streaming_chat.run.call_count == 1
-        args, kwargs = mock_streaming_chat.run.call_args
+        assert mock_streaming_chat.arun.call_count == 1
+        args, kwargs = mock_streaming_chat.arun.call_args
         prompt_argument = args[0]
         assert "some question 1" in prompt_argument
 
@@ -455,7 +539,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_json_chat,
     ):
-        mock_json_chat.run.return_value = "some response from the model"
+        mock_json_chat.arun.return_value = _async_iterate(
+            ["some response from the model"]
+        )
         mock_chat_manager.json_chat.return_value = (
             "some_key",
             mock_json_chat,
@@ -492,3 +578,8 @@ class TestApi(unittest.TestCase):
             },
             warnings=ANY,
         )
+
+
+async def _async_iterate(items):
+    for item in items:
+        yield item
@@ -0,0 +1,69 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import os
+
+from benchmark.knowledge_retrieval import (
+    create_synthetic_knowledge_pack,
+    main,
+    measure_latencies,
+)
+
+
+class TestKnowledgeRetrievalBenchmark:
+    def test_synthetic_knowledge_pack_is_deterministic(self, tmp_path):
+        for folder in ["first", "second"]:
+            create_synthetic_knowledge_pack(
+                os.path.join(tmp_path, folder), documents=2, chunks=5, dimension=8
+            )
+
+        first_kb_path = os.path.join(
+            tmp_path, "first/embeddings/benchmark-document-1.kb"
+        )
+        second_kb_path = os.path.join(
+            tmp_path, "second/embeddings/benchmark-document-1.kb"
+        )
+        for filename in ["index.faiss", "docstore_text.bin", "docstore_offsets.npy"]:
+            with open(os.path.join(first_kb_path, filename), "rb") as first:
+                with open(os.path.join(second_kb_path, filename), "rb") as second:
+                    assert first.read() == second.read()
+
+    def test_measure_latencies_skips_warmup_calls(self):
+        calls = []
+
+        latencies = measure_latencies(calls.append, iterations=4, warmup=2)
+
+        assert calls == [0, 1, 2, 3, 4, 5]
+        assert latencies["iterations"] == 4
+        assert latencies["min_ms"] <= latencies["p50_ms"] <= latencies["p99_ms"]
+
+    def test_main_writes_report(self, tmp_path):
+        output_path = os.path.join(tmp_path, "report.json")
+
+        main(
+            [
+                "--documents",
+                "3",
+                "--chunks",
+                "10",
+                "--dimension",
+                "8",
+                "--queries",
+                "3",
+                "--chat-runs",
+                "2",
+                "--output",
+                output_path,
+            ]
+        )
+
+        with open(output_path) as f:
+            report = json.load(f)
+        assert report["parameters"]["documents"] == 3
+        assert report["load"]["seconds"] > 0
+        for name in [
+            "similarity_search",
+            "similarity_search_on_single_document",
+            "documents_chat_run",
+        ]:
+            assert report[name]["iterations"] > 0
+            assert report[name]["p99_ms"] >= report[name]["p50_ms"]
@@ -0,0 +1,268 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+from llms.chat_history import ChatHistoryCompactor
+from llms.chats import (
+    CHAT_TYPES,
+    ChatManager,
+    ChatOptions,
+    JSONChat,
+    ServerChatSessionMemory,
+    StreamingChat,
+)
+from llms.clients import ChatClientConfig
+from llms.session_stores import SQLiteSessionStore
+
+
+class DeferredExecutor:
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        self.calls.append((fn, args))
+
+    def run_next(self):
+        fn, args = self.calls.pop(0)
+        fn(*args)
+
+
+class WordCounter:
+    def count_batch(self, texts):
+        return [len(text.split()) for text in texts]
+
+
+class ImmediateExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+def _chat(chat_client, turns):
+    chat = StreamingChat(chat_client, None, system_message="Be helpful")
+    for question, answer in turns:
+        chat.memory.append(HumanMessage(content=question))
+        chat.memory.append(AIMessage(content=answer))
+    return chat
+
+
+def _compactor(budget, executor=None):
+    return ChatHistoryCompactor(
+        {"StreamingChat": budget},
+        token_counter=WordCounter(),
+        executor=executor or ImmediateExecutor(),
+    )
+
+
+class TestChatHistoryCompactor:
+    def test_memory_within_budget_is_kept(self):
+        chat_client = MagicMock()
+        chat = _chat(chat_client, [("one two", "three four")])
+        _compactor(10).attach(chat)
+
+        chat._memory_changed()
+
+        assert len(chat.memory) == 3
+        chat_client.invoke.assert_not_called()
+
+    def test_chats_that_do_not_replay_their_memory_are_not_compacted(self):
+        chat_client = MagicMock()
+        chat = JSONChat(chat_client, system_message="Be helpful")
+        for question, answer in [("one two three", "four five six")] * 3:
+            chat.memory.append(HumanMessage(content=question))
+            chat.memory.append(AIMessage(content=answer))
+        ChatHistoryCompactor(
+            {"JSONChat": 8},
+            token_counter=WordCounter(),
+            executor=ImmediateExecutor(),
+        ).attach(chat)
+
+        chat._memory_changed()
+
+        assert len(chat.memory) == 7
+        chat_client.invoke.assert_not_called()
+
+    def test_older_turns_are_replaced_by_a_summary_in_the_system_message(self):
+        chat_client = MagicMock()
+        chat_client.invoke.return_value = AIMessage(content="We talked about numbers")
+        chat = _chat(
+            chat_client,
+            [
+                ("first question here", "first answer here"),
+                ("second question here", "second answer here"),
+                ("third question", "third answer"),
+            ],
+        )
+        _compactor(12).attach(chat)
+        saved_state = chat.to_state()
+        changed_states = []
+        chat.add_background_change_listener(
+            lambda chat, apply_to_state: changed_states.append(
+                apply_to_state(saved_state)
+            )
+        )
+
+        chat._memory_changed()
+
+        assert chat.memory == [
+            SystemMessage(
+                content="Be helpful\n\nSummary of the earlier conversation:\nWe talked about numbers"
+            ),
+            HumanMessage(content="third question"),
+            AIMessage(content="third answer"),
+        ]
+        summary_request = chat_client.invoke.call_args.args[0][0].content
+        assert "There is no summary yet." in summary_request
+        assert "human: first question here" in summary_request
+        assert "ai: second answer here" in summary_request
+        assert "third question" not in summary_request
+        assert changed_states == [chat.to_state()]
+
+    def test_summary_is_updated_with_the_turns_that_followed_it(self):
+        chat_client = MagicMock()
+        chat_client.invoke.return_value = AIMessage(content="An updated summary")
+        chat = _chat(chat_client, [])
+        chat.memory = [
+            SystemMessage(
+                content="Be helpful\n\nSummary of the earlier conversation:\nA summary"
+            ),
+            HumanMessage(content="a long question to summarise"),
+            AIMessage(content="a long answer to summarise"),
+            HumanMessage(content="last question"),
+            AIMessage(content="last answer"),
+        ]
+        _compactor(14).attach(chat)
+
+        chat._memory_changed()
+
+        summary_request = chat_client.invoke.call_args.args[0][0].content
+        assert "A summary" in summary_request
+        assert "Summary of the earlier conversation" not in summary_request
+        assert chat.memory[0].content.endswith("\nAn updated summary")
+        assert len(chat.memory) == 3
+
+    def test_last_turn_is_kept_even_if_it_is_over_budget(self):
+        chat_client = MagicMock()
+        chat_client.invoke.return_value = AIMessage(content="A summary")
+        chat = _chat(
+            chat_client,
+            [("a question", "an answer"), ("a very long last question", "x " * 20)],
+        )
+        _compactor(10).attach(chat)
+
+        chat._memory_changed()
+
+        assert [message.content for message in chat.memory[1:]] == [
+            "a very long last question",
+            "x " * 20,
+        ]
+
+    def test_summary_is_dropped_if_the_memory_was_replaced(self):
+        chat = _chat(MagicMock(), [("one two three", "four five six")] * 2)
+
+        def replace_memory(messages):
+            chat.memory = [SystemMessage(content="Be helpful")]
+            return AIMessage(content="A summary")
+
+        chat.chat_client.invoke.side_effect = replace_memory
+        _compactor(8).attach(chat)
+
+        chat._memory_changed()
+
+        assert chat.memory == [SystemMessage(content="Be helpful")]
+
+    @patch("logger.HaivenLogger.get")
+    def test_failed_compaction_keeps_the_memory_and_can_be_retried(self, mock_logger):
+        chat_client = MagicMock()
+        chat_client.invoke.side_effect = [
+            Exception("rate limited"),
+            AIMessage(content="A summary"),
+        ]
+        chat = _chat(chat_client, [("one two three", "four five six")] * 2)
+        _compactor(8).attach(chat)
+
+        chat._memory_changed()
+        assert len(chat.memory) == 5
+        mock_logger.return_value.analytics.assert_called_once()
+
+        chat._memory_changed()
+        assert len(chat.memory) == 3
+
+    @patch("logger.HaivenLogger.get")
+    def test_compaction_runs_in_the_background_after_the_response(self, mock_logger):
+        chat_client = MagicMock()
+        chat_client.stream.return_value = [AIMessage(content="a long answer")]
+        chat_client.invoke.return_value = AIMessage(content="A summary")
+        chat = _chat(chat_client, [("one two three", "four five six")])
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            _compactor(8, executor).attach(chat)
+
+            chunks = list(chat.run("a new question"))
+
+        assert chunks == ["a long answer"]
+        assert [message.content for message in chat.memory[1:]] == [
+            "a new question",
+            "a long answer",
+        ]
+        assert chat.memory[0].content.endswith("A summary")
+
+    @patch("logger.HaivenLogger.get")
+    def test_compaction_is_applied_to_the_saved_chat_that_continued_meanwhile(
+        self, mock_logger, tmp_path
+    ):
+        chat_client = MagicMock()
+        chat_client.stream.side_effect = lambda messages: [
+            AIMessage(content="an answer")
+        ]
+        chat_client.invoke.return_value = AIMessage(content="A summary")
+        llm_chat_factory = MagicMock()
+        llm_chat_factory.new_chat_client.return_value = chat_client
+        executor = DeferredExecutor()
+        compactor = _compactor(12, executor)
+        path = os.path.join(tmp_path, "chats.db")
+
+        def worker():
+            return ChatManager(
+                MagicMock(),
+                ServerChatSessionMemory(SQLiteSessionStore(path)),
+                llm_chat_factory,
+                MagicMock(),
+                compactor,
+            )
+
+        first_worker, second_worker = worker(), worker()
+        session_key, chat = first_worker.streaming_chat(
+            ChatClientConfig("a-model", 0), options=ChatOptions(category="a-category")
+        )
+        list(chat.run("first question here"))
+        list(chat.run("second question here"))
+        # The third turn is served by another worker while the compaction is pending
+        list(second_worker.get_session(session_key).run("third question here"))
+
+        executor.run_next()
+        # The compaction started by the other worker no longer matches the saved chat
+        executor.run_next()
+
+        assert [
+            message.content for message in worker().get_session(session_key).memory
+        ] == [
+            "You are a helpful assistant\n\nSummary of the earlier conversation:\nA summary",
+            "second question here",
+            "an answer",
+            "third question here",
+            "an answer",
+        ]
+
+    def test_from_env_reads_the_budget_of_each_chat_type(self):
+        with patch.dict(
+            os.environ,
+            {
+                "CHAT_HISTORY_MAX_TOKENS": "4000",
+                "CHAT_HISTORY_MAX_TOKENS_Q_A_CHAT": "0",
+            },
+        ):
+            compactor = ChatHistoryCompactor.from_env(CHAT_TYPES)
+
+        assert compactor.default_budget == 4000
+        assert compactor.budgets == {"Q_A_Chat": 0}
@@ -1,10 +1,25 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import os
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 from langchain.docstore.document import Document
-from llms.chats import DocumentsChat, ServerChatSessionMemory, StreamingChat
-from unittest.mock import MagicMock, patch
+from llms.chats import (
+    ChatManager,
+    ChatOptions,
+    DocumentsChat,
+    JSONChat,
+    Q_A_Chat,
+    ServerChatSessionMemory,
+    StreamingChat,
+)
+from llms.clients import ChatClientConfig
+from llms.session_stores import SQLiteSessionStore
+from unittest.mock import AsyncMock, MagicMock, patch
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 
 
@@ -87,6 +102,107 @@ class TestChats(unittest.TestCase):
         assert isinstance(streaming_chat.memory[1], HumanMessage)
         assert isinstance(streaming_chat.memory[2], AIMessage)
 
+    @patch("knowledge_manager.KnowledgeManager")
+    @patch("logger.HaivenLogger.get")
+    def test_streaming_chat_arun_streams_with_astream(
+        self, mock_logger, mock_knowledge_manager
+    ):
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.return_value = _async_iterate(
+            [MagicMock(content="Pa"), MagicMock(content="ris")]
+        )
+        streaming_chat = StreamingChat(
+            chat_client=mock_chat_client, knowledge_manager=mock_knowledge_manager
+        )
+
+        chunks = asyncio.run(
+            _collect(streaming_chat.arun("What is the capital of France?"))
+        )
+
+        assert chunks == ["Pa", "ris"]
+        mock_chat_client.stream.assert_not_called()
+        assert len(streaming_chat.memory) == 3
+        assert isinstance(streaming_chat.memory[1], HumanMessage)
+        assert streaming_chat.memory[2] == AIMessage(content="Paris")
+
+    @patch("logger.HaivenLogger.get")
+    def test_arun_calls_memory_listeners_outside_of_the_event_loop(self, mock_logger):
+        chat_client = MagicMock()
+        chat_client.astream.side_effect = lambda messages: _async_iterate(
+            [AIMessage(content="Hi")]
+        )
+        listener_threads = []
+        for chat in [StreamingChat(chat_client, None), JSONChat(chat_client)]:
+            chat.add_memory_listener(
+                lambda chat: listener_threads.append(threading.current_thread())
+            )
+
+            asyncio.run(_collect(chat.arun("Hello")))
+
+        assert len(listener_threads) == 2
+        assert threading.main_thread() not in listener_threads
+
+    @patch("logger.HaivenLogger.get")
+    def test_streaming_chat_arun_with_document_summarises_with_ainvoke(
+        self, mock_logger
+    ):
+        mock_chat_client = MagicMock()
+        mock_chat_client.ainvoke = AsyncMock(
+            return_value=AIMessage(content="a summary")
+        )
+        mock_chat_client.astream.return_value = _async_iterate(
+            [MagicMock(content="Advice")]
+        )
+        mock_knowledge_manager = MagicMock()
+        mock_knowledge_manager.knowledge_base_documents.similarity_search.return_value = [
+            Document(
+                page_content="Some doc content",
+                metadata={"source": "http://somewebsite.com", "title": "Some Website"},
+            )
+        ]
+        streaming_chat = StreamingChat(
+            chat_client=mock_chat_client, knowledge_manager=mock_knowledge_manager
+        )
+        streaming_chat.memory.extend(
+            [HumanMessage(content="Hello"), AIMessage(content="Hi")]
+        )
+
+        chunks = asyncio.run(
+            _collect(streaming_chat.arun_with_document("all", "context", "A question"))
+        )
+
+        assert [chunk for chunk, _ in chunks] == ["Advice"]
+        assert "Some Website" in chunks[0][1]
+        mock_chat_client.ainvoke.assert_called_once()
+        mock_chat_client.assert_not_called()
+        query, context = (
+            mock_knowledge_manager.knowledge_base_documents.similarity_search.call_args.args
+        )
+        assert "a summary" in query
+        assert "A question" in query
+        assert context == "context"
+        assert "Some doc content" in streaming_chat.memory[-2].content
+
+    def test_json_chat_arun_yields_the_same_events_as_run(self):
+        chunks = ["[ {", '"title": "A title"', " } ]"]
+        sync_chat_client = MagicMock()
+        sync_chat_client.stream.return_value = iter(
+            [MagicMock(content=chunk) for chunk in chunks]
+        )
+        async_chat_client = MagicMock()
+        async_chat_client.astream.return_value = _async_iterate(
+            [MagicMock(content=chunk) for chunk in chunks]
+        )
+        sync_chat = JSONChat(sync_chat_client)
+        async_chat = JSONChat(async_chat_client)
+
+        events = list(sync_chat.run("a prompt"))
+        async_events = asyncio.run(_collect(async_chat.arun("a prompt")))
+
+        assert async_events == events
+        assert events[-1] == "data: [DONE]\n\n"
+        assert async_chat.memory[-1].content == "".join(chunks)
+
     def test_dump_as_text(self):
         # Arrange
         category = "category"
@@ -124,3 +240,271 @@ class TestChats(unittest.TestCase):
 
         # Assert
         assert "not found for this user" in result
+
+    @patch("logger.HaivenLogger.get")
+    def test_chat_is_rehydrated_from_a_shared_store_by_another_worker(
+        self, mock_logger
+    ):
+        path = os.path.join(self._temporary_directory(), "chats.db")
+        chat_client = MagicMock()
+        chat_client.stream.return_value = [AIMessage(content="Hi")]
+        llm_chat_factory = MagicMock()
+        llm_chat_factory.new_chat_client.return_value = chat_client
+        first_worker = ChatManager(
+            MagicMock(),
+            ServerChatSessionMemory(SQLiteSessionStore(path)),
+            llm_chat_factory,
+            MagicMock(),
+        )
+        second_worker = ChatManager(
+            MagicMock(),
+            ServerChatSessionMemory(SQLiteSessionStore(path)),
+            llm_chat_factory,
+            MagicMock(),
+        )
+
+        session_key, chat = first_worker.streaming_chat(
+            ChatClientConfig("a-model", 0.3),
+            options=ChatOptions(category="a-category", in_chunks=True),
+        )
+        list(chat.run("Hello"))
+
+        rehydrated_chat = second_worker.get_session(session_key)
+        list(rehydrated_chat.run("And now?"))
+        chat_after_second_turn = first_worker.get_session(session_key)
+
+        assert isinstance(rehydrated_chat, StreamingChat)
+        assert rehydrated_chat.stream_in_chunks is True
+        assert rehydrated_chat.chat_client is chat_client
+        config = llm_chat_factory.new_chat_client.call_args.args[0]
+        assert (config.service_name, config.temperature) == ("a-model", 0.3)
+        assert [
+            (message.type, message.content) for message in chat_after_second_turn.memory
+        ] == [
+            ("system", "You are a helpful assistant"),
+            ("human", "Hello"),
+            ("ai", "Hi"),
+            ("human", "And now?"),
+            ("ai", "Hi"),
+        ]
+        assert "content='And now?'" in second_worker.chat_session_memory.dump_as_text(
+            session_key, None
+        )
+
+    @patch("llms.chats.DocumentsChat._create_chain")
+    def test_chat_state_keeps_the_options_of_each_chat_type(self, mock_create_chain):
+        knowledge_manager = MagicMock()
+        chats = [
+            JSONChat(MagicMock(), event_stream_standard=False),
+            Q_A_Chat(MagicMock(), system_message="Ask me questions"),
+            DocumentsChat(MagicMock(), knowledge_manager, "a-document", "a-context"),
+        ]
+
+        for chat in chats:
+            chat.client_settings = {
+                "service_name": "a-model",
+                "temperature": 0.5,
+                "stop": "</Answer>",
+            }
+            chat.memory.append(HumanMessage(content="A question"))
+            chat_client = MagicMock()
+
+            rehydrated_chat = type(chat).from_state(
+                chat.to_state(), chat_client, knowledge_manager
+            )
+
+            assert rehydrated_chat._options() == chat._options()
+            assert rehydrated_chat.client_settings == chat.client_settings
+            assert rehydrated_chat.memory == chat.memory
+            assert rehydrated_chat.chat_client is chat_client
+
+    @patch("logger.HaivenLogger.get")
+    def test_sweep_removes_sessions_that_expired(self, mock_logger):
+        session_memory = ServerChatSessionMemory(ttl_seconds=60)
+        with patch("llms.chats.time.time", return_value=1000.0):
+            old_session_key = session_memory.add_new_entry("category", "a-user")
+        with patch("llms.chats.time.time", return_value=1050.0):
+            session_key = session_memory.add_new_entry("category", "a-user")
+
+        with patch("llms.chats.time.time", return_value=1070.0):
+            assert session_memory.sweep() == [old_session_key]
+
+        session_memory.get_chat(session_key)
+        with self.assertRaises(ValueError):
+            session_memory.get_chat(old_session_key)
+        assert session_memory.stats() == {
+            "live_sessions": 1,
+            "expired": 1,
+            "evicted": 0,
+        }
+
+    @patch("logger.HaivenLogger.get")
+    def test_least_recently_used_session_is_evicted_beyond_max_sessions(
+        self, mock_logger
+    ):
+        session_memory = ServerChatSessionMemory(max_sessions=2)
+        first_session_key = session_memory.add_new_entry("category", "a-user")
+        second_session_key = session_memory.add_new_entry("category", "a-user")
+        session_memory.get_chat(first_session_key)
+
+        third_session_key = session_memory.add_new_entry("category", "a-user")
+
+        assert list(session_memory.store.entries) == [
+            first_session_key,
+            third_session_key,
+        ]
+        assert session_memory.stats()["evicted"] == 1
+        with self.assertRaises(ValueError):
+            session_memory.get_chat(second_session_key)
+
+    @patch("logger.HaivenLogger.get")
+    def test_sweeper_removes_expired_sessions_in_the_background(self, mock_logger):
+        session_memory = ServerChatSessionMemory(ttl_seconds=0)
+        session_memory.add_new_entry("category", "a-user")
+
+        session_memory.start_sweeper(interval_seconds=0.01)
+        self.addCleanup(session_memory.stop_sweeper)
+        for _ in range(100):
+            if session_memory.stats()["live_sessions"] == 0:
+                break
+            time.sleep(0.01)
+
+        assert session_memory.stats()["live_sessions"] == 0
+        assert session_memory.expired == 1
+
+    @patch("logger.HaivenLogger.get")
+    def test_search_summary_is_updated_with_the_new_messages_only(self, mock_logger):
+        chat_client = MagicMock()
+        chat_client.side_effect = [
+            AIMessage(content="a summary"),
+            AIMessage(content="an updated summary"),
+        ]
+        chat_client.stream.return_value = [AIMessage(content="Some advice")]
+        knowledge_manager = MagicMock()
+        knowledge_manager.knowledge_base_documents.similarity_search.return_value = []
+        streaming_chat = StreamingChat(chat_client, knowledge_manager)
+        streaming_chat.memory.extend(
+            [HumanMessage(content="Hello"), AIMessage(content="Hi")]
+        )
+
+        list(streaming_chat.run_with_document("all", "context", "A question"))
+        list(streaming_chat.run_with_document("all", "context", "Another question"))
+
+        assert streaming_chat.search_summary == "an updated summary"
+        assert chat_client.call_count == 2
+        first_request = chat_client.call_args_list[0].args[0]
+        assert first_request[:3] == [
+            SystemMessage(content="You are a helpful assistant"),
+            HumanMessage(content="Hello"),
+            AIMessage(content="Hi"),
+        ]
+        (update_request,) = chat_client.call_args_list[1].args[0]
+        assert "a summary" in update_request.content
+        assert "A question" in update_request.content
+        assert "ai: Some advice" in update_request.content
+        assert "Hello" not in update_request.content
+        query, _ = (
+            knowledge_manager.knowledge_base_documents.similarity_search.call_args.args
+        )
+        assert "an updated summary" in query
+
+    @patch("logger.HaivenLogger.get")
+    def test_search_summary_is_precomputed_after_each_response(self, mock_logger):
+        chat_client = MagicMock()
+        chat_client.return_value = AIMessage(content="a precomputed summary")
+        chat_client.ainvoke = AsyncMock()
+        chat_client.stream.return_value = [AIMessage(content="Hi")]
+        chat_client.astream.return_value = _async_iterate([AIMessage(content="Advice")])
+        knowledge_manager = MagicMock()
+        knowledge_manager.knowledge_base_documents.similarity_search.return_value = []
+        streaming_chat = StreamingChat(chat_client, knowledge_manager)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            streaming_chat.precompute_search_summaries(executor)
+
+            list(streaming_chat.run("Hello"))
+            chunks = asyncio.run(
+                _collect(
+                    streaming_chat.arun_with_document("all", "context", "A question")
+                )
+            )
+
+        assert [chunk for chunk, _ in chunks] == ["Advice"]
+        chat_client.ainvoke.assert_not_called()
+        # Once after each response
+        assert chat_client.call_count == 2
+        query, _ = (
+            knowledge_manager.knowledge_base_documents.similarity_search.call_args.args
+        )
+        assert "a precomputed summary" in query
+
+    @patch("logger.HaivenLogger.get")
+    def test_precomputed_search_summary_is_saved_to_a_shared_store(self, mock_logger):
+        path = os.path.join(self._temporary_directory(), "chats.db")
+        chat_client = MagicMock()
+        chat_client.return_value = AIMessage(content="a precomputed summary")
+        chat_client.stream.side_effect = lambda messages: [AIMessage(content="Hi")]
+        llm_chat_factory = MagicMock()
+        llm_chat_factory.new_chat_client.return_value = chat_client
+        precomputes = []
+        executor = MagicMock()
+        executor.submit.side_effect = lambda fn: precomputes.append(fn)
+
+        def worker():
+            return ChatManager(
+                MagicMock(),
+                ServerChatSessionMemory(SQLiteSessionStore(path)),
+                llm_chat_factory,
+                MagicMock(),
+                precompute_search_summaries=True,
+            )
+
+        with patch("llms.chats._summary_executor", executor):
+            session_key, chat = worker().streaming_chat(
+                ChatClientConfig("a-model", 0), options=ChatOptions(category="a")
+            )
+            list(chat.run("Hello"))
+            # Another worker continues the chat before the summary is ready
+            list(worker().get_session(session_key).run("And now?"))
+            precomputes[0]()
+
+        rehydrated_chat = worker().get_session(session_key)
+
+        assert rehydrated_chat.search_summary == "a precomputed summary"
+        assert rehydrated_chat._messages_to_summarise() == [
+            HumanMessage(content="And now?"),
+            AIMessage(content="Hi"),
+        ]
+        chat_client.assert_called_once()
+
+    def test_search_summary_is_kept_on_rehydration(self):
+        chat_client = MagicMock()
+        chat_client.return_value = AIMessage(content="a summary")
+        streaming_chat = StreamingChat(chat_client, None)
+        streaming_chat.memory.extend(
+            [HumanMessage(content="Hello"), AIMessage(content="Hi")]
+        )
+        streaming_chat._summarise_conversation()
+        streaming_chat.memory.append(HumanMessage(content="A new message"))
+
+        rehydrated_chat = StreamingChat.from_state(
+            streaming_chat.to_state(), chat_client, None
+        )
+
+        assert rehydrated_chat.search_summary == "a summary"
+        assert rehydrated_chat._messages_to_summarise() == [
+            HumanMessage(content="A new message")
+        ]
+
+    def _temporary_directory(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        return temporary_directory.name
+
+
+async def _async_iterate(items):
+    for item in items:
+        yield item
+
+
+async def _collect(async_iterator):
+    return [item async for item in async_iterator]
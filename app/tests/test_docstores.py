@@ -0,0 +1,105 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import os
+
+import pytest
+
+from langchain.docstore.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+import numpy as np
+
+from embeddings.docstores import (
+    MAPPED_DOCSTORE_METADATA_FILE,
+    MAPPED_DOCSTORE_METADATA_LOG_FILE,
+    MAPPED_DOCSTORE_OFFSETS_FILE,
+    MappedDocstore,
+    MergedDocstore,
+    PositionalIds,
+    has_mapped_docstore,
+    save_mapped_docstore,
+)
+
+
+class TestDocstores:
+    def test_mapped_docstore_returns_documents_by_position(self, tmp_path):
+        documents = [
+            Document(page_content="first chunk", metadata={"page": 1, "title": "T"}),
+            Document(
+                page_content="zweiter Abschnitt ä", metadata={"page": 1, "title": "T"}
+            ),
+            Document(page_content="", metadata={"page": 2, "title": "T"}),
+        ]
+        assert not has_mapped_docstore(tmp_path)
+
+        save_mapped_docstore(tmp_path, documents)
+
+        assert has_mapped_docstore(tmp_path)
+        docstore = MappedDocstore(tmp_path)
+        assert len(docstore) == 3
+        for position, document in enumerate(documents):
+            assert docstore.search(str(position)) == document
+        assert docstore.search("3") == "ID 3 not found."
+
+    def test_save_mapped_docstore_interns_metadata(self, tmp_path):
+        documents = [
+            Document(page_content=f"chunk {i}", metadata={"source": "a.pdf", "page": 1})
+            for i in range(10)
+        ]
+
+        save_mapped_docstore(tmp_path, documents)
+
+        with open(os.path.join(tmp_path, MAPPED_DOCSTORE_METADATA_FILE)) as f:
+            assert json.load(f)["metadata"] == [{"page": 1, "source": "a.pdf"}]
+
+    def test_mapped_docstore_reads_metadata_appended_to_the_log(self, tmp_path):
+        save_mapped_docstore(
+            tmp_path, [Document(page_content="ab", metadata={"page": 1})]
+        )
+        # A second chunk with new metadata, appended like the CLI does while indexing
+        with open(os.path.join(tmp_path, "docstore_text.bin"), "ab") as f:
+            f.write(b"cd")
+        np.save(
+            os.path.join(tmp_path, MAPPED_DOCSTORE_OFFSETS_FILE),
+            np.array([[0, 2, 0], [2, 4, 1]], dtype=np.int64),
+        )
+        with open(os.path.join(tmp_path, MAPPED_DOCSTORE_METADATA_LOG_FILE), "w") as f:
+            f.write('{"page": 2}\n{"page"')
+
+        docstore = MappedDocstore(tmp_path)
+
+        assert docstore.search("1") == Document(page_content="cd", metadata={"page": 2})
+
+    def test_positional_ids(self):
+        ids = PositionalIds(2)
+
+        assert ids[1] == "1"
+        assert list(ids.values()) == ["0", "1"]
+        assert 2 not in ids
+
+    def test_merged_docstore_resolves_documents_from_source_stores(self):
+        embeddings = DeterministicFakeEmbedding(size=4)
+        store_a = FAISS.from_texts(["a1", "a2"], embeddings)
+        store_b = FAISS.from_texts(["b1"], embeddings, metadatas=[{"page": 3}])
+        docstore = MergedDocstore()
+        docstore.add_store("doc-a", store_a)
+        docstore.add_store("doc-b", store_b)
+
+        assert len(docstore) == 3
+        assert docstore.search("1") == Document(
+            page_content="a2", metadata={"document_key": "doc-a"}
+        )
+        assert docstore.search("2") == Document(
+            page_content="b1", metadata={"page": 3, "document_key": "doc-b"}
+        )
+        assert docstore.search("3") == "ID 3 not found."
+
+    def test_mapped_docstore_rejects_unknown_version(self, tmp_path):
+        save_mapped_docstore(tmp_path, [Document(page_content="chunk")])
+        with open(os.path.join(tmp_path, MAPPED_DOCSTORE_METADATA_FILE), "w") as f:
+            json.dump({"version": 99, "metadata": [{}]}, f)
+
+        with pytest.raises(ValueError) as e:
+            MappedDocstore(tmp_path)
+        assert "Unsupported docstore version 99" in str(e.value)
@@ -1,9 +1,19 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+import shutil
 from unittest import mock
 
+import faiss
 import pytest
+from langchain.docstore.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from embeddings.cache import EmbeddingsCache
 from embeddings.client import EmbeddingsClient
+from embeddings.docstores import MappedDocstore, save_mapped_docstore
 from embeddings.model import EmbeddingModel
+from embeddings.tokens import TokenCounter
+from tests.utils import get_test_data_path
 
 
 class TestEmbeddings:
@@ -167,7 +177,7 @@ class TestEmbeddings:
 
     @mock.patch("embeddings.client.FAISS.load_local")
     @mock.patch("embeddings.client.FAISS.from_documents")
-    @mock.patch("embeddings.client.RecursiveCharacterTextSplitter")
+    @mock.patch("embeddings.client.TokenBoundaryTextSplitter")
     @mock.patch("embeddings.client.OpenAIEmbeddings")
     def test_generate_openai_provider_embeddings(
         self,
@@ -203,8 +213,8 @@ class TestEmbeddings:
         text_splitter_mock.assert_called_with(
             chunk_size=500,
             chunk_overlap=80,
-            length_function=embeddings._tiktoken_len,
             separators=["\n\n", "\n", " ", ""],
+            tokenizer=TokenCounter.get("cl100k_base"),
         )
         openai_embeddings_mock.assert_called_with(
             model=openai_model, api_key=openai_api_key
@@ -222,7 +232,7 @@ class TestEmbeddings:
         )
 
     @mock.patch("embeddings.client.FAISS.from_documents")
-    @mock.patch("embeddings.client.RecursiveCharacterTextSplitter")
+    @mock.patch("embeddings.client.TokenBoundaryTextSplitter")
     @mock.patch("embeddings.client.AzureOpenAIEmbeddings")
     def test_generate_azure_provider_embeddings(
         self, azure_openai_embeddings_mock, text_splitter_mock, from_documents_mock
@@ -261,8 +271,8 @@ class TestEmbeddings:
         text_splitter_mock.assert_called_with(
             chunk_size=500,
             chunk_overlap=80,
-            length_function=embeddings._tiktoken_len,
             separators=["\n\n", "\n", " ", ""],
+            tokenizer=TokenCounter.get("cl100k_base"),
         )
         azure_openai_embeddings_mock.assert_called_with(
             api_key=azure_openai_api_key,
@@ -276,7 +286,7 @@ class TestEmbeddings:
 
     @mock.patch("embeddings.client.FAISS.load_local")
     @mock.patch("embeddings.client.FAISS.from_documents")
-    @mock.patch("embeddings.client.RecursiveCharacterTextSplitter")
+    @mock.patch("embeddings.client.TokenBoundaryTextSplitter")
     @mock.patch("embeddings.client.BedrockEmbeddings")
     def test_generate_aws_provider_embeddings(
         self,
@@ -309,8 +319,8 @@ class TestEmbeddings:
         text_splitter_mock.assert_called_with(
             chunk_size=500,
             chunk_overlap=80,
-            length_function=embeddings._tiktoken_len,
             separators=["\n\n", "\n", " ", ""],
+            tokenizer=TokenCounter.get("cl100k_base"),
         )
 
         bedrock_embeddings_mock.assert_called_with(
@@ -328,3 +338,151 @@ class TestEmbeddings:
             embeddings=bedrock_embeddings_mock(),
             allow_dangerous_deserialization=True,
         )
+
+    def test_generate_from_retrievers_merges_stores_and_keeps_document_key(self):
+        fake_embeddings = DeterministicFakeEmbedding(size=8)
+        retriever_a = FAISS.from_texts(
+            ["first text of A", "second text of A"],
+            fake_embeddings,
+            metadatas=[{"page": 1}, {"page": 2}],
+        )
+        retriever_b = FAISS.from_texts(["only text of B"], fake_embeddings)
+        embedding_model = EmbeddingModel(
+            id="ollama",
+            name="Ollama",
+            provider="ollama",
+            config={"model": "llama2"},
+        )
+
+        merged_retriever = EmbeddingsClient(embedding_model).generate_from_retrievers(
+            {"document-a": retriever_a, "document-b": retriever_b}
+        )
+
+        assert merged_retriever.index.ntotal == 3
+        results = merged_retriever.similarity_search_with_score_by_vector(
+            fake_embeddings.embed_query("second text of A"), k=1
+        )
+        document, score = results[0]
+        assert document.page_content == "second text of A"
+        assert document.metadata == {"page": 2, "document_key": "document-a"}
+        assert score == 0
+        assert (
+            "document_key"
+            not in retriever_a.docstore.search(
+                retriever_a.index_to_docstore_id[1]
+            ).metadata
+        )
+
+    def test_generate_from_retrievers_returns_none_without_retrievers(self):
+        embedding_model = EmbeddingModel(
+            id="ollama",
+            name="Ollama",
+            provider="ollama",
+            config={"model": "llama2"},
+        )
+
+        assert EmbeddingsClient(embedding_model).generate_from_retrievers({}) is None
+
+    @mock.patch("embeddings.client.OllamaEmbeddings")
+    def test_embed_query_calls_provider_once_for_repeated_queries(
+        self, ollama_embeddings_mock
+    ):
+        ollama_embeddings_mock.return_value.embed_query.return_value = [0.1, 0.2]
+        embedding_model = EmbeddingModel(
+            id="ollama",
+            name="Ollama",
+            provider="ollama",
+            config={"model": "llama2"},
+        )
+        embeddings = EmbeddingsClient(embedding_model, EmbeddingsCache())
+
+        assert embeddings.embed_query("How long was the flight?") == [0.1, 0.2]
+        assert embeddings.embed_query("How long was  the flight?") == [0.1, 0.2]
+
+        ollama_embeddings_mock.return_value.embed_query.assert_called_once_with(
+            "How long was the flight?"
+        )
+        assert embeddings.query_cache_stats()["hits"] == 1
+        assert embeddings.query_cache_stats()["misses"] == 1
+
+    def test_generate_from_filesystem_with_mmap_returns_same_results(self, tmp_path):
+        kb_path = os.path.join(
+            get_test_data_path(),
+            "test_knowledge_pack/embeddings/ingenuity_wikipedia.kb",
+        )
+        mapped_kb_path = os.path.join(tmp_path, "ingenuity_wikipedia.kb")
+        shutil.copytree(kb_path, mapped_kb_path)
+        embedding_model = EmbeddingModel(
+            id="ollama",
+            name="Ollama",
+            provider="ollama",
+            config={"model": "llama2"},
+        )
+        retriever = EmbeddingsClient(
+            embedding_model, use_mmap=False
+        ).generate_from_filesystem(kb_path)
+        query_vector = retriever.index.reconstruct(3).tolist()
+        expected_results = retriever.similarity_search_with_score_by_vector(
+            query_vector, k=3
+        )
+
+        mapped_client = EmbeddingsClient(embedding_model, use_mmap=True)
+        pickled_docstore_results = mapped_client.generate_from_filesystem(
+            mapped_kb_path
+        ).similarity_search_with_score_by_vector(query_vector, k=3)
+
+        save_mapped_docstore(
+            mapped_kb_path,
+            [
+                retriever.docstore.search(retriever.index_to_docstore_id[i])
+                for i in range(retriever.index.ntotal)
+            ],
+        )
+        os.remove(os.path.join(mapped_kb_path, "index.pkl"))
+        mapped_retriever = mapped_client.generate_from_filesystem(mapped_kb_path)
+        mapped_docstore_results = (
+            mapped_retriever.similarity_search_with_score_by_vector(query_vector, k=3)
+        )
+
+        assert isinstance(mapped_retriever.docstore, MappedDocstore)
+        for results in [pickled_docstore_results, mapped_docstore_results]:
+            assert [
+                (document.page_content, document.metadata) for document, _ in results
+            ] == [
+                (document.page_content, document.metadata)
+                for document, _ in expected_results
+            ]
+            assert [score for _, score in results] == pytest.approx(
+                [score for _, score in expected_results]
+            )
+
+    def test_generate_from_filesystem_reads_compact_docstore(self, tmp_path):
+        embedding_model = EmbeddingModel(
+            id="ollama",
+            name="Ollama",
+            provider="ollama",
+            config={"model": "llama2"},
+        )
+        retriever = FAISS.from_texts(
+            ["first chunk", "second chunk"],
+            DeterministicFakeEmbedding(size=4),
+            metadatas=[{"page": 1}, {"page": 2}],
+        )
+        faiss.write_index(retriever.index, os.path.join(tmp_path, "index.faiss"))
+        save_mapped_docstore(
+            tmp_path,
+            [
+                retriever.docstore.search(id)
+                for id in retriever.index_to_docstore_id.values()
+            ],
+        )
+
+        loaded_retriever = EmbeddingsClient(
+            embedding_model, use_mmap=False
+        ).generate_from_filesystem(tmp_path)
+
+        assert isinstance(loaded_retriever.docstore, MappedDocstore)
+        assert loaded_retriever.index.ntotal == 2
+        assert loaded_retriever.docstore.search(
+            loaded_retriever.index_to_docstore_id[1]
+        ) == Document(page_content="second chunk", metadata={"page": 2})
@@ -0,0 +1,105 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+from unittest.mock import patch
+
+from embeddings.cache import EmbeddingsCache
+
+
+class TestEmbeddingsCache:
+    def test_get_returns_cached_vector_for_normalized_text_and_counts_hits(self):
+        cache = EmbeddingsCache(max_entries=10)
+
+        assert cache.get("What is   Haiven?", "model-a") is None
+        cache.put("What is   Haiven?", "model-a", [0.1, 0.2])
+
+        assert cache.get(" What is Haiven?\n", "model-a") == [0.1, 0.2]
+        assert cache.get("What is Haiven?", "model-b") is None
+        assert cache.stats() == {
+            "hits": 1,
+            "misses": 2,
+            "entries": 1,
+            "max_entries": 10,
+        }
+
+    def test_put_evicts_least_recently_used_entry(self):
+        cache = EmbeddingsCache(max_entries=2)
+        cache.put("first", "model", [1.0])
+        cache.put("second", "model", [2.0])
+        cache.get("first", "model")
+
+        cache.put("third", "model", [3.0])
+
+        assert cache.get("second", "model") is None
+        assert cache.get("first", "model") == [1.0]
+        assert cache.get("third", "model") == [3.0]
+
+    def test_get_evicts_expired_entries(self):
+        cache = EmbeddingsCache(max_entries=10, ttl_seconds=60)
+        with patch("embeddings.cache.time.time", return_value=1000):
+            cache.put("question", "model", [1.0])
+
+        with patch("embeddings.cache.time.time", return_value=1059):
+            assert cache.get("question", "model") == [1.0]
+
+        with patch("embeddings.cache.time.time", return_value=1061):
+            assert cache.get("question", "model") is None
+
+        assert cache.stats()["entries"] == 0
+
+    def test_zero_max_entries_disables_cache(self):
+        cache = EmbeddingsCache(max_entries=0)
+        cache.put("question", "model", [1.0])
+
+        assert cache.get("question", "model") is None
+
+    def test_save_and_load_from_persistence_file(self, tmp_path):
+        persistence_path = os.path.join(tmp_path, "embeddings_cache.json")
+        cache = EmbeddingsCache(max_entries=10, persistence_path=persistence_path)
+        cache.put("question", "model", [0.5, 0.25])
+        cache.save()
+
+        reloaded_cache = EmbeddingsCache(
+            max_entries=10, persistence_path=persistence_path
+        )
+
+        assert reloaded_cache.get("question", "model") == [0.5, 0.25]
+
+    def test_from_env_reads_configuration(self):
+        with patch.dict(
+            os.environ,
+            {
+                "EMBEDDINGS_CACHE_MAX_ENTRIES": "5",
+                "EMBEDDINGS_CACHE_TTL_SECONDS": "30",
+            },
+        ):
+            cache = EmbeddingsCache.from_env()
+
+        assert cache.max_entries == 5
+        assert cache.ttl_seconds == 30
+        assert cache.persistence_path is None
+
+    def test_from_env_shares_and_saves_one_cache_per_path(self, tmp_path):
+        persistence_path = os.path.join(tmp_path, "embeddings_cache.json")
+        with (
+            patch.dict(os.environ, {"EMBEDDINGS_CACHE_PATH": persistence_path}),
+            patch("embeddings.cache.atexit.register") as register,
+        ):
+            cache = EmbeddingsCache.from_env()
+            other_cache = EmbeddingsCache.from_env()
+
+        assert other_cache is cache
+        register.assert_called_once_with(cache.save)
+
+    def test_invalid_persistence_file_is_ignored(self, tmp_path):
+        persistence_path = os.path.join(tmp_path, "embeddings_cache.json")
+        with open(persistence_path, "w") as file:
+            file.write("{not json")
+
+        with patch("embeddings.cache.HaivenLogger") as mock_logger:
+            cache = EmbeddingsCache(persistence_path=persistence_path)
+
+        assert cache.stats()["entries"] == 0
+        assert (
+            mock_logger.get.return_value.analytics.call_args.args[0]
+            == "EmbeddingsCacheFileIgnored"
+        )
@@ -1,14 +1,20 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
-from unittest.mock import MagicMock
+import shutil
+from unittest.mock import MagicMock, patch
 
+import frontmatter
 import pytest
 from langchain.docstore.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
 from embeddings.model import EmbeddingModel
 from knowledge.documents import KnowledgeBaseDocuments
 
 
 class TestsKnowledgeBaseDocuments:
+    query_embedding = [0.1, 0.2, 0.3]
+
     @pytest.fixture(autouse=True)
     def setup(self):
         embedding_model = EmbeddingModel(
@@ -27,12 +33,20 @@ class TestsKnowledgeBaseDocuments:
         ]
 
         retriever_mock = MagicMock()
-        retriever_mock.similarity_search_with_score.return_value = (
+        retriever_mock.similarity_search_with_score_by_vector.return_value = (
             fake_similarity_results
         )
+        self.merged_retriever_mock = MagicMock()
+        self.merged_retriever_mock.similarity_search_with_score_by_vector.return_value = fake_similarity_results[
+            :3
+        ]
         embeddings_provider_mock = MagicMock()
+        embeddings_provider_mock.embed_query.return_value = self.query_embedding
         embeddings_provider_mock.generate_from_filesystem.return_value = retriever_mock
         embeddings_provider_mock.generate_from_documents.return_value = retriever_mock
+        embeddings_provider_mock.generate_from_retrievers.return_value = (
+            self.merged_retriever_mock
+        )
         embeddings_provider_mock.embedding_model = embedding_model
         config_service_mock = MagicMock()
         config_service_mock.load_embedding_model.return_value = embedding_model
@@ -49,15 +63,15 @@ class TestsKnowledgeBaseDocuments:
     def test_load_base_knowledge_pack_creates_one_entry_in_stores(
         self,
     ):
-        assert len(self.service._document_stores) == 1
-        assert self.service._document_stores["base"]._embeddings == {}
+        assert len(self.service.get_snapshot().document_stores) == 1
+        assert self.service.get_snapshot().document_stores["base"]._embeddings == {}
 
         self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
 
-        assert len(self.service._document_stores) == 1
+        assert len(self.service.get_snapshot().document_stores) == 1
         assert (
             "ingenuity-wikipedia"
-            in self.service._document_stores["base"]._embeddings.keys()
+            in self.service.get_snapshot().document_stores["base"]._embeddings.keys()
         )
 
     def test_load_context_knowledge_with_empty_embeddings_raise_error(
@@ -74,71 +88,79 @@ class TestsKnowledgeBaseDocuments:
             exception_raised = True
 
         assert exception_raised
-        assert len(self.service._document_stores) == 1  # only base embeddings
-        assert "base" in self.service._document_stores.keys()
-        assert "Context B" not in self.service._document_stores.keys()
+        assert (
+            len(self.service.get_snapshot().document_stores) == 1
+        )  # only base embeddings
+        assert "base" in self.service.get_snapshot().document_stores.keys()
+        assert "Context B" not in self.service.get_snapshot().document_stores.keys()
 
     def test_load_base_and_context_knowledge_creates_two_entry_in_stores(
         self,
     ):
-        assert len(self.service._document_stores) == 1
+        assert len(self.service.get_snapshot().document_stores) == 1
 
         self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
 
-        assert len(self.service._document_stores) == 1
-        assert "base" in self.service._document_stores.keys()
+        assert len(self.service.get_snapshot().document_stores) == 1
+        assert "base" in self.service.get_snapshot().document_stores.keys()
 
         self.service.load_documents_for_context(
             context_name="Context A",
             context_path=self.knowledge_pack_path + "/contexts/context_a/embeddings",
         )
 
-        assert len(self.service._document_stores) == 2
-        assert "base" in self.service._document_stores.keys()
-        assert "Context A" in self.service._document_stores.keys()
+        assert len(self.service.get_snapshot().document_stores) == 2
+        assert "base" in self.service.get_snapshot().document_stores.keys()
+        assert "Context A" in self.service.get_snapshot().document_stores.keys()
 
     def test_re_load_base_or_context_knowledge_should_not_create_extra_entries(
         self,
     ):
-        assert len(self.service._document_stores) == 1
+        assert len(self.service.get_snapshot().document_stores) == 1
 
         self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
 
-        assert len(self.service._document_stores) == 1
-        assert "base" in self.service._document_stores.keys()
+        assert len(self.service.get_snapshot().document_stores) == 1
+        assert "base" in self.service.get_snapshot().document_stores.keys()
 
         self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
 
-        assert len(self.service._document_stores) == 1
-        assert "base" in self.service._document_stores.keys()
+        assert len(self.service.get_snapshot().document_stores) == 1
+        assert "base" in self.service.get_snapshot().document_stores.keys()
 
         self.service.load_documents_for_context(
             context_name="Context A",
             context_path=self.knowledge_pack_path + "/contexts/context_a/embeddings",
         )
 
-        assert len(self.service._document_stores) == 2
-        assert "base" in self.service._document_stores.keys()
-        assert "Context A" in self.service._document_stores.keys()
+        assert len(self.service.get_snapshot().document_stores) == 2
+        assert "base" in self.service.get_snapshot().document_stores.keys()
+        assert "Context A" in self.service.get_snapshot().document_stores.keys()
 
         self.service.load_documents_for_context(
             context_name="Context A",
             context_path=self.knowledge_pack_path + "/contexts/context_a/embeddings",
         )
 
-        assert len(self.service._document_stores) == 2
-        assert "base" in self.service._document_stores.keys()
-        assert "Context A" in self.service._document_stores.keys()
+        assert len(self.service.get_snapshot().document_stores) == 2
+        assert "base" in self.service.get_snapshot().document_stores.keys()
+        assert "Context A" in self.service.get_snapshot().document_stores.keys()
 
     def test_generate_load_knowledge_base_should_load_two_embedding(self):
         self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
 
-        assert len(self.service._document_stores) == 1
-        assert len(self.service._document_stores.keys()) == 1
-        assert "base" in self.service._document_stores.keys()
+        assert len(self.service.get_snapshot().document_stores) == 1
+        assert len(self.service.get_snapshot().document_stores.keys()) == 1
+        assert "base" in self.service.get_snapshot().document_stores.keys()
 
-        assert "ingenuity-wikipedia" in self.service._document_stores["base"].get_keys()
-        assert "tw-guide-agile-sd" in self.service._document_stores["base"].get_keys()
+        assert (
+            "ingenuity-wikipedia"
+            in self.service.get_snapshot().document_stores["base"].get_keys()
+        )
+        assert (
+            "tw-guide-agile-sd"
+            in self.service.get_snapshot().document_stores["base"].get_keys()
+        )
 
     def test_similarity_search_on_single_document_with_scores_for_base_return_documents_and_scores(
         self,
@@ -172,10 +194,89 @@ class TestsKnowledgeBaseDocuments:
 
         assert len(similarity_results) == 0
 
+    def test_loading_documents_creates_merged_retriever_per_context(self):
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        self.service.load_documents_for_context(
+            context_name="Context A",
+            context_path=self.knowledge_pack_path + "/contexts/context_a/embeddings",
+        )
+
+        assert set(self.service.get_snapshot().merged_retrievers.keys()) == {
+            "base",
+            "Context A",
+        }
+
+        merged_document_keys = [
+            list(call.args[0].keys())
+            for call in self.service._embeddings_provider.generate_from_retrievers.call_args_list
+        ]
+        assert ["ingenuity-wikipedia", "tw-guide-agile-sd"] in merged_document_keys
+        assert [
+            "ingenuity-wikipedia",
+            "tw-guide-agile-sd",
+            "automotive-spice-reference-model",
+            "measuring-impact-genai",
+        ] in merged_document_keys
+
+    def test_similarity_search_for_context_uses_merged_retriever_once(self):
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        self.service.load_documents_for_context(
+            context_name="Context A",
+            context_path=self.knowledge_pack_path + "/contexts/context_a/embeddings",
+        )
+
+        similarity_results = self.service.similarity_search_with_scores(
+            query="When Ingenuity was launched?", context="Context A", k=3
+        )
+
+        assert len(similarity_results) == 3
+        self.service._embeddings_provider.embed_query.assert_called_once_with(
+            "When Ingenuity was launched?"
+        )
+        self.merged_retriever_mock.similarity_search_with_score_by_vector.assert_called_once_with(
+            self.query_embedding, k=3, score_threshold=None
+        )
+        self.service.get_snapshot().document_stores["base"].get_document(
+            "ingenuity-wikipedia"
+        ).retriever.similarity_search_with_score_by_vector.assert_not_called()
+
+    def test_similarity_search_without_merged_retriever_embeds_query_only_once(
+        self,
+    ):
+        self.service._embeddings_provider.generate_from_retrievers.return_value = None
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        self.service.load_documents_for_context(
+            context_name="Context A",
+            context_path=self.knowledge_pack_path + "/contexts/context_a/embeddings",
+        )
+
+        self.service.similarity_search_with_scores(
+            query="When Ingenuity was launched?", context="Context A"
+        )
+
+        self.service._embeddings_provider.embed_query.assert_called_once_with(
+            "When Ingenuity was launched?"
+        )
+        retriever_mock = (
+            self.service.get_snapshot()
+            .document_stores["base"]
+            .get_document("ingenuity-wikipedia")
+            .retriever
+        )
+        # all four documents share the same retriever mock in this test
+        assert retriever_mock.similarity_search_with_score_by_vector.call_count == 4
+        retriever_mock.similarity_search_with_score_by_vector.assert_called_with(
+            self.query_embedding, k=5, score_threshold=None
+        )
+        retriever_mock.similarity_search_with_score.assert_not_called()
+
     def test_similarity_search_for_context_should_return_documents_from_base_and_context_stores_sorted_by_scores(
         self,
     ):
-        assert len(self.service._document_stores) == 1
+        # Without a merged retriever, every document store is searched on its own
+        self.service._embeddings_provider.generate_from_retrievers.return_value = None
+
+        assert len(self.service.get_snapshot().document_stores) == 1
 
         self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
 
@@ -207,3 +308,162 @@ class TestsKnowledgeBaseDocuments:
         assert similarity_results[1][1] == 0.2
         assert similarity_results[2][1] == 0.2
         assert similarity_results[3][1] == 0.2
+
+    def test_load_documents_for_contexts_loads_all_contexts_and_reports_timings(
+        self,
+    ):
+        errors = self.service.load_documents_for_contexts(
+            {
+                "Context A": self.knowledge_pack_path
+                + "/contexts/context_a/embeddings",
+                "Context B": self.knowledge_pack_path
+                + "/contexts/context_b/embeddings",
+            }
+        )
+
+        assert list(errors.keys()) == ["Context B"]
+        assert isinstance(errors["Context B"], FileNotFoundError)
+        assert "Context B" not in self.service.get_snapshot().document_stores.keys()
+        assert self.service.get_snapshot().document_stores["Context A"].get_keys() == [
+            "automotive-spice-reference-model",
+            "measuring-impact-genai",
+        ]
+
+        report = self.service.load_report
+        assert report["seconds"] > 0
+        assert list(report["contexts"].keys()) == ["Context A"]
+        assert set(report["contexts"]["Context A"]["documents"].keys()) == {
+            "automotive-spice-reference-model",
+            "measuring-impact-genai",
+        }
+
+    def test_with_memory_budget_retrievers_are_loaded_on_first_search(self):
+        embeddings_provider = self.service._embeddings_provider
+        embeddings_provider.generate_from_filesystem.reset_mock()
+        embeddings_provider.generate_from_filesystem.side_effect = lambda path: (
+            FAISS.from_texts([f"chunk of {path}"], DeterministicFakeEmbedding(size=8))
+        )
+        embeddings_provider.embed_query.return_value = DeterministicFakeEmbedding(
+            size=8
+        ).embed_query("question")
+        service = KnowledgeBaseDocuments(
+            MagicMock(), embeddings_provider, memory_budget_mb=1
+        )
+
+        service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+
+        embeddings_provider.generate_from_filesystem.assert_not_called()
+        assert service.get_document("ingenuity-wikipedia").title != ""
+
+        service.similarity_search_on_single_document(
+            query="question", document_key="ingenuity-wikipedia", context="base"
+        )
+        service.similarity_search_on_single_document(
+            query="question", document_key="ingenuity-wikipedia", context="base"
+        )
+
+        assert embeddings_provider.generate_from_filesystem.call_count == 1
+        assert service._retriever_cache.stats()["hits"] == 1
+
+    def test_with_memory_budget_searches_documents_without_a_merged_index(self):
+        embeddings_provider = self.service._embeddings_provider
+        embeddings_provider.generate_from_retrievers.reset_mock()
+        embeddings_provider.generate_from_filesystem.side_effect = lambda path: (
+            FAISS.from_texts([f"chunk of {path}"], DeterministicFakeEmbedding(size=8))
+        )
+        service = KnowledgeBaseDocuments(
+            MagicMock(), embeddings_provider, memory_budget_mb=1
+        )
+        service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+
+        results = service.similarity_search_by_vector_with_scores(
+            DeterministicFakeEmbedding(size=8).embed_query("question"), "base", k=5
+        )
+
+        embeddings_provider.generate_from_retrievers.assert_not_called()
+        assert service.get_snapshot().merged_retrievers == {}
+        assert len(results) == 2
+        # Only the indexes of the documents are cached, and can be evicted
+        assert service._retriever_cache.stats()["entries"] == 2
+
+    def test_reload_documents_only_loads_changed_documents(self, tmp_path):
+        embeddings_path = os.path.join(tmp_path, "embeddings")
+        shutil.copytree(self.knowledge_pack_path + "/embeddings", embeddings_path)
+        embeddings_provider = self.service._embeddings_provider
+        self.service.load_documents_for_base(embeddings_path)
+        store_before_reload = self.service.get_snapshot().document_stores["base"]
+        embeddings_provider.generate_from_filesystem.reset_mock()
+
+        self.service.reload_documents({"base": embeddings_path})
+
+        embeddings_provider.generate_from_filesystem.assert_not_called()
+        assert (
+            self.service.get_snapshot().document_stores["base"] is store_before_reload
+        )
+
+        document_path = os.path.join(embeddings_path, "tw-guide-agile-sd.md")
+        stat = os.stat(document_path)
+        os.utime(document_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        os.remove(os.path.join(embeddings_path, "ingenuity_wikipedia.md"))
+
+        self.service.reload_documents({"base": embeddings_path})
+
+        assert embeddings_provider.generate_from_filesystem.call_count == 1
+        assert self.service.get_snapshot().document_stores["base"].get_keys() == [
+            "tw-guide-agile-sd"
+        ]
+        assert store_before_reload.get_keys() == [
+            "ingenuity-wikipedia",
+            "tw-guide-agile-sd",
+        ]
+        assert list(
+            self.service.load_report["contexts"]["base"]["documents"].keys()
+        ) == ["tw-guide-agile-sd"]
+
+    def test_documents_are_parsed_once_per_load(self):
+        embeddings_path = self.knowledge_pack_path + "/embeddings"
+        with patch(
+            "knowledge.documents.frontmatter.load", wraps=frontmatter.load
+        ) as load:
+            self.service.load_documents_for_base(embeddings_path)
+            self.service.reload_documents({"base": embeddings_path})
+
+        assert load.call_count == 4
+
+    def test_reload_documents_removes_contexts_that_are_gone(self):
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        self.service.load_documents_for_context(
+            "Context A", self.knowledge_pack_path + "/contexts/context_a/embeddings"
+        )
+
+        self.service.reload_documents(
+            {"base": self.knowledge_pack_path + "/embeddings"}
+        )
+
+        assert list(self.service.get_snapshot().document_stores.keys()) == ["base"]
+        assert "Context A" not in self.service.get_snapshot().merged_retrievers
+
+    def test_document_stores_are_not_shared_between_instances(self):
+        other_service = KnowledgeBaseDocuments(
+            MagicMock(), self.service._embeddings_provider
+        )
+
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+
+        assert len(self.service.get_documents()) == 2
+        assert other_service.get_documents() == []
+
+    def test_loading_documents_replaces_the_snapshot_instead_of_changing_it(self):
+        snapshot_before_loading = self.service.get_snapshot()
+
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        self.service.load_documents_for_context(
+            "Context A", self.knowledge_pack_path + "/contexts/context_a/embeddings"
+        )
+
+        assert self.service.get_snapshot() is not snapshot_before_loading
+        assert list(snapshot_before_loading.document_stores.keys()) == ["base"]
+        assert snapshot_before_loading.get_documents() == []
+        assert snapshot_before_loading.merged_retrievers == {}
+        with pytest.raises(TypeError):
+            self.service.get_snapshot().document_stores["Context B"] = None
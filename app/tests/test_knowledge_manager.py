@@ -1,4 +1,6 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+import shutil
 from unittest.mock import patch
 
 from knowledge.documents import KnowledgeBaseDocuments
@@ -26,6 +28,8 @@ class TestKnowledgeManager:
         mock_config_service.load_knowledge_pack_path.return_value = (
             self.knowledge_pack_path
         )
+        mock_knowledge_base_documents.return_value.load_documents_for_contexts.return_value = {}
+        mock_knowledge_base_documents.return_value.load_report = {}
 
         knowledge_manager = KnowledgeManager(
             config_service=mock_config_service,
@@ -40,6 +44,14 @@ class TestKnowledgeManager:
         mock_knowledge_base_documents_instance.load_documents_for_base.assert_called_once_with(
             self.knowledge_pack_path + "/embeddings"
         )
+        mock_knowledge_base_documents_instance.load_documents_for_contexts.assert_called_once_with(
+            {
+                "context_a": self.knowledge_pack_path
+                + "/contexts/context_a/embeddings",
+                "context_b": self.knowledge_pack_path
+                + "/contexts/context_b/embeddings",
+            }
+        )
 
         mock_knowledge_base_markdown.assert_called_once()
         knowledge_manager.knowledge_base_markdown.load_for_base.assert_called_once_with(
@@ -74,3 +86,82 @@ class TestKnowledgeManager:
             exception_raised = True
 
         assert not exception_raised
+
+    @patch("knowledge_manager.ConfigService")
+    def test_reload_only_reports_what_changed(self, mock_config_service, tmp_path):
+        knowledge_pack_path = os.path.join(tmp_path, "test_knowledge_pack")
+        shutil.copytree(self.knowledge_pack_path, knowledge_pack_path)
+        mock_config_service.load_embedding_model.return_value = EmbeddingModel(
+            id="ollama-embeddings",
+            name="Ollama Embeddings",
+            provider="ollama",
+            config={"model": "ollama-embeddings", "api_key": "api_key"},
+        )
+        mock_config_service.load_knowledge_pack_path.return_value = knowledge_pack_path
+        knowledge_manager = KnowledgeManager(config_service=mock_config_service)
+
+        assert knowledge_manager.reload() == {
+            "markdown": [],
+            "documents": {"base": [], "context_a": []},
+        }
+
+        with open(
+            os.path.join(knowledge_pack_path, "contexts/context_a/architecture.md"),
+            "a",
+        ) as f:
+            f.write("\nA new paragraph.\n")
+        os.makedirs(os.path.join(knowledge_pack_path, "contexts/context_c"))
+
+        report = knowledge_manager.reload()
+
+        assert sorted(report["markdown"]) == ["context_a", "context_c"]
+        assert (
+            "A new paragraph."
+            in (
+                knowledge_manager.knowledge_base_markdown.get_knowledge_content_dict(
+                    "context_a"
+                )["architecture"]
+            )
+        )
+        assert "context_c" in knowledge_manager.get_all_context_keys()
+
+    @patch("knowledge_manager.HaivenLogger")
+    @patch("knowledge_manager.ConfigService")
+    def test_reload_logs_missing_embeddings_once(
+        self, mock_config_service, mock_logger, tmp_path
+    ):
+        knowledge_pack_path = os.path.join(tmp_path, "test_knowledge_pack")
+        shutil.copytree(self.knowledge_pack_path, knowledge_pack_path)
+        mock_config_service.load_embedding_model.return_value = EmbeddingModel(
+            id="ollama-embeddings",
+            name="Ollama Embeddings",
+            provider="ollama",
+            config={"model": "ollama-embeddings", "api_key": "api_key"},
+        )
+        mock_config_service.load_knowledge_pack_path.return_value = knowledge_pack_path
+        knowledge_manager = KnowledgeManager(config_service=mock_config_service)
+        analytics = mock_logger.get.return_value.analytics
+
+        def missing_embeddings_logs():
+            logs = [
+                call.args[1]["error"]
+                for call in analytics.call_args_list
+                if call.args[0] == "KnowledgePackEmbeddingsNotFound"
+            ]
+            analytics.reset_mock()
+            return logs
+
+        assert len(missing_embeddings_logs()) == 1
+
+        knowledge_manager.reload()
+        knowledge_manager.reload()
+
+        assert missing_embeddings_logs() == []
+
+        shutil.rmtree(
+            os.path.join(knowledge_pack_path, "contexts/context_a/embeddings")
+        )
+        knowledge_manager.reload()
+        knowledge_manager.reload()
+
+        assert len(missing_embeddings_logs()) == 1
@@ -0,0 +1,65 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import MagicMock
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+from embeddings.retriever_cache import RetrieverCache, estimate_retriever_size
+
+
+def create_retriever(texts):
+    return FAISS.from_texts(texts, DeterministicFakeEmbedding(size=8))
+
+
+class TestRetrieverCache:
+    def test_estimate_retriever_size_counts_vectors_and_text(self):
+        retriever = create_retriever(["abc", "defgh"])
+
+        assert estimate_retriever_size(retriever) == 2 * 8 * 4 + 3 + 5
+        assert estimate_retriever_size(None) == 0
+
+    def test_get_or_load_only_loads_once(self):
+        retriever = create_retriever(["abc"])
+        loader = MagicMock(return_value=retriever)
+        cache = RetrieverCache(memory_budget_bytes=1024)
+
+        assert cache.get_or_load("document", loader) is retriever
+        assert cache.get_or_load("document", loader) is retriever
+
+        loader.assert_called_once()
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_least_recently_used_store_is_evicted_over_budget(self):
+        # each of these stores is estimated at 8 * 4 + 3 = 35 bytes
+        cache = RetrieverCache(memory_budget_bytes=80)
+        cache.get_or_load("first", lambda: create_retriever(["aaa"]))
+        cache.get_or_load("second", lambda: create_retriever(["bbb"]))
+        cache.get_or_load("first", lambda: create_retriever(["aaa"]))
+
+        cache.get_or_load("third", lambda: create_retriever(["ccc"]))
+
+        stats = cache.stats()
+        assert stats["evictions"] == 1
+        assert stats["entries"] == 2
+        assert stats["size_bytes"] == 70
+
+        reloaded_loader = MagicMock(return_value=create_retriever(["bbb"]))
+        cache.get_or_load("second", reloaded_loader)
+        reloaded_loader.assert_called_once()
+
+    def test_store_bigger_than_budget_is_kept_alone(self):
+        cache = RetrieverCache(memory_budget_bytes=10)
+        retriever = create_retriever(["a long text"])
+
+        assert cache.get_or_load("big", lambda: retriever) is retriever
+        assert cache.stats()["entries"] == 1
+
+    def test_evict_removes_store(self):
+        cache = RetrieverCache(memory_budget_bytes=1024)
+        cache.get_or_load("document", lambda: create_retriever(["abc"]))
+
+        cache.evict("document")
+
+        assert cache.stats()["entries"] == 0
+        assert cache.stats()["size_bytes"] == 0
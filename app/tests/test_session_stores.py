@@ -0,0 +1,241 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import fnmatch
+import os
+
+import pytest
+from llms.session_stores import (
+    InMemorySessionStore,
+    RedisSessionStore,
+    SessionStore,
+    SQLiteSessionStore,
+    create_session_store,
+    decode_chat_state,
+    encode_chat_state,
+)
+
+CHAT_STATE = {
+    "type": "StreamingChat",
+    "client": {"service_name": "mock", "temperature": 0.2, "stop": None},
+    "options": {"system_message": "You are a helpful assistant"},
+    "messages": [
+        {"type": "system", "content": "You are a helpful assistant"},
+        {"type": "human", "content": "Hello"},
+        {"type": "ai", "content": "Hi, how can I help?"},
+    ],
+}
+
+
+class FakeRedis:
+    """
+    Keeps keys in a dictionary, with the commands of redis-py that RedisSessionStore uses.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.expiries = {}
+        self.sorted_sets = {}
+        self.scans = 0
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def set(self, name, value, ex=None):
+        self.values[name] = value
+        self.expiries[name] = ex
+
+    def expire(self, name, seconds):
+        if name in self.values:
+            self.expiries[name] = seconds
+
+    def scan_iter(self, match):
+        self.scans += 1
+        return [name for name in self.values if fnmatch.fnmatch(name, match)]
+
+    def delete(self, *names):
+        deleted = [name for name in names if name in self.values]
+        for name in deleted:
+            del self.values[name]
+        return len(deleted)
+
+    def zadd(self, name, mapping, xx=False):
+        scores = self.sorted_sets.setdefault(name, {})
+        for member, score in mapping.items():
+            if not xx or member.encode("utf-8") in scores:
+                scores[member.encode("utf-8")] = score
+
+    def zrem(self, name, *members):
+        scores = self.sorted_sets.get(name, {})
+        for member in members:
+            scores.pop(member.encode("utf-8"), None)
+
+    def zcard(self, name):
+        return len(self.sorted_sets.get(name, {}))
+
+    def zrange(self, name, start, end):
+        return self._members_by_score(name)[start : end + 1]
+
+    def zrangebyscore(self, name, min, max):
+        assert min == "-inf" and max.startswith("(")
+        scores = self.sorted_sets.get(name, {})
+        return [
+            member
+            for member in self._members_by_score(name)
+            if scores[member] < float(max[1:])
+        ]
+
+    def _members_by_score(self, name):
+        scores = self.sorted_sets.get(name, {})
+        return sorted(scores, key=lambda member: (scores[member], member))
+
+
+def _entry(last_access=100.0, chat=CHAT_STATE):
+    return {
+        "created_at": 50.0,
+        "last_access": last_access,
+        "user": "a-user",
+        "chat": chat,
+    }
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def serialized_store(request, tmp_path):
+    if request.param == "sqlite":
+        store = SQLiteSessionStore(os.path.join(tmp_path, "sessions", "chats.db"))
+        yield store
+        store.close()
+    else:
+        yield RedisSessionStore(FakeRedis(), ttl_seconds=1800)
+
+
+class TestSessionStores:
+    def test_serialized_stores_return_the_entries_they_were_given(
+        self, serialized_store
+    ):
+        serialized_store.put("a-session", _entry())
+        serialized_store.put("new-session", _entry(chat=None))
+
+        assert serialized_store.get("a-session") == _entry()
+        assert serialized_store.get("new-session") == _entry(chat=None)
+        assert serialized_store.get("unknown-session") is None
+
+    def test_serialized_stores_delete_sessions(self, serialized_store):
+        serialized_store.put("a-session", _entry())
+
+        assert serialized_store.delete("a-session") is True
+        assert serialized_store.delete("a-session") is False
+        assert serialized_store.get("a-session") is None
+
+    def test_sqlite_store_removes_sessions_that_were_not_accessed(self, tmp_path):
+        store = SQLiteSessionStore(os.path.join(tmp_path, "chats.db"))
+        store.put("old-session", _entry(last_access=100.0))
+        store.put("touched-session", _entry(last_access=100.0))
+        store.touch("touched-session", 300.0)
+
+        assert store.remove_older_than(200.0) == ["old-session"]
+        assert store.get("old-session") is None
+        assert store.get("touched-session")["last_access"] == 300.0
+        store.close()
+
+    def test_sqlite_store_shares_sessions_between_connections(self, tmp_path):
+        path = os.path.join(tmp_path, "chats.db")
+        SQLiteSessionStore(path).put("a-session", _entry())
+
+        assert SQLiteSessionStore(path).get("a-session") == _entry()
+
+    def test_redis_store_expires_sessions_after_their_last_access(self):
+        client = FakeRedis()
+        store = RedisSessionStore(client, ttl_seconds=1800)
+
+        store.put("a-session", _entry())
+        client.expiries["haiven:chat-session:a-session"] = 10
+        store.touch("a-session", 200.0)
+
+        assert client.expiries["haiven:chat-session:a-session"] == 1800
+
+    def test_redis_store_removes_sessions_by_last_access_without_scanning(self):
+        client = FakeRedis()
+        store = RedisSessionStore(client, ttl_seconds=1800)
+        store.put("first-session", _entry(last_access=100.0))
+        store.put("second-session", _entry(last_access=110.0))
+        store.put("third-session", _entry(last_access=120.0))
+        store.put("fourth-session", _entry(last_access=125.0))
+        store.touch("first-session", 130.0)
+        store.touch("expired-session", 130.0)
+        # Redis expired the key of the third session
+        del client.values["haiven:chat-session:third-session"]
+
+        assert store.count() == 4
+        assert store.remove_older_than(115.0) == ["second-session"]
+        assert store.remove_least_recently_used(1) == [
+            "third-session",
+            "fourth-session",
+        ]
+        assert store.count() == 1
+        assert store.get("first-session")["last_access"] == 100.0
+        assert store.delete("first-session") is True
+        assert store.count() == 0
+        assert client.scans == 0
+
+    def test_in_memory_store_keeps_the_chat_objects(self):
+        store = InMemorySessionStore()
+        chat = object()
+        store.put("a-session", _entry(chat=chat))
+
+        assert store.get("a-session")["chat"] is chat
+        assert store.remove_older_than(200.0) == ["a-session"]
+
+    def test_in_memory_store_removes_sessions_in_order_of_last_access(self):
+        store = InMemorySessionStore()
+        store.put("first-session", _entry(last_access=100.0))
+        store.put("second-session", _entry(last_access=110.0))
+        store.put("third-session", _entry(last_access=120.0))
+        store.touch("first-session", 130.0)
+
+        assert store.remove_older_than(115.0) == ["second-session"]
+        assert store.remove_least_recently_used(1) == ["third-session"]
+        assert list(store.entries) == ["first-session"]
+        assert store.count() == 1
+
+    def test_serialized_stores_count_sessions(self, serialized_store):
+        serialized_store.put("a-session", _entry())
+        serialized_store.put("another-session", _entry())
+
+        assert serialized_store.count() == 2
+
+    def test_sqlite_store_removes_least_recently_used_sessions(self, tmp_path):
+        store = SQLiteSessionStore(os.path.join(tmp_path, "chats.db"))
+        store.put("first-session", _entry(last_access=100.0))
+        store.put("second-session", _entry(last_access=110.0))
+        store.put("third-session", _entry(last_access=120.0))
+        store.touch("first-session", 130.0)
+
+        assert store.remove_least_recently_used(1) == [
+            "second-session",
+            "third-session",
+        ]
+        assert store.remove_least_recently_used(1) == []
+        assert store.count() == 1
+        store.close()
+
+    def test_incomplete_store_can_not_be_created(self):
+        class StoreWithoutCount(SessionStore):
+            def get(self, session_key):
+                return None
+
+        with pytest.raises(TypeError):
+            StoreWithoutCount()
+
+    def test_encoded_chat_state_keeps_one_role_and_content_pair_per_message(self):
+        data = encode_chat_state(CHAT_STATE)
+
+        assert decode_chat_state(data) == CHAT_STATE
+        assert len(data) < len(str(CHAT_STATE))
+
+    def test_create_session_store_from_url(self, tmp_path):
+        assert isinstance(create_session_store(""), InMemorySessionStore)
+        sqlite_store = create_session_store(f"sqlite:///{tmp_path}/chats.db")
+        assert isinstance(sqlite_store, SQLiteSessionStore)
+        assert sqlite_store.path == f"{tmp_path}/chats.db"
+
+        with pytest.raises(ValueError):
+            create_session_store("mongodb://localhost")
@@ -0,0 +1,68 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import MagicMock, patch
+
+from embeddings.tokens import TokenCounter
+
+
+class TestTokenCounter:
+    @patch("embeddings.tokens.tiktoken")
+    def test_count_remembers_counts(self, mock_tiktoken):
+        encoder = MagicMock()
+        encoder.encode.return_value = [1, 2, 3]
+        mock_tiktoken.get_encoding.return_value = encoder
+
+        counter = TokenCounter("cl100k_base")
+
+        assert counter.count("some text") == 3
+        assert counter.count("some text") == 3
+
+        mock_tiktoken.get_encoding.assert_called_once_with("cl100k_base")
+        encoder.encode.assert_called_once_with("some text", disallowed_special=())
+        assert counter.stats()["hits"] == 1
+        assert counter.stats()["misses"] == 1
+
+    @patch("embeddings.tokens.tiktoken")
+    def test_count_evicts_least_recently_used_and_skips_long_texts(self, mock_tiktoken):
+        encoder = MagicMock()
+        encoder.encode.return_value = [1]
+        mock_tiktoken.get_encoding.return_value = encoder
+
+        counter = TokenCounter("cl100k_base", max_entries=2, max_text_length=5)
+        counter.count("a")
+        counter.count("b")
+        counter.count("a")
+        counter.count("c")
+        counter.count("too long")
+
+        assert counter.stats()["entries"] == 2
+        counter.count("a")
+        assert counter.stats()["hits"] == 2
+        counter.count("b")
+        assert counter.stats()["hits"] == 2
+
+    @patch("embeddings.tokens.tiktoken")
+    def test_count_batch_encodes_missing_texts_in_one_batch(self, mock_tiktoken):
+        encoder = MagicMock()
+        encoder.encode.return_value = [1]
+        encoder.encode_batch.return_value = [[1, 2], [1, 2, 3]]
+        mock_tiktoken.get_encoding.return_value = encoder
+
+        counter = TokenCounter("cl100k_base")
+        counter.count("a")
+
+        counts = counter.count_batch(["bb", "a", "ccc", "bb"])
+
+        assert counts == [2, 1, 3, 2]
+        encoder.encode_batch.assert_called_once_with(
+            ["bb", "ccc"], disallowed_special=()
+        )
+        assert counter.count("ccc") == 3
+        encoder.encode.assert_called_once()
+
+    @patch("embeddings.tokens.tiktoken")
+    def test_get_returns_one_counter_per_encoding(self, mock_tiktoken):
+        with patch.object(TokenCounter, "_instances", {}):
+            counter = TokenCounter.get("cl100k_base")
+
+            assert TokenCounter.get("cl100k_base") is counter
+            assert TokenCounter.get("p50k_base") is not counter
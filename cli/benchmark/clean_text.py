@@ -0,0 +1,135 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+"""
+Benchmarks FileService.clean_text_with_spaces_between_characters against the lookaround
+substitutions it replaced, on synthetic text that looks like the text extracted from PDFs:
+words with spaces between their characters, as in scanned documents, mixed with plain
+words, punctuation, double spaces and line breaks. The same arguments always create the
+same text, and the outputs of both implementations are checked to be identical.
+
+Run from the cli folder:
+    python -m benchmark.clean_text --words 500000 --spaced-ratio 0.7 --output clean_text_report.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import re
+import time
+
+from haiven_cli.services.file_service import FileService
+
+BENCHMARK_REPORT_VERSION = 1
+
+_WORDS = (
+    "agile architecture backlog build cloud code customer data delivery deploy design "
+    "developer’s domain feedback feature (incident) infrastructure integration: iteration, "
+    "latency metric model-based monitoring pipeline platform product quality release "
+    "2024 3.5 requirement; retrospective risk security service stakeholder story team test"
+).split()
+
+
+def create_text(words: int, spaced_ratio: float, seed: int = 0) -> str:
+    text_random = random.Random(seed)
+    parts = []
+    for _ in range(words):
+        word = text_random.choice(_WORDS)
+        if text_random.random() < spaced_ratio:
+            word = " ".join(word)
+        parts.append(word)
+        parts.append("  " if text_random.random() < 0.3 else " ")
+        if text_random.random() < 0.05:
+            parts.append("\n")
+    return "".join(parts)
+
+
+def clean_text_with_lookarounds(text: str) -> str:
+    text = re.sub(r"(?<=[\w,.’\-():]) (?=[\w,.’\-():])", "", text)
+    text = re.sub(r"  ", " ", text)
+    return text
+
+
+def measure_seconds(clean, text: str, repeats: int) -> dict:
+    durations = []
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        clean(text)
+        durations.append(time.perf_counter() - started_at)
+    return {"best_seconds": min(durations), "mean_seconds": sum(durations) / repeats}
+
+
+def run_benchmark(
+    words: int, spaced_ratio: float, repeats: int = 5, seed: int = 0
+) -> dict:
+    """
+    Parameters:
+        words: The number of words of the text.
+        spaced_ratio: The share of words with spaces between their characters.
+        repeats: The number of times each implementation cleans the text.
+        seed: The seed of the generated text.
+
+    Returns:
+        dict: The benchmark report.
+    """
+    text = create_text(words, spaced_ratio, seed)
+    clean = FileService().clean_text_with_spaces_between_characters
+
+    if clean(text) != clean_text_with_lookarounds(text):
+        raise AssertionError("the cleaned texts differ")
+
+    lookarounds = measure_seconds(clean_text_with_lookarounds, text, repeats)
+    current = measure_seconds(clean, text, repeats)
+
+    return {
+        "version": BENCHMARK_REPORT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "parameters": {
+            "words": words,
+            "spaced_ratio": spaced_ratio,
+            "repeats": repeats,
+            "seed": seed,
+            "characters": len(text),
+        },
+        "lookarounds": lookarounds,
+        "current": current,
+        "speedup": lookarounds["best_seconds"] / current["best_seconds"],
+    }
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the cleaning of spaces between characters of PDF text."
+    )
+    parser.add_argument("--words", type=int, default=500000)
+    parser.add_argument(
+        "--spaced-ratio",
+        type=float,
+        default=0.7,
+        help="Share of words with spaces between their characters",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.words, args.spaced_ratio, args.repeats, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark report written to {args.output}")
+
+    print(
+        f"{report['parameters']['characters']} characters:",
+        f"lookarounds {report['lookarounds']['best_seconds']:.3f} s,",
+        f"current {report['current']['best_seconds']:.3f} s,",
+        f"speedup {report['speedup']:.2f}x",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,27 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import typer
 from haiven_cli.models.embedding_model import EmbeddingModel
+from haiven_cli.models.html_filter import HtmlFilter
 from haiven_cli.services.config_service import ConfigService
+from haiven_cli.services.crawler_service import (
+    DEFAULT_NEAR_DUPLICATE_DISTANCE,
+    CrawlerService,
+    CrawlMetrics,
+)
 from haiven_cli.services.file_service import FileService
 from haiven_cli.services.knowledge_service import KnowledgeService
 from haiven_cli.services.metadata_service import MetadataService
+from haiven_cli.services.page_helper import PageHelper
 from typing import List
+from urllib.parse import urlparse
+
+# The number of PDF pages split and embedded at once
+PDF_BATCH_SIZE = 50
 
 
 class App:
@@ -15,11 +31,13 @@ class App:
         file_service: FileService,
         knowledge_service: KnowledgeService,
         metadata_service: MetadataService,
+        crawler_service: CrawlerService = None,
     ):
         self.config_service = config_service
         self.file_service = file_service
         self.knowledge_service = knowledge_service
         self.metadata_service = metadata_service
+        self.crawler_service = crawler_service or CrawlerService(PageHelper())
 
     def index_individual_file(
         self,
@@ -29,6 +47,10 @@ class App:
         output_dir: str,
         description: str,
         pdf_source_link: str = None,
+        pdf_workers: int = 1,
+        clean_pdf_text: bool = False,
+        csv_batch_size: int = 0,
+        start_row: int = None,
     ):
         if not source_path:
             raise ValueError("please provide file path for source_path option")
@@ -44,22 +66,48 @@ class App:
                 f"embeddings are not defined in {config_path}\n{current_models}"
             )
 
-        file_content = None
-        file_metadata = None
-        if source_path.endswith(".csv"):
-            file_content, file_metadata = self._get_csv_file_text_and_metadata(
-                source_path
+        file_path_prefix = _format_file_name(source_path)
+        output_kb_dir = f"{output_dir}/{file_path_prefix}.kb"
+
+        if source_path.endswith(".csv") and csv_batch_size > 0:
+            # Rows are indexed while they are read, resuming an interrupted ingestion
+            if start_row is None:
+                start_row = self.knowledge_service.get_indexed_rows(
+                    output_kb_dir, source_path
+                )
+            if start_row > 0:
+                print(f"Skipping the first {start_row} rows of {source_path}")
+            rows = self.file_service.get_rows_from_csv(source_path, start_row)
+            self.knowledge_service.index_in_batches(
+                rows, model, output_kb_dir, source_path, csv_batch_size, start_row
             )
         elif source_path.endswith(".pdf"):
-            file_content, file_metadata = self._get_pdf_file_text_and_metadata(
-                source_path, pdf_source_link
+            # Pages are split, embedded and appended to the knowledge base while they are
+            # extracted, the text of the whole file is never kept
+            pages = self._get_pdf_pages(
+                source_path, pdf_source_link, pdf_workers, clean_pdf_text
+            )
+            self.knowledge_service.index_in_batches(
+                pages,
+                model,
+                output_kb_dir,
+                source_path,
+                PDF_BATCH_SIZE,
+                delete_vanished_chunks=True,
             )
         else:
-            raise ValueError("source file needs to be .pdf or .csv file")
+            file_content = None
+            file_metadata = None
+            if source_path.endswith(".csv"):
+                file_content, file_metadata = self._get_csv_file_text_and_metadata(
+                    source_path
+                )
+            else:
+                raise ValueError("source file needs to be .pdf or .csv file")
 
-        file_path_prefix = _format_file_name(source_path)
-        output_kb_dir = f"{output_dir}/{file_path_prefix}.kb"
-        self.knowledge_service.index(file_content, file_metadata, model, output_kb_dir)
+            self.knowledge_service.index(
+                file_content, file_metadata, model, output_kb_dir, source_path
+            )
         metadata = self.metadata_service.create_metadata(
             source_path, description, model.provider, output_dir
         )
@@ -74,6 +122,7 @@ class App:
         config_path: str,
         output_dir: str,
         description: str,
+        workers: int = 1,
     ):
         if not source_dir:
             raise ValueError("please provide directory path for source_dir option")
@@ -88,6 +137,12 @@ class App:
 
         files = self.file_service.get_files_path_from_directory(source_dir)
 
+        if workers > 1:
+            self._index_files_in_parallel(
+                list(files), model, output_dir, description, workers
+            )
+            return
+
         for file in files:
             print(f"creating knowledge for {file} in {output_dir}")
             file_content = None
@@ -105,7 +160,7 @@ class App:
 
             output_kb_dir = f"{output_dir}/{_format_file_name(file)}.kb"
             self.knowledge_service.index(
-                file_content, first_metadata, model, output_kb_dir
+                file_content, first_metadata, model, output_kb_dir, file
             )
             metadata = self.metadata_service.create_metadata(
                 file, description, model.provider, output_dir
@@ -114,6 +169,93 @@ class App:
                 metadata, f"{output_dir}/{_format_file_name(file)}.md"
             )
 
+    def _index_files_in_parallel(
+        self,
+        files: List[str],
+        model: EmbeddingModel,
+        output_dir: str,
+        description: str,
+        workers: int,
+    ):
+        """
+        Indexes files in a pipeline: text extraction and splitting run in a pool of worker
+        processes, while the chunks of files that are already split are embedded and saved
+        by a pool of threads. At most twice as many files as workers are in flight, and files
+        are finished, with their metadata file written, in the order they were listed.
+        """
+        for file in files:
+            if not (file.endswith(".csv") or file.endswith(".pdf")):
+                raise ValueError("source file needs to be .pdf or .csv file")
+
+        # Files with the same name in different folders are merged into the same .kb
+        output_kb_dir_locks = defaultdict(threading.Lock)
+        remaining_files = iter(files)
+        split_futures = deque()
+        index_futures = deque()
+
+        with (
+            ProcessPoolExecutor(max_workers=workers) as split_executor,
+            ThreadPoolExecutor(max_workers=workers) as index_executor,
+            typer.progressbar(length=len(files), label="Indexing files") as progress,
+        ):
+
+            def split_next_file():
+                file = next(remaining_files, None)
+                if file is not None:
+                    split_futures.append(
+                        (
+                            file,
+                            split_executor.submit(
+                                _split_file,
+                                self.file_service,
+                                self.knowledge_service,
+                                file,
+                            ),
+                        )
+                    )
+
+            def create_knowledge_base(documents, output_kb_dir, file):
+                with output_kb_dir_locks[output_kb_dir]:
+                    self.knowledge_service.create_knowledge_base(
+                        documents, model, output_kb_dir, file
+                    )
+
+            def finish_next_file():
+                file, future = index_futures.popleft()
+                future.result()
+                metadata = self.metadata_service.create_metadata(
+                    file, description, model.provider, output_dir
+                )
+                self.file_service.write_metadata_file(
+                    metadata, f"{output_dir}/{_format_file_name(file)}.md"
+                )
+                progress.update(1)
+
+            for _ in range(workers * 2):
+                split_next_file()
+
+            while split_futures:
+                file, future = split_futures.popleft()
+                documents = future.result()
+                output_kb_dir = f"{output_dir}/{_format_file_name(file)}.kb"
+                index_futures.append(
+                    (
+                        file,
+                        index_executor.submit(
+                            create_knowledge_base, documents, output_kb_dir, file
+                        ),
+                    )
+                )
+                split_next_file()
+
+                while index_futures and (
+                    index_futures[0][1].done() or len(index_futures) > workers
+                ):
+                    finish_next_file()
+
+            while index_futures:
+                finish_next_file()
+
     def index_txts_directory(
         self,
         source_dir: str,
@@ -149,6 +291,69 @@ class App:
             metadata, f"{output_dir}/{_format_file_name(directory_name)}.md"
         )
 
+    def index_web_pages(
+        self,
+        embedding_model: str,
+        config_path: str,
+        output_dir: str,
+        description: str,
+        sitemap: str = None,
+        url_list: str = None,
+        mirror_dir: str = None,
+        base_url: str = None,
+        html_filter: str = "p",
+        workers: int = 4,
+        batch_size: int = 100,
+        near_duplicate_distance: int = DEFAULT_NEAR_DUPLICATE_DISTANCE,
+    ):
+        """
+        Indexes the pages of a sitemap, a file with a list of URLs or a local mirror of a
+        site into one knowledge base, named after the sitemap, list or mirror. Pages are
+        fetched and parsed by a pool of workers, and indexed batch_size pages at a time while
+        the next pages are crawled. Near duplicates of a page before them are skipped, see
+        CrawlerService.get_rows.
+        """
+        sources = [source for source in [sitemap, url_list, mirror_dir] if source]
+        if len(sources) != 1:
+            raise ValueError(
+                "please provide one of the sitemap, url_list or mirror_dir options"
+            )
+        source = sources[0]
+
+        embedding_models = self.config_service.load_embeddings(config_path)
+        model = _get_embedding(embedding_model, embedding_models)
+        if model is None:
+            current_models = _get_defined_embedding_models_ids(embedding_models)
+            raise ValueError(
+                f"embeddings are not defined in {config_path}\n{current_models}"
+            )
+
+        if sitemap:
+            pages = self.crawler_service.get_urls_from_sitemap(sitemap)
+        elif url_list:
+            pages = self.crawler_service.get_urls_from_file(url_list)
+        else:
+            pages = self.crawler_service.get_pages_from_mirror(mirror_dir, base_url)
+        print(f"Crawling {len(pages)} pages of {source}")
+
+        metrics = CrawlMetrics()
+        rows = self.crawler_service.get_rows(
+            pages, HtmlFilter(html_filter), workers, metrics, near_duplicate_distance
+        )
+        source_name = _format_web_source_name(source)
+        self.knowledge_service.index_in_batches(
+            rows, model, f"{output_dir}/{source_name}.kb", source, batch_size
+        )
+        for line in metrics.report():
+            print(line)
+
+        metadata = self.metadata_service.create_metadata(
+            source_name, description, model.provider, output_dir
+        )
+        self.file_service.write_metadata_file(
+            metadata, f"{output_dir}/{source_name}.md"
+        )
+
     def create_context_structure(self, context_name: str, parent_dir: str = "./"):
         if not context_name:
             raise ValueError("please provide context name for context_name option")
@@ -174,15 +379,50 @@ class App:
             directory_path, authors
         )
 
+    def _get_pdf_pages(
+        self,
+        source_path: str,
+        pdf_source_link: str,
+        pdf_workers: int,
+        clean_text: bool,
+    ):
+        """
+        Yields the pages of a PDF while they are extracted, by ranges in pdf_workers
+        processes if there is more than one.
+        """
+        if pdf_workers > 1:
+            yield from self.file_service.get_pages_from_pdf_in_parallel(
+                source_path, pdf_source_link, pdf_workers, clean_text=clean_text
+            )
+            return
+
+        with open(source_path, "rb") as pdf_file:
+            yield from self.file_service.get_pages_from_pdf(
+                pdf_file, pdf_source_link, clean_text=clean_text
+            )
+
     def _get_pdf_file_text_and_metadata(
-        self, source_path: str, pdf_source_link: str = None
+        self, source_path: str, pdf_source_link: str = None, clean_text: bool = False
     ):
         with open(source_path, "rb") as pdf_file:
             return self.file_service.get_text_and_metadata_from_pdf(
-                pdf_file, pdf_source_link
+                pdf_file, pdf_source_link, clean_text
             )
 
 
+def _split_file(file_service: FileService, knowledge_service: KnowledgeService, file):
+    """
+    Extracts the text of a file and splits it, in a worker process.
+    """
+    if file.endswith(".csv"):
+        texts, metadatas = file_service.get_text_and_metadata_from_csv(file)
+    else:
+        with open(file, "rb") as pdf_file:
+            texts, metadatas = file_service.get_text_and_metadata_from_pdf(pdf_file)
+
+    return knowledge_service.split_documents(texts, metadatas)
+
+
 def _get_embedding(
     embedding_model: str, embedding_models: List[EmbeddingModel]
 ) -> EmbeddingModel:
@@ -199,6 +439,24 @@ def _get_defined_embedding_models_ids(embedding_models: List[EmbeddingModel]) ->
     return models_ids
 
 
+def _format_web_source_name(source: str) -> str:
+    """
+    Returns the name of the knowledge base of a web source: the host and path of a sitemap
+    URL, like example.com-docs-sitemap for https://example.com/docs/sitemap.xml, or the
+    name of a mirror directory or URL list file.
+    """
+    url = urlparse(source)
+    if url.scheme in ("http", "https"):
+        path = os.path.splitext(url.path.strip("/"))[0]
+        parts = [url.netloc.replace(":", "-"), *path.split("/")]
+        return "-".join(part for part in parts if part)
+
+    name = os.path.basename(os.path.normpath(os.path.abspath(source)))
+    if os.path.isdir(source):
+        return name
+    return os.path.splitext(name)[0]
+
+
 def _format_file_name(file_path: str) -> str:
     split_file = file_path.split(".")
     if len(split_file) == 1:
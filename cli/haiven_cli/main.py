@@ -3,14 +3,23 @@ import typer
 
 from haiven_cli.app.app import App
 from haiven_cli.services.config_service import ConfigService
-from haiven_cli.services.cli_config_service import CliConfigService
+from haiven_cli.services.cli_config_service import (
+    CliConfigService,
+    DEFAULT_CLI_CONFIG_DIR,
+)
+from haiven_cli.services.crawler_service import DEFAULT_NEAR_DUPLICATE_DISTANCE
 from haiven_cli.services.embedding_service import EmbeddingService
+from haiven_cli.services.embeddings_cache import (
+    CachedEmbeddingService,
+    EmbeddingsCache,
+)
 from haiven_cli.services.file_service import FileService
 from haiven_cli.services.knowledge_service import KnowledgeService
 from haiven_cli.services.token_service import TokenService
 from haiven_cli.services.metadata_service import MetadataService
 
 ENCODING = "cl100k_base"
+DEFAULT_EMBEDDINGS_CACHE_PATH = f"{DEFAULT_CLI_CONFIG_DIR}/embeddings_cache.sqlite"
 
 cli = typer.Typer(no_args_is_help=True)
 
@@ -35,6 +44,11 @@ def index_file(
     description: str = "",
     output_dir: str = "new_knowledge_base",
     pdf_source_link: str = None,
+    pdf_workers: int = 1,
+    clean_pdf_text: bool = False,
+    csv_batch_size: int = 0,
+    start_row: int = None,
+    embeddings_cache: str = DEFAULT_EMBEDDINGS_CACHE_PATH,
 ):
     """Index single file to a given destination directory."""
 
@@ -46,15 +60,23 @@ def index_file(
 
     config_service = ConfigService(env_file_path=env_path_file)
 
-    app = create_app(config_service)
-    app.index_individual_file(
-        source_path,
-        embedding_model,
-        config_path,
-        output_dir,
-        description,
-        pdf_source_link,
-    )
+    cache = _create_embeddings_cache(embeddings_cache)
+    app = create_app(config_service, cache)
+    try:
+        app.index_individual_file(
+            source_path,
+            embedding_model,
+            config_path,
+            output_dir,
+            description,
+            pdf_source_link,
+            pdf_workers,
+            clean_pdf_text,
+            csv_batch_size,
+            start_row,
+        )
+    finally:
+        _close_embeddings_cache(cache)
 
 
 @cli.command(no_args_is_help=True)
@@ -64,6 +86,8 @@ def index_all_files(
     embedding_model="openai",
     description: str = "",
     config_path: str = "",
+    workers: int = 1,
+    embeddings_cache: str = DEFAULT_EMBEDDINGS_CACHE_PATH,
 ):
     """Index all files in a directory to a given destination directory."""
     cli_config_service = CliConfigService()
@@ -73,11 +97,15 @@ def index_all_files(
     env_path_file = cli_config_service.get_env_path()
 
     config_service = ConfigService(env_file_path=env_path_file)
-    app = create_app(config_service)
-    print("Indexing all files")
-    app.index_all_files(
-        source_dir, embedding_model, config_path, output_dir, description
-    )
+    cache = _create_embeddings_cache(embeddings_cache)
+    app = create_app(config_service, cache)
+    try:
+        print("Indexing all files")
+        app.index_all_files(
+            source_dir, embedding_model, config_path, output_dir, description, workers
+        )
+    finally:
+        _close_embeddings_cache(cache)
 
 
 @cli.command(no_args_is_help=True)
@@ -88,6 +116,7 @@ def index_txt_files(
     description: str = "",
     config_path: str = "",
     authors: str = "Unknown",
+    embeddings_cache: str = DEFAULT_EMBEDDINGS_CACHE_PATH,
 ):
     """Index all TXT files in a directory into one knowledge base in a given destination directory."""
     cli_config_service = CliConfigService()
@@ -97,12 +126,61 @@ def index_txt_files(
     env_path_file = cli_config_service.get_env_path()
 
     config_service = ConfigService(env_file_path=env_path_file)
-    app = create_app(config_service)
-    print("Indexing all files in " + source_dir)
+    cache = _create_embeddings_cache(embeddings_cache)
+    app = create_app(config_service, cache)
+    try:
+        print("Indexing all files in " + source_dir)
 
-    app.index_txts_directory(
-        source_dir, embedding_model, config_path, output_dir, description, authors
-    )
+        app.index_txts_directory(
+            source_dir, embedding_model, config_path, output_dir, description, authors
+        )
+    finally:
+        _close_embeddings_cache(cache)
+
+
+@cli.command(no_args_is_help=True)
+def index_web_pages(
+    sitemap: str = "",
+    url_list: str = "",
+    mirror_dir: str = "",
+    base_url: str = "",
+    output_dir="new_knowledge_base",
+    embedding_model="openai",
+    description: str = "",
+    config_path: str = "",
+    html_filter: str = "p",
+    workers: int = 4,
+    batch_size: int = 100,
+    near_duplicate_distance: int = DEFAULT_NEAR_DUPLICATE_DISTANCE,
+    embeddings_cache: str = DEFAULT_EMBEDDINGS_CACHE_PATH,
+):
+    """Index the pages of a sitemap, a list of URLs or a local mirror of a site into one knowledge base."""
+    cli_config_service = CliConfigService()
+    if cli_config_service.get_config_path() and config_path == "":
+        config_path = cli_config_service.get_config_path()
+
+    env_path_file = cli_config_service.get_env_path()
+
+    config_service = ConfigService(env_file_path=env_path_file)
+    cache = _create_embeddings_cache(embeddings_cache)
+    app = create_app(config_service, cache)
+    try:
+        app.index_web_pages(
+            embedding_model,
+            config_path,
+            output_dir,
+            description,
+            sitemap=sitemap,
+            url_list=url_list,
+            mirror_dir=mirror_dir,
+            base_url=base_url,
+            html_filter=html_filter,
+            workers=workers,
+            batch_size=batch_size,
+            near_duplicate_distance=near_duplicate_distance,
+        )
+    finally:
+        _close_embeddings_cache(cache)
 
 
 @cli.command(no_args_is_help=True)
@@ -152,9 +230,12 @@ def set_env_path(
     print(f"Env path set to {env_path}")
 
 
-def create_app(config_service: ConfigService):
+def create_app(config_service: ConfigService, embeddings_cache: EmbeddingsCache = None):
     token_service = TokenService(ENCODING)
-    knowledge_service = KnowledgeService(token_service, EmbeddingService)
+    embedding_service = EmbeddingService
+    if embeddings_cache is not None:
+        embedding_service = CachedEmbeddingService(EmbeddingService, embeddings_cache)
+    knowledge_service = KnowledgeService(token_service, embedding_service)
     app = App(
         config_service,
         FileService(),
@@ -164,5 +245,23 @@ def create_app(config_service: ConfigService):
     return app
 
 
+def _create_embeddings_cache(path: str) -> EmbeddingsCache:
+    if not path:
+        return None
+    return EmbeddingsCache(path)
+
+
+def _close_embeddings_cache(cache: EmbeddingsCache):
+    if cache is None:
+        return
+
+    stats = cache.stats()
+    print(
+        f"Embeddings cache: {stats['hits']} chunks found, {stats['misses']} embedded",
+        f"({stats['hit_rate']:.0%} hit rate)",
+    )
+    cache.close()
+
+
 if __name__ == "__main__":
     cli()
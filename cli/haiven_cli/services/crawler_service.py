@@ -0,0 +1,322 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import os
+import re
+import threading
+import time
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List
+
+from bs4 import BeautifulSoup
+from haiven_cli.models.html_filter import HtmlFilter
+from haiven_cli.models.page_data import PageData
+from haiven_cli.services.page_helper import PageHelper
+
+FETCH_TIMEOUT_SECONDS = 30
+USER_AGENT = "haiven-cli"
+HTML_FILE_EXTENSIONS = (".html", ".htm")
+DEFAULT_NEAR_DUPLICATE_DISTANCE = 3
+SHINGLE_WORDS = 3
+FINGERPRINT_BITS = 64
+
+
+class CrawlMetrics:
+    """
+    Counts the pages and bytes that went through each stage of a crawl (fetch, parse,
+    dedup, index) and the time the workers of the stage spent on them, to report the
+    throughput of every stage.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._started_at = clock()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self, stage: str, pages: int = 1, byte_count: int = 0, seconds: float = 0
+    ):
+        with self._lock:
+            metrics = self._stages.setdefault(
+                stage, {"pages": 0, "bytes": 0, "seconds": 0.0, "failures": 0}
+            )
+            metrics["pages"] += pages
+            metrics["bytes"] += byte_count
+            metrics["seconds"] += seconds
+
+    def record_failure(self, stage: str):
+        with self._lock:
+            self._stages.setdefault(
+                stage, {"pages": 0, "bytes": 0, "seconds": 0.0, "failures": 0}
+            )["failures"] += 1
+
+    def stats(self) -> dict:
+        elapsed_seconds = max(self._clock() - self._started_at, 1e-9)
+        with self._lock:
+            return {
+                stage: {
+                    **metrics,
+                    "pages_per_second": metrics["pages"] / elapsed_seconds,
+                }
+                for stage, metrics in self._stages.items()
+            }
+
+    def report(self) -> List[str]:
+        return [
+            f"{stage}: {metrics['pages']} pages, {metrics['bytes'] / 1e6:.1f} MB,"
+            f" {metrics['failures']} failed, {metrics['pages_per_second']:.1f} pages/s,"
+            f" {metrics['seconds']:.1f}s of work"
+            for stage, metrics in self.stats().items()
+        ]
+
+
+class NearDuplicateIndex:
+    """
+    Finds the pages whose SimHash fingerprint differs from the fingerprint of a page added
+    before them by at most max_distance bits. The fingerprints are split into
+    max_distance + 1 bands: two fingerprints that close have at least one equal band, so
+    only the fingerprints that share a band with a page are compared to it.
+    """
+
+    def __init__(self, max_distance: int = DEFAULT_NEAR_DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        band_count = max_distance + 1
+        # The (shift, mask) of each band
+        bounds = [
+            FINGERPRINT_BITS * band // band_count for band in range(band_count + 1)
+        ]
+        self._bands = [
+            (start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])
+        ]
+        self._fingerprints_by_band = [{} for _ in self._bands]
+
+    def add(self, fingerprint: int) -> bool:
+        """
+        Adds the fingerprint of a page, unless it is a near duplicate of a page added
+        before. Returns whether it was added.
+        """
+        keys = [(fingerprint >> shift) & mask for shift, mask in self._bands]
+        for key, fingerprints in zip(keys, self._fingerprints_by_band):
+            for other in fingerprints.get(key, ()):
+                if (fingerprint ^ other).bit_count() <= self.max_distance:
+                    return False
+
+        for key, fingerprints in zip(keys, self._fingerprints_by_band):
+            fingerprints.setdefault(key, []).append(fingerprint)
+        return True
+
+
+class CrawlerService:
+    """
+    Lists the pages of a sitemap, a list of URLs or a local mirror of a site, and turns them
+    into (text, metadata) rows with PageHelper: pages are fetched by a pool of threads and
+    parsed by a pool of processes, and pages that are near duplicates of a page before them,
+    like copies with another layout or a different footer, are skipped.
+    """
+
+    def __init__(self, page_helper: PageHelper, read_location=None):
+        self.page_helper = page_helper
+        self._read_location = read_location or _read_location
+
+    def get_urls_from_sitemap(self, sitemap: str) -> List[str]:
+        """
+        Returns the page URLs of a sitemap, a URL or a file, following sitemap indexes.
+        """
+        root = ElementTree.fromstring(self._read_location(sitemap))
+        # The <loc> of each <url> or <sitemap> entry, not the ones of extensions like images
+        locations = [
+            element.text.strip()
+            for entry in root
+            for element in entry
+            if _get_local_name(element.tag) == "loc" and element.text
+        ]
+        if _get_local_name(root.tag) != "sitemapindex":
+            return locations
+
+        urls = []
+        for location in locations:
+            urls.extend(self.get_urls_from_sitemap(location))
+        return urls
+
+    def get_urls_from_file(self, url_list: str) -> List[str]:
+        """
+        Returns the URLs of a file with one URL per line, skipping empty lines and # comments.
+        """
+        with open(url_list, "r") as f:
+            return [
+                line.strip()
+                for line in f
+                if line.strip() and not line.strip().startswith("#")
+            ]
+
+    def get_pages_from_mirror(self, mirror_dir: str, base_url: str = None) -> List:
+        """
+        Returns (url, path) tuples for the HTML files of a local mirror of a site, in a stable
+        order. The url is the path relative to mirror_dir, joined to base_url when it is set.
+        """
+        pages = []
+        for directory, _, files in os.walk(mirror_dir):
+            for file in files:
+                if file.lower().endswith(HTML_FILE_EXTENSIONS):
+                    path = os.path.join(directory, file)
+                    relative_path = os.path.relpath(path, mirror_dir).replace(
+                        os.sep, "/"
+                    )
+                    url = (
+                        f"{base_url.rstrip('/')}/{relative_path}" if base_url else path
+                    )
+                    pages.append((url, path))
+        return sorted(pages)
+
+    def get_rows(
+        self,
+        pages,
+        html_filter: HtmlFilter,
+        workers: int = 4,
+        metrics: CrawlMetrics = None,
+        near_duplicate_distance: int = DEFAULT_NEAR_DUPLICATE_DISTANCE,
+    ):
+        """
+        Yields the (text, metadata) rows of pages, in the order of the pages, while the next
+        pages are fetched and parsed. At most twice as many pages as workers are in flight,
+        so the crawl runs ahead of the consumer of the rows, like the indexing of a batch,
+        by that many pages only. Pages that can not be fetched or parsed are reported and
+        skipped.
+
+        A page is a near duplicate of a page before it when the SimHash fingerprints of
+        their shingles of SHINGLE_WORDS words, ignoring case and punctuation, differ by at
+        most near_duplicate_distance of their FINGERPRINT_BITS bits. 0 only skips pages
+        with the same words.
+
+        Parameters:
+            pages: An iterable of URLs, or of (url, location) tuples to read a page from
+                another location than its URL, like a file of a mirror.
+            html_filter: The HTML elements to take the text of the pages from.
+            workers: The number of pages fetched and parsed at the same time.
+            metrics: Where to record the throughput of each stage.
+            near_duplicate_distance: The number of bits two fingerprints may differ by.
+        """
+        metrics = metrics or CrawlMetrics()
+        remaining_pages = iter(pages)
+        futures = deque()
+        near_duplicates = NearDuplicateIndex(near_duplicate_distance)
+
+        with (
+            ThreadPoolExecutor(max_workers=workers) as fetch_executor,
+            ProcessPoolExecutor(max_workers=workers) as parse_executor,
+        ):
+
+            def crawl_next_page():
+                page = next(remaining_pages, None)
+                if page is not None:
+                    url, location = page if isinstance(page, tuple) else (page, page)
+                    futures.append(
+                        fetch_executor.submit(
+                            self._crawl_page,
+                            parse_executor,
+                            url,
+                            location,
+                            html_filter,
+                            metrics,
+                        )
+                    )
+
+            for _ in range(workers * 2):
+                crawl_next_page()
+
+            while futures:
+                row = futures.popleft().result()
+                crawl_next_page()
+                if row is None:
+                    continue
+
+                text, metadata, fingerprint = row
+                if not near_duplicates.add(fingerprint):
+                    metrics.record("dedup")
+                    continue
+
+                metrics.record("index", byte_count=len(text.encode("utf-8")))
+                yield text, metadata
+
+    def _crawl_page(self, parse_executor, url, location, html_filter, metrics):
+        started_at = time.monotonic()
+        try:
+            html = self._read_location(location)
+        except Exception as e:
+            print(f"Could not fetch {location}: {e}")
+            metrics.record_failure("fetch")
+            return None
+        metrics.record(
+            "fetch", byte_count=len(html), seconds=time.monotonic() - started_at
+        )
+
+        try:
+            text, metadata, fingerprint, seconds = parse_executor.submit(
+                _parse_page, self.page_helper, url, html, html_filter
+            ).result()
+        except Exception as e:
+            print(f"Could not parse {url}: {e}")
+            metrics.record_failure("parse")
+            return None
+        metrics.record("parse", seconds=seconds)
+
+        if not text.strip():
+            return None
+
+        return text, {**metadata, "source": url}, fingerprint
+
+
+def _parse_page(page_helper: PageHelper, url: str, html: bytes, html_filter):
+    """
+    Parses a page into its text, metadata and fingerprint, in a worker process.
+    """
+    started_at = time.monotonic()
+    page_data = PageData(url=url, content=BeautifulSoup(html, "html.parser"))
+    document = page_helper.get_article(page_data, html_filter)
+    return (
+        document.page_content,
+        document.metadata,
+        _fingerprint_page_text(document.page_content),
+        time.monotonic() - started_at,
+    )
+
+
+def _read_location(location: str) -> bytes:
+    if location.startswith(("http://", "https://")):
+        request = urllib.request.Request(location, headers={"User-Agent": USER_AGENT})
+        with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT_SECONDS) as response:
+            return response.read()
+
+    with open(location, "rb") as f:
+        return f.read()
+
+
+def _get_local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _fingerprint_page_text(text: str) -> int:
+    """
+    Returns the SimHash of the shingles of a text: each bit is set when most of the
+    shingles have it set in their own hash, so texts that share most of their shingles
+    have fingerprints that differ by a few bits.
+    """
+    words = re.findall(r"\w+", text.lower())
+    shingles = {
+        " ".join(words[i : i + SHINGLE_WORDS])
+        for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))
+    }
+    weights = [0] * FINGERPRINT_BITS
+    for shingle in shingles:
+        shingle_hash = int.from_bytes(
+            hashlib.blake2b(
+                shingle.encode("utf-8"), digest_size=FINGERPRINT_BITS // 8
+            ).digest(),
+            "big",
+        )
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += 1 if shingle_hash >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
@@ -0,0 +1,408 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import io
+import json
+import os
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+INDEX_FILE = "index.faiss"
+PICKLED_DOCSTORE_FILE = "index.pkl"
+COMPACT_DOCSTORE_TEXT_FILE = "docstore_text.bin"
+COMPACT_DOCSTORE_OFFSETS_FILE = "docstore_offsets.npy"
+COMPACT_DOCSTORE_METADATA_FILE = "docstore_metadata.json"
+COMPACT_DOCSTORE_METADATA_LOG_FILE = "docstore_metadata.jsonl"
+COMPACT_DOCSTORE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 2
+PROGRESS_FILE = "progress.json"
+
+
+def save_knowledge_base(db: FAISS, output_dir: str):
+    """
+    Saves a FAISS store as a knowledge base folder with a compact docstore:
+    - index.faiss: the vector index
+    - docstore_text.bin: the UTF-8 text of all chunks, concatenated
+    - docstore_offsets.npy: one (start, end, metadata id) row per chunk, in index order
+    - docstore_metadata.json: the table of distinct metadata dictionaries
+
+    Parameters:
+        db: The FAISS store to save.
+        output_dir: The .kb folder to write to, created if it does not exist.
+    """
+    KnowledgeBaseWriter(output_dir).save(db)
+
+
+class KnowledgeBaseWriter:
+    """
+    Saves a FAISS store that only grows, like the one of an ingestion, to a knowledge base
+    folder again and again. The first save writes the whole folder, like
+    save_knowledge_base. The next ones append the text and offsets of the chunks added
+    since to the docstore, and the metadata dictionaries that are new to
+    docstore_metadata.jsonl, so they write the new chunks only, apart from the vector
+    index. close rewrites docstore_metadata.json with the appended metadata.
+
+    Chunks saved before may not be deleted or changed between two saves, use
+    save_knowledge_base after deleting chunks.
+
+    Attributes:
+        output_dir (str): The .kb folder to write to, created if it does not exist.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self._saved_count = None
+        self._text_size = 0
+        self._metadata_table = []
+        self._metadata_ids = {}
+        self._has_metadata_log = False
+
+    def save(self, db: FAISS):
+        if self._saved_count is None:
+            self._write(db)
+        else:
+            self._append(db)
+
+    def close(self):
+        if not self._has_metadata_log:
+            return
+
+        metadata_path = self._write_metadata_table()
+        os.replace(f"{metadata_path}.tmp", metadata_path)
+        os.remove(self._get_path(COMPACT_DOCSTORE_METADATA_LOG_FILE))
+        self._has_metadata_log = False
+
+    def _write(self, db: FAISS):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._metadata_table = []
+        self._metadata_ids = {}
+
+        # Every file is written next to the one it replaces, and only moved into place once
+        # all of them are written, so an interrupted save leaves the previous knowledge base
+        # intact
+        text_path = self._get_path(COMPACT_DOCSTORE_TEXT_FILE)
+        with open(f"{text_path}.tmp", "wb") as f:
+            offsets = self._write_texts(f, _get_documents(db, 0), 0)
+
+        offsets_path = self._get_path(COMPACT_DOCSTORE_OFFSETS_FILE)
+        with open(f"{offsets_path}.tmp", "wb") as f:
+            np.save(f, np.array(offsets, dtype=np.int64).reshape(-1, 3))
+        metadata_path = self._write_metadata_table()
+        index_path = self._write_index(db)
+
+        # The index goes last: a folder without one has no knowledge base yet
+        for path in [text_path, offsets_path, metadata_path, index_path]:
+            os.replace(f"{path}.tmp", path)
+
+        # A log of an interrupted ingestion, or a docstore pickled by an earlier version,
+        # would no longer match the index
+        for file in [COMPACT_DOCSTORE_METADATA_LOG_FILE, PICKLED_DOCSTORE_FILE]:
+            if os.path.exists(self._get_path(file)):
+                os.remove(self._get_path(file))
+
+        self._saved_count = db.index.ntotal
+        self._has_metadata_log = False
+
+    def _append(self, db: FAISS):
+        documents = _get_documents(db, self._saved_count)
+        if len(documents) == 0:
+            return
+
+        # The files only grow: bytes and rows beyond the ones the saved offsets and index
+        # refer to are the leftovers of an interrupted save, and are overwritten
+        metadata_count = len(self._metadata_table)
+        with open(self._get_path(COMPACT_DOCSTORE_TEXT_FILE), "r+b") as f:
+            f.seek(self._text_size)
+            f.truncate()
+            offsets = self._write_texts(f, documents, self._text_size)
+
+        new_metadata = self._metadata_table[metadata_count:]
+        if len(new_metadata) > 0:
+            with open(self._get_path(COMPACT_DOCSTORE_METADATA_LOG_FILE), "a") as f:
+                for metadata in new_metadata:
+                    f.write(json.dumps(metadata) + "\n")
+            self._has_metadata_log = True
+
+        _append_offsets(
+            self._get_path(COMPACT_DOCSTORE_OFFSETS_FILE), self._saved_count, offsets
+        )
+        index_path = self._write_index(db)
+        os.replace(f"{index_path}.tmp", index_path)
+
+        self._saved_count = db.index.ntotal
+
+    def _write_texts(self, f, documents: list, position: int) -> list:
+        offsets = []
+        for document in documents:
+            encoded_text = document.page_content.encode("utf-8")
+            f.write(encoded_text)
+
+            metadata_key = json.dumps(document.metadata, sort_keys=True, default=str)
+            if metadata_key not in self._metadata_ids:
+                self._metadata_ids[metadata_key] = len(self._metadata_table)
+                self._metadata_table.append(json.loads(metadata_key))
+
+            offsets.append(
+                (
+                    position,
+                    position + len(encoded_text),
+                    self._metadata_ids[metadata_key],
+                )
+            )
+            position += len(encoded_text)
+
+        self._text_size = position
+        return offsets
+
+    def _write_metadata_table(self) -> str:
+        metadata_path = self._get_path(COMPACT_DOCSTORE_METADATA_FILE)
+        with open(f"{metadata_path}.tmp", "w") as f:
+            json.dump(
+                {"version": COMPACT_DOCSTORE_VERSION, "metadata": self._metadata_table},
+                f,
+            )
+        return metadata_path
+
+    def _write_index(self, db: FAISS) -> str:
+        index_path = self._get_path(INDEX_FILE)
+        faiss.write_index(db.index, f"{index_path}.tmp")
+        return index_path
+
+    def _get_path(self, file: str) -> str:
+        return os.path.join(self.output_dir, file)
+
+
+def _get_documents(db: FAISS, start: int) -> list:
+    return [
+        db.docstore.search(db.index_to_docstore_id[position])
+        for position in range(start, db.index.ntotal)
+    ]
+
+
+def _append_offsets(offsets_path: str, saved_count: int, offsets: list):
+    """
+    Appends rows to the (n, 3) array of an .npy file after its first saved_count rows, and
+    updates the shape in its header. numpy pads the header so that the shape can grow in
+    place, the rows are written before the header so that the file stays readable.
+    """
+    rows = np.array(offsets, dtype=np.int64).reshape(-1, 3)
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        header,
+        {
+            "descr": np.lib.format.dtype_to_descr(rows.dtype),
+            "fortran_order": False,
+            "shape": (saved_count + len(rows), 3),
+        },
+    )
+
+    with open(offsets_path, "r+b") as f:
+        if np.lib.format.read_magic(f) != (1, 0):
+            raise ValueError(f"unsupported offsets file {offsets_path}")
+        np.lib.format.read_array_header_1_0(f)
+        data_start = f.tell()
+        if len(header.getvalue()) != data_start:
+            raise ValueError(f"the offsets header of {offsets_path} can not grow")
+
+        f.seek(data_start + saved_count * rows.itemsize * 3)
+        f.truncate()
+        f.write(rows.tobytes())
+        f.seek(0)
+        f.write(header.getvalue())
+
+
+def load_knowledge_base(output_dir: str, embeddings) -> FAISS:
+    """
+    Loads a knowledge base folder, with a compact docstore or with the pickled
+    docstore written by earlier versions of the CLI.
+
+    Parameters:
+        output_dir: The .kb folder to read from.
+        embeddings: The embeddings the knowledge base was created with.
+
+    Returns:
+        The FAISS store, or None if there is no knowledge base in the folder.
+    """
+    if not os.path.exists(os.path.join(output_dir, INDEX_FILE)):
+        return None
+
+    if not os.path.exists(os.path.join(output_dir, COMPACT_DOCSTORE_OFFSETS_FILE)):
+        return FAISS.load_local(
+            output_dir, embeddings, allow_dangerous_deserialization=True
+        )
+
+    with open(os.path.join(output_dir, COMPACT_DOCSTORE_METADATA_FILE), "r") as f:
+        metadata_file = json.load(f)
+    if metadata_file.get("version") != COMPACT_DOCSTORE_VERSION:
+        raise ValueError(
+            f"unsupported docstore version {metadata_file.get('version')} in {output_dir}"
+        )
+
+    metadata_table = metadata_file["metadata"]
+    metadata_log_path = os.path.join(output_dir, COMPACT_DOCSTORE_METADATA_LOG_FILE)
+    if os.path.exists(metadata_log_path):
+        metadata_table = metadata_table + _read_metadata_log(metadata_log_path)
+
+    index = faiss.read_index(os.path.join(output_dir, INDEX_FILE))
+    # Offsets beyond the index were appended by a save that was interrupted
+    offsets = np.load(os.path.join(output_dir, COMPACT_DOCSTORE_OFFSETS_FILE))[
+        : index.ntotal
+    ]
+    with open(os.path.join(output_dir, COMPACT_DOCSTORE_TEXT_FILE), "rb") as f:
+        text = f.read()
+
+    documents = {
+        str(position): Document(
+            page_content=text[start:end].decode("utf-8"),
+            metadata=dict(metadata_table[metadata_id]),
+        )
+        for position, (start, end, metadata_id) in enumerate(offsets)
+    }
+
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(documents),
+        index_to_docstore_id={
+            position: str(position) for position in range(len(documents))
+        },
+    )
+
+
+def _read_metadata_log(metadata_log_path: str) -> list:
+    metadata_table = []
+    with open(metadata_log_path, "r") as f:
+        for line in f:
+            try:
+                metadata_table.append(json.loads(line))
+            except json.JSONDecodeError:
+                # The last line of a save that was interrupted, no chunk refers to it
+                break
+    return metadata_table
+
+
+def hash_document(document: Document) -> str:
+    """
+    Returns a hash of the text and metadata of a chunk, that identifies it across indexing runs.
+    """
+    content = json.dumps(
+        [document.page_content, document.metadata], sort_keys=True, default=str
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_manifest_source(source: str, output_dir: str) -> str:
+    """
+    Returns the key of a source in the manifest and progress of a knowledge base folder:
+    the path of a local file or folder relative to the knowledge base folder, so that
+    "./docs/a.pdf" and "docs/a.pdf", or the same file indexed from another directory, are
+    the same source. URLs are kept as they are.
+    """
+    if source is None or "://" in source:
+        return source
+
+    try:
+        path = os.path.relpath(os.path.abspath(source), os.path.abspath(output_dir))
+    except ValueError:
+        # On Windows, a file on another drive than the knowledge base folder
+        path = os.path.abspath(source)
+    return path.replace(os.sep, "/")
+
+
+def load_manifest(output_dir: str, db: FAISS) -> dict:
+    """
+    Loads the manifest of a knowledge base folder: the hash of every chunk in the index and
+    the source it was indexed from. Chunks of knowledge bases that were saved without a
+    manifest, or with an outdated one, are hashed from the docstore and have no source.
+
+    Parameters:
+        output_dir: The .kb folder to read from.
+        db: The FAISS store loaded from the folder.
+
+    Returns:
+        A dictionary from docstore id to a {"hash", "source"} dictionary, with the source
+        as returned by get_manifest_source.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    chunks = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest_file = json.load(f)
+        if (
+            manifest_file.get("version") in (1, MANIFEST_VERSION)
+            and len(manifest_file["chunks"]) == db.index.ntotal
+        ):
+            chunks = manifest_file["chunks"]
+        if chunks is not None and manifest_file["version"] == 1:
+            # Sources were saved as they were given, relative to the working directory
+            for chunk in chunks:
+                chunk["source"] = get_manifest_source(chunk["source"], output_dir)
+
+    if chunks is None:
+        chunks = [
+            {
+                "hash": hash_document(
+                    db.docstore.search(db.index_to_docstore_id[position])
+                ),
+                "source": None,
+            }
+            for position in range(db.index.ntotal)
+        ]
+
+    return {
+        db.index_to_docstore_id[position]: chunk
+        for position, chunk in enumerate(chunks)
+    }
+
+
+def save_manifest(output_dir: str, db: FAISS, chunks_by_id: dict):
+    """
+    Saves the manifest of a knowledge base folder, with the chunks in index order.
+
+    Parameters:
+        output_dir: The .kb folder to write to.
+        db: The FAISS store that was saved to the folder.
+        chunks_by_id: A dictionary from docstore id to a {"hash", "source"} dictionary.
+    """
+    chunks = [
+        chunks_by_id[db.index_to_docstore_id[position]]
+        for position in range(db.index.ntotal)
+    ]
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "chunks": chunks}, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def load_progress(output_dir: str, source: str) -> int:
+    """
+    Returns the number of rows of a source that were indexed and saved to a knowledge base
+    folder by an ingestion that did not finish, 0 if there is none.
+    """
+    progress_path = os.path.join(output_dir, PROGRESS_FILE)
+    if not os.path.exists(progress_path):
+        return 0
+
+    with open(progress_path, "r") as f:
+        progress = json.load(f)
+    return progress["rows"] if progress.get("source") == source else 0
+
+
+def save_progress(output_dir: str, source: str, rows: int):
+    """
+    Records that the first rows of a source are indexed and saved to a knowledge base folder.
+    """
+    progress_path = os.path.join(output_dir, PROGRESS_FILE)
+    with open(f"{progress_path}.tmp", "w") as f:
+        json.dump({"source": source, "rows": rows}, f)
+    os.replace(f"{progress_path}.tmp", progress_path)
+
+
+def remove_progress(output_dir: str):
+    progress_path = os.path.join(output_dir, PROGRESS_FILE)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
@@ -0,0 +1,318 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from haiven_cli.models.embedding_model import EmbeddingModel
+from haiven_cli.services.token_service import TokenService
+
+# Request size limits of the embedding APIs, per provider
+PROVIDER_BATCH_LIMITS = {
+    "openai": {"max_batch_size": 2048, "max_batch_tokens": 250000},
+    "azure": {"max_batch_size": 16, "max_batch_tokens": 100000},
+    # Bedrock embeds one text per request
+    "aws": {"max_batch_size": 1, "max_batch_tokens": 8000},
+    "ollama": {"max_batch_size": 32, "max_batch_tokens": 64000},
+}
+DEFAULT_BATCH_LIMITS = {"max_batch_size": 16, "max_batch_tokens": 8000}
+
+
+class RateLimiter:
+    """
+    Keeps the requests and tokens sent in the last minute under a budget. A budget of None
+    is not limited. A single request with more tokens than the budget is sent alone.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = None,
+        tokens_per_minute: int = None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._clock = clock
+        self._sleep = sleep
+        self._sent = deque()
+        self._sent_tokens = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        while True:
+            with self._lock:
+                now = self._clock()
+                while self._sent and self._sent[0][0] <= now - 60:
+                    _, sent_tokens = self._sent.popleft()
+                    self._sent_tokens -= sent_tokens
+
+                if self._has_budget_for(tokens):
+                    self._sent.append((now, tokens))
+                    self._sent_tokens += tokens
+                    return
+
+                wait_seconds = self._sent[0][0] + 60 - now
+
+            self._sleep(max(wait_seconds, 0.01))
+
+    def _has_budget_for(self, tokens: int) -> bool:
+        if not self._sent:
+            return True
+
+        if self.requests_per_minute and len(self._sent) >= self.requests_per_minute:
+            return False
+
+        if (
+            self.tokens_per_minute
+            and self._sent_tokens + tokens > self.tokens_per_minute
+        ):
+            return False
+
+        return True
+
+
+class EmbeddingBatcher:
+    """
+    Embeds texts in batches sized by token count, sending up to max_concurrent_requests
+    batches at the same time under a requests and tokens per minute budget. Batches that
+    fail with a rate limit, server, timeout or connection error are retried with exponential
+    backoff, other errors are raised at once. Finished embeddings are appended to a checkpoint
+    file, so that embedding the same texts again after a failure only embeds what is missing.
+
+    Attributes:
+        embeddings (Embeddings): The embeddings to embed the texts with.
+        token_service (TokenService): Counts the tokens of the texts.
+        max_batch_size (int): The maximum number of texts in a request.
+        max_batch_tokens (int): The maximum number of tokens in a request.
+        max_concurrent_requests (int): The number of requests that are sent at the same time.
+        max_retries (int): The number of times a failed request is retried.
+        initial_backoff_seconds (float): The wait before the first retry, doubled for every next retry.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        token_service: TokenService,
+        max_batch_size: int = 16,
+        max_batch_tokens: int = 8000,
+        max_concurrent_requests: int = 4,
+        requests_per_minute: int = None,
+        tokens_per_minute: int = None,
+        max_retries: int = 5,
+        initial_backoff_seconds: float = 1.0,
+        sleep=time.sleep,
+    ):
+        self.embeddings = embeddings
+        self.token_service = token_service
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_retries = max_retries
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.rate_limiter = RateLimiter(
+            requests_per_minute, tokens_per_minute, sleep=sleep
+        )
+        self._sleep = sleep
+        self._checkpoint_lock = threading.Lock()
+
+    @classmethod
+    def from_model(
+        cls,
+        model: EmbeddingModel,
+        embeddings: Embeddings,
+        token_service: TokenService,
+    ):
+        """
+        Creates a batcher with the request size limits of the model provider. Each limit can
+        be set in the model config, along with the requests_per_minute and tokens_per_minute
+        budget, max_concurrent_requests and max_retries.
+        """
+        limits = dict(
+            PROVIDER_BATCH_LIMITS.get(
+                (model.provider or "").lower(), DEFAULT_BATCH_LIMITS
+            )
+        )
+        for key in [
+            "max_batch_size",
+            "max_batch_tokens",
+            "max_concurrent_requests",
+            "requests_per_minute",
+            "tokens_per_minute",
+            "max_retries",
+        ]:
+            value = model.config.get(key)
+            if value is not None and value != "":
+                limits[key] = int(value)
+
+        return cls(embeddings, token_service, **limits)
+
+    def embed_documents(
+        self, texts: List[str], checkpoint_path: str = None
+    ) -> List[List[float]]:
+        """
+        Embeds the texts.
+
+        Parameters:
+            texts: The texts to embed.
+            checkpoint_path: A file to keep the finished embeddings in until they are saved, see
+                remove_checkpoint. Embeddings found in it are not requested again.
+
+        Returns:
+            The embeddings, in the order of the texts.
+        """
+        text_hashes = [_hash_text(text) for text in texts]
+        embeddings_by_hash = _load_checkpoint(checkpoint_path)
+
+        missing_texts = {}
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in embeddings_by_hash:
+                missing_texts.setdefault(text_hash, text)
+
+        if len(missing_texts) > 0:
+            batches = self._create_batches(list(missing_texts.items()))
+            print(
+                f"Embedding {len(missing_texts)} texts in {len(batches)} batches,",
+                f"{len(embeddings_by_hash)} embeddings found in checkpoint...",
+            )
+            with ThreadPoolExecutor(
+                max_workers=self.max_concurrent_requests
+            ) as executor:
+                futures = [
+                    executor.submit(self._embed_batch, batch, tokens, checkpoint_path)
+                    for batch, tokens in batches
+                ]
+                for future in futures:
+                    embeddings_by_hash.update(future.result())
+
+        return [embeddings_by_hash[text_hash] for text_hash in text_hashes]
+
+    def _create_batches(self, hashed_texts: List[tuple]) -> List[tuple]:
+        token_counts = self.token_service.get_tokens_lengths(
+            [text for _, text in hashed_texts]
+        )
+
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for hashed_text, tokens in zip(hashed_texts, token_counts):
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or batch_tokens + tokens > self.max_batch_tokens
+            ):
+                batches.append((batch, batch_tokens))
+                batch = []
+                batch_tokens = 0
+
+            batch.append(hashed_text)
+            batch_tokens += tokens
+
+        if batch:
+            batches.append((batch, batch_tokens))
+
+        return batches
+
+    def _embed_batch(self, batch: List[tuple], tokens: int, checkpoint_path: str):
+        texts = [text for _, text in batch]
+
+        retries = 0
+        while True:
+            self.rate_limiter.acquire(tokens)
+            try:
+                vectors = self.embeddings.embed_documents(texts)
+                break
+            except Exception as e:
+                if retries >= self.max_retries or not _is_retryable(e):
+                    raise
+
+                backoff_seconds = self.initial_backoff_seconds * (2**retries)
+                backoff_seconds += random.uniform(0, backoff_seconds / 2)
+                retries += 1
+                print(
+                    f"Embedding request failed ({e}), retry {retries} of",
+                    f"{self.max_retries} in {backoff_seconds:.1f}s",
+                )
+                self._sleep(backoff_seconds)
+
+        embeddings_by_hash = {
+            text_hash: vector for (text_hash, _), vector in zip(batch, vectors)
+        }
+        if checkpoint_path is not None:
+            with self._checkpoint_lock:
+                _append_to_checkpoint(checkpoint_path, embeddings_by_hash)
+
+        return embeddings_by_hash
+
+
+def remove_checkpoint(checkpoint_path: str):
+    """
+    Removes the checkpoint of embed_documents, once its embeddings are saved elsewhere.
+    """
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """
+    Returns whether a failed embedding request can succeed when sent again: the provider
+    answered with a rate limit (429) or server (5xx) error, or the request timed out or
+    could not connect.
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        response = getattr(error, "response", None)
+        if isinstance(response, dict):
+            # botocore errors
+            status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        else:
+            status_code = getattr(response, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code == 429 or status_code >= 500
+
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+
+    # The clients of the providers (openai, httpx, requests, botocore) have their own
+    # timeout and connection errors
+    return any(
+        "Timeout" in error_class.__name__ or "Connection" in error_class.__name__
+        for error_class in type(error).__mro__
+    )
+
+
+def _hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _load_checkpoint(checkpoint_path: str) -> dict:
+    embeddings_by_hash = {}
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return embeddings_by_hash
+
+    complete_length = 0
+    with open(checkpoint_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            entry = json.loads(line)
+            embeddings_by_hash[entry["hash"]] = entry["embedding"]
+            complete_length += len(line)
+
+    # The last line is cut off when the previous run was interrupted while writing it
+    if complete_length < os.path.getsize(checkpoint_path):
+        os.truncate(checkpoint_path, complete_length)
+
+    return embeddings_by_hash
+
+
+def _append_to_checkpoint(checkpoint_path: str, embeddings_by_hash: dict):
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    with open(checkpoint_path, "a") as f:
+        for text_hash, vector in embeddings_by_hash.items():
+            f.write(json.dumps({"hash": text_hash, "embedding": list(vector)}) + "\n")
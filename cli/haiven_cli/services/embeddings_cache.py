@@ -0,0 +1,177 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from haiven_cli.models.embedding_model import EmbeddingModel
+
+
+class EmbeddingsCache:
+    """
+    Keeps embeddings in a SQLite file, by embedding model id and hash of the embedded text,
+    so that a text is only sent to the embedding provider once, across files and runs.
+    Vectors are stored as float32, the precision FAISS keeps them in.
+
+    Attributes:
+        path (str): The SQLite file, created if it does not exist.
+        hits (int): The number of texts whose embedding was found in the cache.
+        misses (int): The number of texts that had to be embedded.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections can not be pickled, processes that receive the cache open their own
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_many(self, model_id: str, text_hashes: List[str]) -> Dict[str, List[float]]:
+        vectors = {}
+        with self._lock:
+            connection = self._get_connection()
+            unique_hashes = list(dict.fromkeys(text_hashes))
+            # SQLite limits the number of parameters of a statement
+            for start in range(0, len(unique_hashes), 500):
+                hashes = unique_hashes[start : start + 500]
+                rows = connection.execute(
+                    "SELECT text_hash, vector FROM embeddings WHERE model_id = ?"
+                    f" AND text_hash IN ({','.join('?' * len(hashes))})",
+                    [model_id, *hashes],
+                )
+                for text_hash, vector in rows:
+                    vectors[text_hash] = np.frombuffer(
+                        vector, dtype=np.float32
+                    ).tolist()
+
+            self.hits += len(vectors)
+            self.misses += len(unique_hashes) - len(vectors)
+
+        return vectors
+
+    def put_many(self, model_id: str, vectors: Dict[str, List[float]]):
+        with self._lock:
+            connection = self._get_connection()
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model_id, text_hash, vector) VALUES (?, ?, ?)",
+                [
+                    (
+                        model_id,
+                        text_hash,
+                        np.asarray(vector, dtype=np.float32).tobytes(),
+                    )
+                    for text_hash, vector in vectors.items()
+                ],
+            )
+            connection.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(os.path.expanduser(self.path))
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(
+                os.path.expanduser(self.path), check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model_id TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL,"
+                " PRIMARY KEY (model_id, text_hash)) WITHOUT ROWID"
+            )
+        return self._connection
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings that look texts up in an EmbeddingsCache before embedding them with the
+    wrapped embeddings. Queries are not cached, they are embedded when searching.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingsCache, model_id: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_id = model_id
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_documents_with(texts, self.embeddings.embed_documents)
+
+    def embed_documents_with(
+        self,
+        texts: List[str],
+        embed_documents: Callable[[List[str]], List[List[float]]],
+    ) -> List[List[float]]:
+        """
+        Looks the texts up in the cache, and embeds only the texts that are missing with
+        embed_documents, like an EmbeddingBatcher that batches and rate limits the requests
+        for the wrapped embeddings.
+        """
+        text_hashes = [_hash_text(text) for text in texts]
+        vectors = self.cache.get_many(self.model_id, text_hashes)
+
+        missing_texts = {}
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in vectors:
+                missing_texts.setdefault(text_hash, text)
+
+        if len(missing_texts) > 0:
+            missing_vectors = dict(
+                zip(
+                    missing_texts.keys(),
+                    embed_documents(list(missing_texts.values())),
+                )
+            )
+            self.cache.put_many(self.model_id, missing_vectors)
+            vectors.update(missing_vectors)
+
+        return [vectors[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+
+class CachedEmbeddingService:
+    """
+    Loads embeddings with an embedding service, and wraps them to use an EmbeddingsCache.
+    """
+
+    def __init__(self, embedding_service, cache: EmbeddingsCache):
+        self.embedding_service = embedding_service
+        self.cache = cache
+
+    def load_embeddings(self, model: EmbeddingModel) -> Embeddings:
+        return CachedEmbeddings(
+            self.embedding_service.load_embeddings(model), self.cache, model.id
+        )
+
+
+def _hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
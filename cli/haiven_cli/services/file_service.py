@@ -1,59 +1,160 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
 import csv
+import itertools
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from pypdf import PdfReader
 from typing import List
 
+# Characters that are joined when a single space separates them
+_SPACED_CHARACTER = r"[\w,.’\-():]"
+# A run of such characters separated by single spaces, like the text of scanned PDFs often is.
+# The lookbehind and possessive quantifiers keep the scan linear, and each run is joined in
+# a single substitution rather than one substitution per space.
+_SPACED_RUN_PATTERN = re.compile(
+    rf"(?<!{_SPACED_CHARACTER}){_SPACED_CHARACTER}++(?: {_SPACED_CHARACTER}++)+"
+)
+
 
 class FileService:
     def clean_text_with_spaces_between_characters(self, text: str):
-        # Replace two spaces with one space, then remove spaces between characters and specified punctuation
-        text = re.sub(r"(?<=[\w,.’\-():]) (?=[\w,.’\-():])", "", text)
-        text = re.sub(r"  ", " ", text)
-        return text
+        # Remove spaces between characters and specified punctuation, then replace two spaces with one space
+        text = _SPACED_RUN_PATTERN.sub(_join_spaced_run, text)
+        return text.replace("  ", " ")
 
-    def get_text_and_metadata_from_pdf(self, pdf_file, pdf_source_link=None):
+    def get_text_and_metadata_from_pdf(
+        self, pdf_file, pdf_source_link=None, clean_text=False
+    ):
         text = []
         metadatas = []
+        for page_text, metadata_for_page in self.get_pages_from_pdf(
+            pdf_file, pdf_source_link, clean_text=clean_text
+        ):
+            text.append(page_text)
+            metadatas.append(metadata_for_page)
+        return text, metadatas
+
+    def get_pages_from_pdf(
+        self,
+        pdf_file,
+        pdf_source_link=None,
+        first_page=0,
+        last_page=None,
+        clean_text=False,
+    ):
+        """
+        Yields the text and metadata of the pages of a PDF one at a time, so that a page
+        can be processed before the next one is extracted.
+
+        Parameters:
+            pdf_file: The opened PDF file.
+            pdf_source_link: The source to set in the metadata, the file name by default.
+            first_page: The index of the first page to extract.
+            last_page: The index of the page to stop before, the end of the file by default.
+            clean_text: Whether to remove the spaces between characters of each page, see
+                clean_text_with_spaces_between_characters.
+        """
         pdf_reader = PdfReader(pdf_file)
         pdf_file_base_name = os.path.basename(pdf_file.name)
 
-        page_number = 1
         pdf_title = _get_pdf_title(pdf_reader, pdf_file_base_name)
         pdf_authors = _get_pdf_authors(pdf_reader)
         pdf_source = pdf_source_link or pdf_file_base_name
 
-        for page in pdf_reader.pages:
-            text.append(page.extract_text())
+        pages = pdf_reader.pages
+        last_page = len(pages) if last_page is None else min(last_page, len(pages))
+        for page_index in range(first_page, last_page):
             metadata_for_page = {
-                "page": page_number,
+                "page": page_index + 1,
                 "source": pdf_source,
                 "title": pdf_title,
                 "authors": pdf_authors,
             }
-            metadatas.append(metadata_for_page)
-            page_number += 1
-        return text, metadatas
+            page_text = pages[page_index].extract_text()
+            if clean_text:
+                page_text = self.clean_text_with_spaces_between_characters(page_text)
+            yield page_text, metadata_for_page
+
+    def get_pages_from_pdf_in_parallel(
+        self,
+        pdf_path: str,
+        pdf_source_link=None,
+        workers=2,
+        pages_per_range=25,
+        clean_text=False,
+    ):
+        """
+        Yields the text and metadata of the pages of a PDF in order, while ranges of
+        pages_per_range pages are extracted in worker processes. Each worker reads only its
+        own range, and at most twice as many ranges as workers are extracted ahead of the
+        pages that were yielded.
+        """
+        with open(pdf_path, "rb") as pdf_file:
+            page_count = len(PdfReader(pdf_file).pages)
+
+        page_ranges = iter(
+            [
+                (first_page, min(first_page + pages_per_range, page_count))
+                for first_page in range(0, page_count, pages_per_range)
+            ]
+        )
+        futures = deque()
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+
+            def extract_next_range():
+                page_range = next(page_ranges, None)
+                if page_range is not None:
+                    futures.append(
+                        executor.submit(
+                            _get_pdf_page_range,
+                            pdf_path,
+                            pdf_source_link,
+                            *page_range,
+                            clean_text,
+                        )
+                    )
+
+            for _ in range(workers * 2):
+                extract_next_range()
+
+            while futures:
+                pages = futures.popleft().result()
+                extract_next_range()
+                yield from pages
 
     def get_text_and_metadata_from_csv(self, csv_file):
         text = []
         metadatas = []
+        for row_text, metadata in self.get_rows_from_csv(csv_file):
+            text.append(row_text)
+            metadatas.append(metadata)
+        return text, metadatas
+
+    def get_rows_from_csv(self, csv_file, start_row=0):
+        """
+        Yields the text and metadata of the rows of a CSV file one at a time, so that files
+        larger than memory can be indexed.
 
+        Parameters:
+            csv_file: The path of the CSV file.
+            start_row: The number of rows to skip, not counting the header row.
+        """
         with open(csv_file, "r") as file:
             csv_reader = csv.DictReader(file)
 
-            for row in csv_reader:
-                text.append(row["content"])
-                metadatas.append(
+            for row in itertools.islice(csv_reader, start_row, None):
+                yield (
+                    row["content"],
                     {
                         "source": row["metadata.source"],
                         "title": row["metadata.title"],
                         "authors": row["metadata.authors"],
-                    }
+                    },
                 )
-        return text, metadatas
 
     def get_text_and_metadata_from_txts(self, txt_file_directory, authors="Unknown"):
         text = []
@@ -122,6 +223,19 @@ title: Context
         os.makedirs(f"{kp_root_dir}/contexts/{context_name}/embeddings", exist_ok=True)
 
 
+def _get_pdf_page_range(pdf_path, pdf_source_link, first_page, last_page, clean_text):
+    with open(pdf_path, "rb") as pdf_file:
+        return list(
+            FileService().get_pages_from_pdf(
+                pdf_file, pdf_source_link, first_page, last_page, clean_text
+            )
+        )
+
+
+def _join_spaced_run(match) -> str:
+    return match.group().replace(" ", "")
+
+
 def _get_pdf_title(pdf_reader, source):
     if not pdf_reader.metadata or not pdf_reader.metadata.title:
         source_name = os.path.basename(source)
@@ -1,8 +1,27 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import itertools
+import threading
+
 from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from haiven_cli.services.docstore_service import (
+    KnowledgeBaseWriter,
+    get_manifest_source,
+    hash_document,
+    load_knowledge_base,
+    load_manifest,
+    load_progress,
+    remove_progress,
+    save_knowledge_base,
+    save_manifest,
+    save_progress,
+)
+from haiven_cli.services.embedding_batcher import EmbeddingBatcher, remove_checkpoint
 from haiven_cli.services.embedding_service import EmbeddingService
+from haiven_cli.services.embeddings_cache import CachedEmbeddings
 from haiven_cli.services.token_service import TokenService
+from haiven_cli.services.token_text_splitter import TokenBoundaryTextSplitter
+
+EMBEDDINGS_CHECKPOINT_FILE = "embeddings_checkpoint.jsonl"
 
 
 class KnowledgeService:
@@ -11,34 +30,303 @@ class KnowledgeService:
     ):
         self.token_service = token_service
         self.embedding_service = embedding_service
+        # One batcher per embedding model, so its rate limit covers all files and batches
+        self._embedding_batchers = {}
+        self._embedding_batchers_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes only split files, they do not embed
+        state = self.__dict__.copy()
+        state["_embedding_batchers"] = {}
+        state["_embedding_batchers_lock"] = None
+        return state
 
-    def index(self, texts, metadatas, embedding_model, output_dir):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._embedding_batchers_lock = threading.Lock()
+
+    def index(self, texts, metadatas, embedding_model, output_dir, source=None):
         if texts is None or len(texts) == 0:
             raise ValueError("file content has no value")
 
         if embedding_model is None:
             raise ValueError("embedding model has no value")
 
-        text_splitter = RecursiveCharacterTextSplitter(
+        documents = self.split_documents(texts, metadatas)
+        self.create_knowledge_base(documents, embedding_model, output_dir, source)
+
+    def split_documents(self, texts, metadatas):
+        if texts is None or len(texts) == 0:
+            raise ValueError("file content has no value")
+
+        print("Creating documents out of", len(texts), "texts...")
+        return self._create_text_splitter().create_documents(texts, metadatas)
+
+    def _create_text_splitter(self) -> TokenBoundaryTextSplitter:
+        return TokenBoundaryTextSplitter(
             chunk_size=100,
             chunk_overlap=20,
-            length_function=self.token_service.get_tokens_length,
             separators=["\n\n", "\n", " ", ""],
+            tokenizer=self.token_service,
         )
 
-        print("Creating documents out of", len(texts), "texts...")
-        documents = text_splitter.create_documents(texts, metadatas)
+    def create_knowledge_base(
+        self, documents, embedding_model, output_dir, source: str = None
+    ):
+        """
+        Adds chunks to the knowledge base in output_dir, or creates it. The manifest of the
+        knowledge base tells which chunks were indexed before from the same source: chunks
+        that did not change keep their vectors, only new chunks are embedded, and chunks of
+        the source that are no longer there are deleted. Chunks of other sources are kept.
+
+        Parameters:
+            documents: The chunks to index.
+            embedding_model: The embedding model to embed new chunks with.
+            output_dir: The .kb folder of the knowledge base.
+            source: The file the chunks were created from.
+        """
+        source = get_manifest_source(source, output_dir)
         print("Loading embeddings model", embedding_model.name, "...")
         embeddings = self.embedding_service.load_embeddings(embedding_model)
 
-        print("Creating DB...")
-        db = FAISS.from_documents(documents, embeddings)
-        try:
-            local_db = FAISS.load_local(output_dir, embeddings)
-            local_db.merge_from(db)
-        except ValueError:
+        local_db = load_knowledge_base(output_dir, embeddings)
+        if local_db is None:
             print("Indexing to new path")
-            local_db = db
+            chunks_by_id = {}
+        else:
+            chunks_by_id = load_manifest(output_dir, local_db)
+
+        new_documents = {}
+        for document in documents:
+            new_documents.setdefault(hash_document(document), document)
+
+        # Chunks without a source were indexed before there was a manifest
+        unchanged_hashes = set()
+        deleted_ids = []
+        for docstore_id, chunk in chunks_by_id.items():
+            if chunk["source"] not in (source, None):
+                continue
+
+            if chunk["hash"] in new_documents and chunk["hash"] not in unchanged_hashes:
+                unchanged_hashes.add(chunk["hash"])
+                chunk["source"] = source
+            elif chunk["hash"] in new_documents or chunk["source"] == source:
+                deleted_ids.append(docstore_id)
+
+        added_documents = {
+            document_hash: document
+            for document_hash, document in new_documents.items()
+            if document_hash not in unchanged_hashes
+        }
+        print(
+            f"{len(unchanged_hashes)} chunks unchanged, {len(added_documents)} to embed,",
+            f"{len(deleted_ids)} to delete",
+        )
+
+        if len(added_documents) > 0:
+            local_db = self._add_documents(
+                local_db,
+                chunks_by_id,
+                added_documents,
+                embedding_model,
+                embeddings,
+                output_dir,
+                source,
+            )
+
+        if len(deleted_ids) > 0:
+            local_db.delete(deleted_ids)
+            for docstore_id in deleted_ids:
+                del chunks_by_id[docstore_id]
+
+        if local_db is None:
+            return
+
+        if len(added_documents) > 0 or len(deleted_ids) > 0:
+            print("Saving DB to", output_dir)
+            save_knowledge_base(local_db, output_dir)
+        save_manifest(output_dir, local_db, chunks_by_id)
+        remove_checkpoint(f"{output_dir}/{EMBEDDINGS_CHECKPOINT_FILE}")
+
+    def index_in_batches(
+        self,
+        rows,
+        embedding_model,
+        output_dir,
+        source: str = None,
+        batch_size: int = 500,
+        start_row: int = 0,
+        save_every_rows: int = 10000,
+        delete_vanished_chunks: bool = False,
+    ):
+        """
+        Indexes (text, metadata) rows while they are read, batch_size rows at a time: each
+        batch is split, embedded and appended to the knowledge base in output_dir, so memory
+        does not grow with the size of the source. Every save_every_rows rows, the knowledge
+        base is saved along with the number of rows indexed so far, see get_indexed_rows, so
+        an interrupted ingestion can resume from there. The first save writes the whole
+        knowledge base, the next ones append the chunks added since, see
+        KnowledgeBaseWriter. Chunks already indexed from the same source are not added again.
+
+        Parameters:
+            rows: An iterable of (text, metadata) tuples, like FileService.get_rows_from_csv
+                or FileService.get_pages_from_pdf.
+            embedding_model: The embedding model to embed the chunks with.
+            output_dir: The .kb folder of the knowledge base.
+            source: The file the rows are read from.
+            batch_size: The number of rows to split and embed at once.
+            start_row: The number of rows of the source that were skipped.
+            save_every_rows: The number of rows indexed between two saves.
+            delete_vanished_chunks: Whether to delete the chunks of the source that are no
+                longer in it, like create_knowledge_base, once all rows are indexed from the
+                first one.
+        """
+        if embedding_model is None:
+            raise ValueError("embedding model has no value")
+
+        source = get_manifest_source(source, output_dir)
+        print("Loading embeddings model", embedding_model.name, "...")
+        embeddings = self.embedding_service.load_embeddings(embedding_model)
+
+        local_db = load_knowledge_base(output_dir, embeddings)
+        chunks_by_id = {} if local_db is None else load_manifest(output_dir, local_db)
+        indexed_hashes = {
+            chunk["hash"]
+            for chunk in chunks_by_id.values()
+            if chunk["source"] == source
+        }
+
+        text_splitter = self._create_text_splitter()
+        knowledge_base_writer = KnowledgeBaseWriter(output_dir)
+        row_count = start_row
+        saved_row_count = start_row
+        seen_hashes = set()
+        rows = iter(rows)
+        while batch := list(itertools.islice(rows, batch_size)):
+            texts = [text for text, _ in batch]
+            metadatas = [metadata for _, metadata in batch]
+            added_documents = {}
+            for document in text_splitter.create_documents(texts, metadatas):
+                document_hash = hash_document(document)
+                seen_hashes.add(document_hash)
+                if document_hash not in indexed_hashes:
+                    added_documents.setdefault(document_hash, document)
+
+            if len(added_documents) > 0:
+                local_db = self._add_documents(
+                    local_db,
+                    chunks_by_id,
+                    added_documents,
+                    embedding_model,
+                    embeddings,
+                    output_dir,
+                    source,
+                )
+                indexed_hashes.update(added_documents)
+
+            row_count += len(batch)
+            print(f"{row_count} rows indexed, {len(added_documents)} chunks added")
+
+            if row_count - saved_row_count >= save_every_rows:
+                # Rows indexed after the saved knowledge base are indexed again on resume,
+                # the chunks they were already saved with are then skipped
+                knowledge_base_writer.save(local_db)
+                save_manifest(output_dir, local_db, chunks_by_id)
+                save_progress(output_dir, source, row_count)
+                remove_checkpoint(f"{output_dir}/{EMBEDDINGS_CHECKPOINT_FILE}")
+                saved_row_count = row_count
+
+        deleted_ids = []
+        if delete_vanished_chunks and start_row == 0 and row_count > 0:
+            deleted_ids = [
+                docstore_id
+                for docstore_id, chunk in chunks_by_id.items()
+                if chunk["source"] == source and chunk["hash"] not in seen_hashes
+            ]
+        if len(deleted_ids) > 0:
+            print(f"{len(deleted_ids)} chunks no longer in the source deleted")
+            local_db.delete(deleted_ids)
+            for docstore_id in deleted_ids:
+                del chunks_by_id[docstore_id]
+
+        if local_db is None:
+            if row_count == 0:
+                raise ValueError("file content has no value")
+        elif len(deleted_ids) > 0:
+            # The positions of the chunks changed, they are all written again
+            print("Saving DB to", output_dir)
+            save_knowledge_base(local_db, output_dir)
+            save_manifest(output_dir, local_db, chunks_by_id)
+        else:
+            if row_count > saved_row_count:
+                print("Saving DB to", output_dir)
+                knowledge_base_writer.save(local_db)
+                save_manifest(output_dir, local_db, chunks_by_id)
+            knowledge_base_writer.close()
+
+        remove_progress(output_dir)
+        remove_checkpoint(f"{output_dir}/{EMBEDDINGS_CHECKPOINT_FILE}")
+
+    def get_indexed_rows(self, output_dir, source: str = None) -> int:
+        """
+        Returns the number of rows of the source that an interrupted index_in_batches saved
+        to the knowledge base in output_dir, 0 if there was none.
+        """
+        return load_progress(output_dir, get_manifest_source(source, output_dir))
+
+    def _get_embedding_batcher(self, embedding_model, embeddings) -> EmbeddingBatcher:
+        with self._embedding_batchers_lock:
+            if embedding_model.id not in self._embedding_batchers:
+                self._embedding_batchers[embedding_model.id] = (
+                    EmbeddingBatcher.from_model(
+                        embedding_model, embeddings, self.token_service
+                    )
+                )
+            return self._embedding_batchers[embedding_model.id]
+
+    def _add_documents(
+        self,
+        local_db,
+        chunks_by_id,
+        added_documents,
+        embedding_model,
+        embeddings,
+        output_dir,
+        source,
+    ):
+        # Kept until the knowledge base is saved, to resume from when indexing fails
+        checkpoint_path = f"{output_dir}/{EMBEDDINGS_CHECKPOINT_FILE}"
+        texts = [document.page_content for document in added_documents.values()]
+        if isinstance(embeddings, CachedEmbeddings):
+            # Cached chunks are found before batching, only the others are rate limited
+            embedding_batcher = self._get_embedding_batcher(
+                embedding_model, embeddings.embeddings
+            )
+            vectors = embeddings.embed_documents_with(
+                texts,
+                lambda missing_texts: embedding_batcher.embed_documents(
+                    missing_texts, checkpoint_path
+                ),
+            )
+        else:
+            embedding_batcher = self._get_embedding_batcher(embedding_model, embeddings)
+            vectors = embedding_batcher.embed_documents(texts, checkpoint_path)
+        text_embeddings = list(zip(texts, vectors))
+        metadatas = [document.metadata for document in added_documents.values()]
+
+        if local_db is None:
+            print("Creating DB...")
+            local_db = FAISS.from_embeddings(
+                text_embeddings, embeddings, metadatas=metadatas
+            )
+            added_ids = [
+                local_db.index_to_docstore_id[position]
+                for position in range(len(texts))
+            ]
+        else:
+            added_ids = local_db.add_embeddings(text_embeddings, metadatas=metadatas)
+
+        for docstore_id, document_hash in zip(added_ids, added_documents):
+            chunks_by_id[docstore_id] = {"hash": document_hash, "source": source}
 
-        print("Saving DB to", output_dir)
-        local_db.save_local(output_dir)
+        return local_db
@@ -1,12 +1,75 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from collections import OrderedDict
+from typing import List, Tuple
+
 import tiktoken
 
 
 class TokenService:
-    def __init__(self, encoding: str = "cl100k_base"):
+    """
+    Counts tokens with one tokenizer that is created on first use, and remembers the
+    counts of recently counted texts. The text splitter counts the same fragments many
+    times while it merges splits and overlaps, so most of its calls are answered from memory.
+    """
+
+    def __init__(
+        self,
+        encoding: str = "cl100k_base",
+        max_cached_counts: int = 50000,
+        max_cached_text_length: int = 4000,
+    ):
         self.encoding = encoding
+        self.max_cached_counts = max_cached_counts
+        self.max_cached_text_length = max_cached_text_length
+        self._tokenizer = None
+        self._counts = OrderedDict()
+
+    def __getstate__(self):
+        # The tokenizer is not picklable, processes that receive this service create their own
+        state = self.__dict__.copy()
+        state["_tokenizer"] = None
+        state["_counts"] = OrderedDict()
+        return state
 
     def get_tokens_length(self, s) -> int:
-        tokenizer = tiktoken.get_encoding(self.encoding)
-        tokens = tokenizer.encode(s, disallowed_special=())
+        if s in self._counts:
+            self._counts.move_to_end(s)
+            return self._counts[s]
+
+        tokens = self._get_tokenizer().encode(s, disallowed_special=())
+        self._remember(s, len(tokens))
         return len(tokens)
+
+    def get_tokens_lengths(self, texts: List[str]) -> List[int]:
+        missing_texts = list(dict.fromkeys(s for s in texts if s not in self._counts))
+        lengths = {}
+        if missing_texts:
+            encoded_texts = self._get_tokenizer().encode_batch(
+                missing_texts, disallowed_special=()
+            )
+            for s, tokens in zip(missing_texts, encoded_texts):
+                lengths[s] = len(tokens)
+                self._remember(s, len(tokens))
+
+        return [
+            lengths[s] if s in lengths else self.get_tokens_length(s) for s in texts
+        ]
+
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        return self._get_tokenizer().encode_batch(texts, disallowed_special=())
+
+    def decode_with_offsets(self, tokens: List[int]) -> Tuple[str, List[int]]:
+        return self._get_tokenizer().decode_with_offsets(tokens)
+
+    def _get_tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = tiktoken.get_encoding(self.encoding)
+        return self._tokenizer
+
+    def _remember(self, s, length: int):
+        if self.max_cached_counts <= 0 or len(s) > self.max_cached_text_length:
+            return
+
+        self._counts[s] = length
+        while len(self._counts) > self.max_cached_counts:
+            self._counts.popitem(last=False)
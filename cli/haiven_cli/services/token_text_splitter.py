@@ -0,0 +1,153 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import bisect
+import copy
+import re
+from typing import List, Optional, Tuple
+
+from langchain.docstore.document import Document
+from langchain.text_splitter import TextSplitter
+
+# The app and the cli are packaged and deployed separately and do not import each other,
+# so this module is kept identical in app/embeddings/splitters.py and
+# cli/haiven_cli/services/token_text_splitter.py, which the tests of both check.
+
+
+class TokenBoundaryTextSplitter(TextSplitter):
+    """
+    Splits texts into chunks of at most chunk_size tokens, with about chunk_overlap tokens
+    of overlap, preferring to break at the earliest separator in the list, like
+    RecursiveCharacterTextSplitter does.
+
+    Each text is tokenized once. Chunks are cut at token offsets, moved back to the closest
+    separator, and mapped to character spans of the original text, so the cost grows
+    linearly with the length of the text instead of re-tokenizing candidate splits and
+    their overlaps over and over.
+
+    Attributes:
+        tokenizer: Encodes texts and decodes tokens with their character offsets, like the
+            TokenCounter of the app or the TokenService of the cli.
+        separators (List[str]): The separators to break at, from most to least preferred. An empty
+            separator allows to break between any two tokens, which is done anyway when there is
+            no separator in a chunk.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 500,
+        chunk_overlap: int = 80,
+        separators: Optional[List[str]] = None,
+        *,
+        tokenizer,
+        **kwargs,
+    ):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, **kwargs)
+        self.separators = separators or ["\n\n", "\n", " ", ""]
+        self.tokenizer = tokenizer
+
+    def split_text(self, text: str) -> List[str]:
+        tokens = self.tokenizer.encode_batch([text])[0]
+        return [chunk for chunk, _ in self._split_encoded_text(text, tokens)]
+
+    def create_documents(
+        self, texts: List[str], metadatas: Optional[List[dict]] = None
+    ) -> List[Document]:
+        texts = list(texts)
+        metadatas = metadatas or [{}] * len(texts)
+        encoded_texts = self.tokenizer.encode_batch(texts)
+
+        documents = []
+        for text, tokens, metadata in zip(texts, encoded_texts, metadatas):
+            for chunk, start_index in self._split_encoded_text(text, tokens):
+                chunk_metadata = copy.deepcopy(metadata)
+                if self._add_start_index:
+                    chunk_metadata["start_index"] = start_index
+                documents.append(Document(page_content=chunk, metadata=chunk_metadata))
+
+        return documents
+
+    def _split_encoded_text(
+        self, text: str, tokens: List[int]
+    ) -> List[Tuple[str, int]]:
+        if len(tokens) == 0:
+            return []
+
+        _, offsets = self.tokenizer.decode_with_offsets(tokens)
+        offsets.append(len(text))
+        break_levels = self._get_break_levels(text, offsets)
+
+        chunks = []
+        start = 0
+        end = 0
+        while start < len(tokens):
+            # Every chunk ends after the previous one, or overlaps could repeat it
+            first_end = max(start, end) + 1
+            end = min(start + self._chunk_size, len(tokens))
+            if end < len(tokens):
+                end = self._find_break(break_levels, first_end, end)
+            self._append_chunk(chunks, text, offsets[start], offsets[end])
+
+            if end == len(tokens):
+                break
+
+            next_start = end
+            if self._chunk_overlap > 0:
+                next_start = self._find_overlap_start(break_levels, start, end)
+            start = next_start
+
+        return chunks
+
+    def _get_break_levels(self, text: str, offsets: List[int]) -> List[int]:
+        """
+        Returns, for each token, the position in the separators list of the best separator
+        the token starts at. Breaking before a token that does not start at any separator
+        gets the lowest preference.
+        """
+        break_levels = [len(self.separators)] * len(offsets)
+        for level, separator in enumerate(self.separators):
+            if separator == "":
+                break_levels = [min(level, value) for value in break_levels]
+                break
+
+            for match in re.finditer(re.escape(separator), text):
+                token = bisect.bisect_right(offsets, match.start()) - 1
+                if offsets[token] != match.start():
+                    # The separator is inside a token, break after that token instead
+                    token += 1
+                break_levels[token] = min(break_levels[token], level)
+
+        return break_levels
+
+    def _find_break(self, break_levels: List[int], first: int, last: int) -> int:
+        """
+        Returns the last token between first and last at the best separator.
+        """
+        best_token = None
+        for token in range(last, first - 1, -1):
+            if best_token is None or break_levels[token] < break_levels[best_token]:
+                best_token = token
+                if break_levels[token] == 0:
+                    break
+
+        return best_token
+
+    def _find_overlap_start(self, break_levels: List[int], start: int, end: int) -> int:
+        """
+        Returns the earliest token within chunk_overlap tokens before the end of a chunk that
+        is at a separator as good as the one the chunk ended at. Like the recursive splitter,
+        chunks that end at a paragraph do not overlap into it at a space.
+        """
+        for token in range(max(start + 1, end - self._chunk_overlap), end):
+            if break_levels[token] <= break_levels[end]:
+                return token
+
+        return end
+
+    def _append_chunk(self, chunks: list, text: str, start: int, end: int):
+        chunk = text[start:end]
+        if self._strip_whitespace:
+            stripped_chunk = chunk.lstrip()
+            start += len(chunk) - len(stripped_chunk)
+            chunk = stripped_chunk.rstrip()
+
+        if chunk != "":
+            chunks.append((chunk, start))
@@ -1,5 +1,8 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
 from haiven_cli.app.app import App
@@ -139,7 +142,7 @@ class TestApp:
 
         file_service.get_text_and_metadata_from_csv.assert_called_once_with(source_path)
         knowledge_service.index.assert_called_once_with(
-            file_content, metadatas, embedding, "output_dir/file.kb"
+            file_content, metadatas, embedding, "output_dir/file.kb", source_path
         )
         metadata_service.create_metadata.assert_called_once_with(
             source_path, description, embedding.provider, output_dir
@@ -148,6 +151,68 @@ class TestApp:
             metadata, "output_dir/file.md"
         )
 
+    def test_index_individual_csv_file_in_batches_resumes_from_indexed_rows(self):
+        source_path = "/path/to/file.csv"
+        embedding_model = "an embedding model"
+
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value=embedding_model)
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+
+        rows = MagicMock()
+        file_service = MagicMock()
+        file_service.get_rows_from_csv.return_value = rows
+        knowledge_service = MagicMock()
+        knowledge_service.get_indexed_rows.return_value = 1200
+        metadata_service = MagicMock()
+
+        app = App(config_service, file_service, knowledge_service, metadata_service)
+
+        app.index_individual_file(
+            source_path,
+            embedding_model,
+            "test_config.yaml",
+            "output_dir",
+            "description",
+            csv_batch_size=100,
+        )
+
+        knowledge_service.get_indexed_rows.assert_called_once_with(
+            "output_dir/file.kb", source_path
+        )
+        file_service.get_rows_from_csv.assert_called_once_with(source_path, 1200)
+        file_service.get_text_and_metadata_from_csv.assert_not_called()
+        knowledge_service.index_in_batches.assert_called_once_with(
+            rows, embedding, "output_dir/file.kb", source_path, 100, 1200
+        )
+        file_service.write_metadata_file.assert_called_once_with(
+            metadata_service.create_metadata.return_value, "output_dir/file.md"
+        )
+
+    def test_index_individual_csv_file_in_batches_from_start_row(self):
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value="an embedding model")
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+        file_service = MagicMock()
+        knowledge_service = MagicMock()
+
+        app = App(config_service, file_service, knowledge_service, MagicMock())
+
+        app.index_individual_file(
+            "file.csv",
+            "an embedding model",
+            "test_config.yaml",
+            "output_dir",
+            "description",
+            csv_batch_size=100,
+            start_row=50,
+        )
+
+        knowledge_service.get_indexed_rows.assert_not_called()
+        file_service.get_rows_from_csv.assert_called_once_with("file.csv", 50)
+
     @patch("builtins.open", new_callable=mock_open)
     def test_index_individual_pdf_file(self, mock_file):
         source_path = "/path/to/file.pdf"
@@ -164,17 +229,16 @@ class TestApp:
         config_service.load_embeddings.return_value = config_embeddings
 
         knowledge_service = MagicMock()
+        indexed_pages = []
+        knowledge_service.index_in_batches.side_effect = lambda pages, *args, **kwargs: (
+            indexed_pages.extend(pages)
+        )
 
-        file_content = "the file content"
-        metadatas = MagicMock()
-
+        pages = [("page text", {"page": 1})]
         file = MagicMock()
         mock_file.return_value.__enter__.return_value = file
         file_service = MagicMock()
-        file_service.get_text_and_metadata_from_pdf.return_value = (
-            file_content,
-            metadatas,
-        )
+        file_service.get_pages_from_pdf.return_value = iter(pages)
 
         metadata = MagicMock()
         metadata_service = MagicMock()
@@ -199,12 +263,20 @@ class TestApp:
 
         config_service.load_embeddings.assert_called_once_with(config_path)
         mock_file.assert_called_once_with(source_path, "rb")
-        file_service.get_text_and_metadata_from_pdf.assert_called_once_with(
-            file, pdf_source_link
-        )
-        knowledge_service.index.assert_called_once_with(
-            file_content, metadatas, embedding, "output_dir/file.kb"
+        file_service.get_pages_from_pdf.assert_called_once_with(
+            file, pdf_source_link, clean_text=False
+        )
+        file_service.get_text_and_metadata_from_pdf.assert_not_called()
+        index_args = knowledge_service.index_in_batches.call_args
+        assert index_args.args[1:] == (
+            embedding,
+            "output_dir/file.kb",
+            source_path,
+            50,
         )
+        assert index_args.kwargs == {"delete_vanished_chunks": True}
+        assert indexed_pages == pages
+        knowledge_service.index.assert_not_called()
         metadata_service.create_metadata.assert_called_once_with(
             source_path, description, embedding.provider, output_dir
         )
@@ -212,6 +284,227 @@ class TestApp:
             metadata, "output_dir/file.md"
         )
 
+    def test_index_individual_pdf_file_with_pdf_workers_streams_pages(self):
+        source_path = "/path/to/file.pdf"
+        embedding_model = "an embedding model"
+        pdf_source_link = "https://pdf-source-link.com"
+
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value=embedding_model)
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+
+        pages = [("page text", {"page": 1})]
+        file_service = MagicMock()
+        file_service.get_pages_from_pdf_in_parallel.return_value = iter(pages)
+        knowledge_service = MagicMock()
+        indexed_pages = []
+        knowledge_service.index_in_batches.side_effect = lambda pages, *args, **kwargs: (
+            indexed_pages.extend(pages)
+        )
+        metadata_service = MagicMock()
+
+        app = App(config_service, file_service, knowledge_service, metadata_service)
+
+        app.index_individual_file(
+            source_path,
+            embedding_model,
+            "test_config.yaml",
+            "output_dir",
+            "description",
+            pdf_source_link,
+            pdf_workers=4,
+            clean_pdf_text=True,
+        )
+
+        file_service.get_pages_from_pdf_in_parallel.assert_called_once_with(
+            source_path, pdf_source_link, 4, clean_text=True
+        )
+        file_service.get_pages_from_pdf.assert_not_called()
+        assert indexed_pages == pages
+        assert knowledge_service.index_in_batches.call_args.args[1:] == (
+            embedding,
+            "output_dir/file.kb",
+            source_path,
+            50,
+        )
+        knowledge_service.index.assert_not_called()
+        file_service.write_metadata_file.assert_called_once_with(
+            metadata_service.create_metadata.return_value, "output_dir/file.md"
+        )
+
+    def test_index_web_pages_from_sitemap(self):
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value="an embedding model")
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+        file_service = MagicMock()
+        knowledge_service = MagicMock()
+        metadata_service = MagicMock()
+        crawler_service = MagicMock()
+        urls = ["https://example.com/first", "https://example.com/second"]
+        crawler_service.get_urls_from_sitemap.return_value = urls
+        rows = MagicMock()
+        crawler_service.get_rows.return_value = rows
+
+        app = App(
+            config_service,
+            file_service,
+            knowledge_service,
+            metadata_service,
+            crawler_service,
+        )
+
+        app.index_web_pages(
+            "an embedding model",
+            "test_config.yaml",
+            "output_dir",
+            "description",
+            sitemap="https://example.com/sitemap.xml",
+            workers=8,
+            batch_size=50,
+            near_duplicate_distance=5,
+        )
+
+        crawler_service.get_urls_from_sitemap.assert_called_once_with(
+            "https://example.com/sitemap.xml"
+        )
+        get_rows_args = crawler_service.get_rows.call_args.args
+        assert get_rows_args[0] == urls
+        assert get_rows_args[1].type == "p"
+        assert get_rows_args[2] == 8
+        assert get_rows_args[4] == 5
+        knowledge_service.index_in_batches.assert_called_once_with(
+            rows,
+            embedding,
+            "output_dir/example.com-sitemap.kb",
+            "https://example.com/sitemap.xml",
+            50,
+        )
+        metadata_service.create_metadata.assert_called_once_with(
+            "example.com-sitemap", "description", embedding.provider, "output_dir"
+        )
+        file_service.write_metadata_file.assert_called_once_with(
+            metadata_service.create_metadata.return_value,
+            "output_dir/example.com-sitemap.md",
+        )
+
+    def test_index_web_pages_from_mirror(self):
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value="an embedding model")
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+        knowledge_service = MagicMock()
+        crawler_service = MagicMock()
+
+        app = App(
+            config_service, MagicMock(), knowledge_service, MagicMock(), crawler_service
+        )
+
+        app.index_web_pages(
+            "an embedding model",
+            "test_config.yaml",
+            "output_dir",
+            "description",
+            mirror_dir="mirrors/site/",
+            base_url="https://example.com",
+        )
+
+        crawler_service.get_pages_from_mirror.assert_called_once_with(
+            "mirrors/site/", "https://example.com"
+        )
+        assert (
+            knowledge_service.index_in_batches.call_args.args[2] == "output_dir/site.kb"
+        )
+
+    @pytest.mark.parametrize(
+        "source, source_name",
+        [
+            ("https://example.com/", "example.com"),
+            ("https://example.com/sitemap.xml", "example.com-sitemap"),
+            ("https://other.org/docs/sitemap.xml", "other.org-docs-sitemap"),
+            ("http://localhost:8080/sitemap.xml", "localhost-8080-sitemap"),
+            ("lists/urls.txt", "urls"),
+        ],
+    )
+    def test_index_web_pages_names_the_knowledge_base_after_the_source(
+        self, source, source_name
+    ):
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value="an embedding model")
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+        file_service = MagicMock()
+        knowledge_service = MagicMock()
+
+        app = App(
+            config_service, file_service, knowledge_service, MagicMock(), MagicMock()
+        )
+
+        app.index_web_pages(
+            "an embedding model",
+            "test_config.yaml",
+            "output_dir",
+            "description",
+            sitemap=source,
+        )
+
+        assert (
+            knowledge_service.index_in_batches.call_args.args[2]
+            == f"output_dir/{source_name}.kb"
+        )
+        assert (
+            file_service.write_metadata_file.call_args.args[1]
+            == f"output_dir/{source_name}.md"
+        )
+
+    @pytest.mark.parametrize("mirror_dir", ["./site", "../site/", "site/."])
+    def test_index_web_pages_names_the_knowledge_base_after_a_relative_mirror(
+        self, mirror_dir, tmp_path, monkeypatch
+    ):
+        (tmp_path / "site").mkdir()
+        (tmp_path / "work").mkdir()
+        monkeypatch.chdir(tmp_path / ("work" if mirror_dir.startswith("..") else ""))
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value="an embedding model")
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+        knowledge_service = MagicMock()
+
+        app = App(
+            config_service, MagicMock(), knowledge_service, MagicMock(), MagicMock()
+        )
+
+        app.index_web_pages(
+            "an embedding model",
+            "test_config.yaml",
+            "output_dir",
+            "description",
+            mirror_dir=mirror_dir,
+        )
+
+        assert (
+            knowledge_service.index_in_batches.call_args.args[2] == "output_dir/site.kb"
+        )
+
+    def test_index_web_pages_fails_if_not_one_source_is_set(self):
+        app = App(MagicMock(), MagicMock(), MagicMock(), MagicMock(), MagicMock())
+
+        with pytest.raises(ValueError) as e:
+            app.index_web_pages(
+                "an embedding model",
+                "test_config.yaml",
+                "output_dir",
+                "description",
+                sitemap="sitemap.xml",
+                url_list="urls.txt",
+            )
+
+        assert (
+            str(e.value)
+            == "please provide one of the sitemap, url_list or mirror_dir options"
+        )
+
     def test_index_all_files_fails_if_source_dir_is_not_set(self):
         source_dir = ""
         embedding_model = "embedding_model"
@@ -368,7 +661,7 @@ class TestApp:
             first_file_path
         )
         file_service.get_text_and_metadata_from_pdf.assert_called_once_with(
-            second_file, None
+            second_file, None, False
         )
 
         knowledge_service.index.assert_has_calls(
@@ -378,12 +671,14 @@ class TestApp:
                     first_file_metadata,
                     embedding,
                     "output_dir/csv_file_path.kb",
+                    first_file_path,
                 ),
                 call(
                     second_file_content,
                     second_file_metadata,
                     embedding,
                     "output_dir/pdf_file_path.kb",
+                    second_file_path,
                 ),
             ]
         )
@@ -402,6 +697,90 @@ class TestApp:
             ]
         )
 
+    @patch("haiven_cli.app.app.ProcessPoolExecutor", new=ThreadPoolExecutor)
+    def test_index_all_files_with_workers_indexes_files_in_order(self):
+        embedding_model = "embedding_model"
+        output_dir = "output_dir"
+        description = "description"
+
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value=embedding_model)
+        type(embedding).provider = PropertyMock(return_value="provider")
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+
+        file_paths = [f"folder/file_{index}.csv" for index in range(5)]
+        file_service = MagicMock()
+        file_service.get_files_path_from_directory.return_value = file_paths
+        file_service.get_text_and_metadata_from_csv.side_effect = lambda path: (
+            [f"content of {path}"],
+            [{"source": path}],
+        )
+
+        knowledge_service = MagicMock()
+        knowledge_service.split_documents.side_effect = lambda texts, metadatas: [
+            (texts[0], metadatas[0])
+        ]
+
+        def create_knowledge_base(documents, model, output_kb_dir, source):
+            # The first file is the slowest to embed, it must still be finished first
+            if output_kb_dir.endswith("file_0.kb"):
+                time.sleep(0.2)
+
+        knowledge_service.create_knowledge_base.side_effect = create_knowledge_base
+
+        metadata_service = MagicMock()
+        metadata_service.create_metadata.side_effect = (
+            lambda path, description, provider, output_dir: {"source": path}
+        )
+
+        app = App(config_service, file_service, knowledge_service, metadata_service)
+
+        app.index_all_files(
+            "source_dir", embedding_model, "config_path", output_dir, description, 3
+        )
+
+        knowledge_service.index.assert_not_called()
+        assert sorted(
+            call.args for call in knowledge_service.create_knowledge_base.call_args_list
+        ) == [
+            (
+                [(f"content of {path}", {"source": path})],
+                embedding,
+                f"output_dir/file_{index}.kb",
+                path,
+            )
+            for index, path in enumerate(file_paths)
+        ]
+        assert file_service.write_metadata_file.call_args_list == [
+            call({"source": path}, f"output_dir/file_{index}.md")
+            for index, path in enumerate(file_paths)
+        ]
+
+    def test_index_all_files_with_workers_fails_before_indexing_unsupported_files(
+        self,
+    ):
+        embedding = MagicMock()
+        type(embedding).id = PropertyMock(return_value="embedding_model")
+        config_service = MagicMock()
+        config_service.load_embeddings.return_value = [embedding]
+        file_service = MagicMock()
+        file_service.get_files_path_from_directory.return_value = [
+            "file.csv",
+            "file.txt",
+        ]
+        knowledge_service = MagicMock()
+
+        app = App(config_service, file_service, knowledge_service, MagicMock())
+
+        with pytest.raises(ValueError) as e:
+            app.index_all_files(
+                "source_dir", "embedding_model", "config_path", "output_dir", "", 2
+            )
+
+        assert str(e.value) == "source file needs to be .pdf or .csv file"
+        knowledge_service.split_documents.assert_not_called()
+
     def test_create_context_structure_fails_if_context_name_is_not_set(self):
         context_name = ""
         parent_dir = "parent_dir"
@@ -0,0 +1,238 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from haiven_cli.models.html_filter import HtmlFilter
+from haiven_cli.services.crawler_service import (
+    CrawlerService,
+    CrawlMetrics,
+    NearDuplicateIndex,
+    _fingerprint_page_text,
+)
+from haiven_cli.services.page_helper import PageHelper
+
+SITEMAP_INDEX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap><loc>https://example.com/sitemap-docs.xml</loc></sitemap>
+</sitemapindex>
+"""
+
+SITEMAP = b"""<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"
+        xmlns:image="http://www.google.com/schemas/sitemap-image/1.1">
+  <url>
+    <loc>https://example.com/first</loc>
+    <image:image><image:loc>https://example.com/first.png</image:loc></image:image>
+  </url>
+  <url><loc> https://example.com/second </loc></url>
+</urlset>
+"""
+
+
+def _page(title, text):
+    return f"<html><body><h1>{title}</h1><p>{text}</p></body></html>".encode()
+
+
+class FakeLocations:
+    def __init__(self, pages):
+        self.pages = pages
+        self.read = []
+
+    def __call__(self, location):
+        self.read.append(location)
+        if location not in self.pages:
+            raise OSError("404 Not Found")
+        return self.pages[location]
+
+
+class TestCrawlerService:
+    def test_get_urls_from_sitemap_follows_sitemap_index(self):
+        crawler_service = CrawlerService(
+            PageHelper(),
+            FakeLocations(
+                {
+                    "https://example.com/sitemap.xml": SITEMAP_INDEX,
+                    "https://example.com/sitemap-docs.xml": SITEMAP,
+                }
+            ),
+        )
+
+        urls = crawler_service.get_urls_from_sitemap("https://example.com/sitemap.xml")
+
+        assert urls == ["https://example.com/first", "https://example.com/second"]
+
+    def test_get_urls_from_file_skips_empty_lines_and_comments(self, tmp_path):
+        url_list = os.path.join(tmp_path, "urls.txt")
+        with open(url_list, "w") as f:
+            f.write(
+                "# docs\nhttps://example.com/first\n\n  https://example.com/second\n"
+            )
+
+        urls = CrawlerService(PageHelper()).get_urls_from_file(url_list)
+
+        assert urls == ["https://example.com/first", "https://example.com/second"]
+
+    def test_get_pages_from_mirror_lists_html_files(self, tmp_path):
+        os.makedirs(os.path.join(tmp_path, "site", "docs"))
+        for path in ["index.html", "docs/page.htm", "docs/style.css"]:
+            with open(os.path.join(tmp_path, "site", path), "w") as f:
+                f.write("")
+        mirror_dir = os.path.join(tmp_path, "site")
+
+        pages = CrawlerService(PageHelper()).get_pages_from_mirror(
+            mirror_dir, "https://example.com/"
+        )
+
+        assert pages == [
+            (
+                "https://example.com/docs/page.htm",
+                os.path.join(mirror_dir, "docs", "page.htm"),
+            ),
+            ("https://example.com/index.html", os.path.join(mirror_dir, "index.html")),
+        ]
+
+    @patch(
+        "haiven_cli.services.crawler_service.ProcessPoolExecutor", ThreadPoolExecutor
+    )
+    def test_get_rows_parses_pages_in_order_and_skips_duplicates_and_failures(self):
+        read_location = FakeLocations(
+            {
+                "https://example.com/first": _page("First", "The first page"),
+                "mirror/second.html": _page("Second", "The second page"),
+                "https://example.com/copy": _page("Copy", "the  FIRST page"),
+                "https://example.com/empty": _page("Empty", " "),
+                "https://example.com/third": _page("Third", "The third page"),
+            }
+        )
+        crawler_service = CrawlerService(PageHelper(), read_location)
+        metrics = CrawlMetrics()
+
+        rows = list(
+            crawler_service.get_rows(
+                [
+                    "https://example.com/first",
+                    ("https://example.com/second", "mirror/second.html"),
+                    "https://example.com/copy",
+                    "https://example.com/missing",
+                    "https://example.com/empty",
+                    "https://example.com/third",
+                ],
+                HtmlFilter("p"),
+                workers=2,
+                metrics=metrics,
+            )
+        )
+
+        assert rows == [
+            (
+                "The first page",
+                {
+                    "title": "First",
+                    "url": "https://example.com/first",
+                    "source": "https://example.com/first",
+                },
+            ),
+            (
+                "The second page",
+                {
+                    "title": "Second",
+                    "url": "https://example.com/second",
+                    "source": "https://example.com/second",
+                },
+            ),
+            (
+                "The third page",
+                {
+                    "title": "Third",
+                    "url": "https://example.com/third",
+                    "source": "https://example.com/third",
+                },
+            ),
+        ]
+        stats = metrics.stats()
+        assert stats["fetch"]["pages"] == 5
+        assert stats["fetch"]["failures"] == 1
+        assert stats["parse"]["pages"] == 5
+        assert stats["dedup"]["pages"] == 1
+        assert stats["index"]["pages"] == 3
+
+    def test_get_rows_skips_near_duplicates_of_pages_before_them(self):
+        article = " ".join(f"word{i}" for i in range(300))
+        read_location = FakeLocations(
+            {
+                "https://example.com/article": _page("Article", article),
+                "https://example.com/print": _page(
+                    "Print", article + " Printed from example.com"
+                ),
+                "https://example.com/other": _page(
+                    "Other", " ".join(f"other{i}" for i in range(300))
+                ),
+            }
+        )
+        crawler_service = CrawlerService(PageHelper(), read_location)
+        urls = [
+            "https://example.com/article",
+            "https://example.com/print",
+            "https://example.com/other",
+        ]
+
+        rows = list(crawler_service.get_rows(urls, HtmlFilter("p"), workers=2))
+        exact_rows = list(
+            crawler_service.get_rows(
+                urls, HtmlFilter("p"), workers=2, near_duplicate_distance=0
+            )
+        )
+
+        assert [metadata["source"] for _, metadata in rows] == [
+            "https://example.com/article",
+            "https://example.com/other",
+        ]
+        assert len(exact_rows) == 3
+
+
+class TestNearDuplicateIndex:
+    def test_add_refuses_fingerprints_within_max_distance(self):
+        index = NearDuplicateIndex(max_distance=3)
+
+        assert index.add(0b1111 << 60) is True
+        # 3 bits apart, in different bands
+        assert index.add(0b1111 << 60 ^ 1 ^ 1 << 30 ^ 1 << 45) is False
+        assert index.add(0b1111 << 60 ^ 0b1111) is True
+        assert index.add(0) is True
+
+    def test_fingerprints_of_similar_texts_are_close(self):
+        text = " ".join(f"word{i}" for i in range(200))
+        fingerprint = _fingerprint_page_text(text)
+
+        assert _fingerprint_page_text(text.upper().replace(" ", "\n ")) == fingerprint
+        assert (
+            fingerprint ^ _fingerprint_page_text(text.replace("word100", "changed"))
+        ).bit_count() <= 3
+        assert (
+            fingerprint ^ _fingerprint_page_text(text.replace("word", "other"))
+        ).bit_count() > 10
+
+
+class TestCrawlMetrics:
+    def test_stats_reports_throughput_of_each_stage(self):
+        now = [0.0]
+        metrics = CrawlMetrics(clock=lambda: now[0])
+
+        metrics.record("fetch", byte_count=1000, seconds=0.5)
+        metrics.record("fetch", byte_count=3000, seconds=1.5)
+        metrics.record_failure("fetch")
+        now[0] = 4.0
+
+        assert metrics.stats() == {
+            "fetch": {
+                "pages": 2,
+                "bytes": 4000,
+                "seconds": 2.0,
+                "failures": 1,
+                "pages_per_second": 0.5,
+            }
+        }
+        assert metrics.report() == [
+            "fetch: 2 pages, 0.0 MB, 1 failed, 0.5 pages/s, 2.0s of work"
+        ]
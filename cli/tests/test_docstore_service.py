@@ -0,0 +1,178 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import os
+
+import pytest
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+from unittest.mock import patch
+
+from haiven_cli.services.docstore_service import (
+    COMPACT_DOCSTORE_METADATA_FILE,
+    COMPACT_DOCSTORE_METADATA_LOG_FILE,
+    COMPACT_DOCSTORE_TEXT_FILE,
+    KnowledgeBaseWriter,
+    load_knowledge_base,
+    save_knowledge_base,
+)
+
+
+def _loaded_documents(db):
+    return [
+        (document.page_content, document.metadata)
+        for document in (
+            db.docstore.search(db.index_to_docstore_id[position])
+            for position in range(db.index.ntotal)
+        )
+    ]
+
+
+class TestDocstoreService:
+    def test_save_and_load_knowledge_base_with_compact_docstore(self, tmp_path):
+        embeddings = DeterministicFakeEmbedding(size=8)
+        metadatas = [{"source": "a.pdf", "page": 1}] * 3 + [
+            {"source": "a.pdf", "page": 2}
+        ]
+        texts = ["first", "second ü", "", "fourth"]
+        db = FAISS.from_texts(texts, embeddings, metadatas=metadatas)
+        output_dir = os.path.join(tmp_path, "a.kb")
+
+        save_knowledge_base(db, output_dir)
+        loaded_db = load_knowledge_base(output_dir, embeddings)
+
+        assert sorted(os.listdir(output_dir)) == [
+            "docstore_metadata.json",
+            "docstore_offsets.npy",
+            "docstore_text.bin",
+            "index.faiss",
+        ]
+        with open(os.path.join(output_dir, COMPACT_DOCSTORE_METADATA_FILE)) as f:
+            assert len(json.load(f)["metadata"]) == 2
+        assert loaded_db.index.ntotal == 4
+        for position, (text, metadata) in enumerate(zip(texts, metadatas)):
+            document = loaded_db.docstore.search(
+                loaded_db.index_to_docstore_id[position]
+            )
+            assert document.page_content == text
+            assert document.metadata == metadata
+        assert loaded_db.similarity_search("fourth", k=1)[0].page_content == "fourth"
+
+    def test_interrupted_save_keeps_the_previous_knowledge_base(self, tmp_path):
+        embeddings = DeterministicFakeEmbedding(size=8)
+        output_dir = os.path.join(tmp_path, "a.kb")
+        save_knowledge_base(FAISS.from_texts(["old"], embeddings), output_dir)
+
+        with (
+            patch(
+                "haiven_cli.services.docstore_service.faiss.write_index",
+                side_effect=KeyboardInterrupt(),
+            ),
+            pytest.raises(KeyboardInterrupt),
+        ):
+            save_knowledge_base(
+                FAISS.from_texts(["new", "other"], embeddings), output_dir
+            )
+
+        loaded_db = load_knowledge_base(output_dir, embeddings)
+        assert loaded_db.index.ntotal == 1
+        assert (
+            loaded_db.docstore.search(loaded_db.index_to_docstore_id[0]).page_content
+            == "old"
+        )
+
+    def test_writer_appends_the_chunks_added_since_the_last_save(self, tmp_path):
+        embeddings = DeterministicFakeEmbedding(size=8)
+        output_dir = os.path.join(tmp_path, "a.kb")
+        db = FAISS.from_texts(["first"], embeddings, metadatas=[{"page": 1}])
+        writer = KnowledgeBaseWriter(output_dir)
+        writer.save(db)
+
+        db.add_texts(["second", "third"], metadatas=[{"page": 1}, {"page": 2}])
+        with patch("builtins.open", wraps=open) as opened:
+            writer.save(db)
+        text_modes = [
+            call.args[1]
+            for call in opened.call_args_list
+            if call.args[0].endswith(COMPACT_DOCSTORE_TEXT_FILE)
+        ]
+        db.add_texts(["fourth"], metadatas=[{"page": 3}])
+        writer.save(db)
+
+        # The new metadata is in the log, and still read, until the writer is closed
+        with open(os.path.join(output_dir, COMPACT_DOCSTORE_METADATA_FILE)) as f:
+            assert json.load(f)["metadata"] == [{"page": 1}]
+        appended_documents = _loaded_documents(
+            load_knowledge_base(output_dir, embeddings)
+        )
+        writer.close()
+
+        assert text_modes == ["r+b"]
+        assert not os.path.exists(
+            os.path.join(output_dir, COMPACT_DOCSTORE_METADATA_LOG_FILE)
+        )
+        with open(os.path.join(output_dir, COMPACT_DOCSTORE_METADATA_FILE)) as f:
+            assert len(json.load(f)["metadata"]) == 3
+        expected_documents = [
+            ("first", {"page": 1}),
+            ("second", {"page": 1}),
+            ("third", {"page": 2}),
+            ("fourth", {"page": 3}),
+        ]
+        assert appended_documents == expected_documents
+        assert (
+            _loaded_documents(load_knowledge_base(output_dir, embeddings))
+            == expected_documents
+        )
+
+    def test_interrupted_append_keeps_the_chunks_saved_before(self, tmp_path):
+        embeddings = DeterministicFakeEmbedding(size=8)
+        output_dir = os.path.join(tmp_path, "a.kb")
+        db = FAISS.from_texts(["first"], embeddings, metadatas=[{"page": 1}])
+        writer = KnowledgeBaseWriter(output_dir)
+        writer.save(db)
+
+        db.add_texts(["second"], metadatas=[{"page": 2}])
+        with (
+            patch(
+                "haiven_cli.services.docstore_service.faiss.write_index",
+                side_effect=KeyboardInterrupt(),
+            ),
+            pytest.raises(KeyboardInterrupt),
+        ):
+            writer.save(db)
+
+        loaded_db = load_knowledge_base(output_dir, embeddings)
+        assert _loaded_documents(loaded_db) == [("first", {"page": 1})]
+
+        loaded_db.add_texts(["other"], metadatas=[{"page": 3}])
+        resumed_writer = KnowledgeBaseWriter(output_dir)
+        resumed_writer.save(loaded_db)
+        resumed_writer.close()
+        assert _loaded_documents(load_knowledge_base(output_dir, embeddings)) == [
+            ("first", {"page": 1}),
+            ("other", {"page": 3}),
+        ]
+
+    def test_load_knowledge_base_with_pickled_docstore(self, tmp_path):
+        embeddings = DeterministicFakeEmbedding(size=8)
+        FAISS.from_texts(["old"], embeddings, metadatas=[{"page": 1}]).save_local(
+            tmp_path
+        )
+
+        loaded_db = load_knowledge_base(tmp_path, embeddings)
+        loaded_db.merge_from(FAISS.from_texts(["new"], embeddings))
+        save_knowledge_base(loaded_db, tmp_path)
+        converted_db = load_knowledge_base(tmp_path, embeddings)
+
+        assert not os.path.exists(os.path.join(tmp_path, "index.pkl"))
+        assert [
+            converted_db.docstore.search(
+                converted_db.index_to_docstore_id[i]
+            ).page_content
+            for i in range(2)
+        ] == ["old", "new"]
+
+    def test_load_knowledge_base_returns_none_without_index(self, tmp_path):
+        assert load_knowledge_base(tmp_path, DeterministicFakeEmbedding(size=8)) is None
@@ -0,0 +1,250 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import os
+
+import pytest
+
+from haiven_cli.models.embedding_model import EmbeddingModel
+from haiven_cli.services.embedding_batcher import (
+    EmbeddingBatcher,
+    RateLimiter,
+    remove_checkpoint,
+)
+from unittest.mock import MagicMock
+
+
+class WordTokenService:
+    def get_tokens_lengths(self, texts):
+        return [len(text.split()) for text in texts]
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class FakeEmbeddings:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.requests = []
+
+    def embed_documents(self, texts):
+        self.requests.append(list(texts))
+        if self.failures > 0:
+            self.failures -= 1
+            raise RateLimitError("429 Too Many Requests")
+        return [[float(len(text))] for text in texts]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestEmbeddingBatcher:
+    def test_embed_documents_batches_by_size_and_tokens(self):
+        embeddings = FakeEmbeddings()
+        batcher = EmbeddingBatcher(
+            embeddings,
+            WordTokenService(),
+            max_batch_size=3,
+            max_batch_tokens=4,
+            max_concurrent_requests=1,
+        )
+        texts = ["a b", "c", "d", "e", "f g h i j", "k"]
+
+        vectors = batcher.embed_documents(texts)
+
+        assert vectors == [[float(len(text))] for text in texts]
+        assert embeddings.requests == [
+            ["a b", "c", "d"],
+            ["e"],
+            ["f g h i j"],
+            ["k"],
+        ]
+
+    def test_embed_documents_embeds_duplicate_texts_once(self):
+        embeddings = FakeEmbeddings()
+        batcher = EmbeddingBatcher(embeddings, WordTokenService())
+
+        vectors = batcher.embed_documents(["same", "other", "same"])
+
+        assert vectors == [[4.0], [5.0], [4.0]]
+        assert embeddings.requests == [["same", "other"]]
+
+    def test_embed_documents_retries_failed_requests_with_backoff(self):
+        embeddings = FakeEmbeddings(failures=2)
+        sleep = MagicMock()
+        batcher = EmbeddingBatcher(
+            embeddings,
+            WordTokenService(),
+            max_retries=3,
+            initial_backoff_seconds=1.0,
+            sleep=sleep,
+        )
+
+        vectors = batcher.embed_documents(["text"])
+
+        assert vectors == [[4.0]]
+        assert len(embeddings.requests) == 3
+        backoffs = [call.args[0] for call in sleep.call_args_list]
+        assert 1.0 <= backoffs[0] <= 1.5
+        assert 2.0 <= backoffs[1] <= 3.0
+
+    def test_embed_documents_raises_when_retries_are_exhausted(self):
+        embeddings = FakeEmbeddings(failures=5)
+        batcher = EmbeddingBatcher(
+            embeddings, WordTokenService(), max_retries=1, sleep=MagicMock()
+        )
+
+        with pytest.raises(Exception) as e:
+            batcher.embed_documents(["text"])
+
+        assert str(e.value) == "429 Too Many Requests"
+        assert len(embeddings.requests) == 2
+
+    def test_embed_documents_retries_timeouts_and_server_errors(self):
+        server_error = Exception("internal server error")
+        server_error.response = MagicMock(status_code=503)
+        embeddings = MagicMock()
+        embeddings.embed_documents.side_effect = [
+            TimeoutError("timed out"),
+            server_error,
+            [[1.0]],
+        ]
+        batcher = EmbeddingBatcher(
+            embeddings, WordTokenService(), max_retries=3, sleep=MagicMock()
+        )
+
+        assert batcher.embed_documents(["text"]) == [[1.0]]
+        assert embeddings.embed_documents.call_count == 3
+
+    def test_embed_documents_does_not_retry_other_errors(self):
+        invalid_request = Exception("invalid input")
+        invalid_request.status_code = 400
+        for error in [invalid_request, ValueError("unexpected response")]:
+            embeddings = MagicMock()
+            embeddings.embed_documents.side_effect = error
+            sleep = MagicMock()
+            batcher = EmbeddingBatcher(
+                embeddings, WordTokenService(), max_retries=3, sleep=sleep
+            )
+
+            with pytest.raises(Exception) as e:
+                batcher.embed_documents(["text"])
+
+            assert e.value is error
+            assert embeddings.embed_documents.call_count == 1
+            sleep.assert_not_called()
+
+    def test_embed_documents_resumes_from_checkpoint(self, tmp_path):
+        checkpoint_path = os.path.join(tmp_path, "output.kb", "checkpoint.jsonl")
+        failing_embeddings = MagicMock()
+        failing_embeddings.embed_documents.side_effect = [
+            [[1.0]],
+            RateLimitError("429 Too Many Requests"),
+        ]
+        batcher = EmbeddingBatcher(
+            failing_embeddings,
+            WordTokenService(),
+            max_batch_size=1,
+            max_concurrent_requests=1,
+            max_retries=0,
+        )
+
+        with pytest.raises(Exception):
+            batcher.embed_documents(["first", "second"], checkpoint_path)
+
+        with open(checkpoint_path, "a") as f:
+            f.write('{"hash": "cut off')
+
+        embeddings = FakeEmbeddings()
+        batcher = EmbeddingBatcher(embeddings, WordTokenService())
+        vectors = batcher.embed_documents(["first", "second"], checkpoint_path)
+
+        assert vectors == [[1.0], [6.0]]
+        assert embeddings.requests == [["second"]]
+        # The caller removes the checkpoint once the embeddings are saved
+        assert os.path.exists(checkpoint_path)
+        remove_checkpoint(checkpoint_path)
+        assert not os.path.exists(checkpoint_path)
+
+    def test_checkpoint_keeps_finished_batches(self, tmp_path):
+        checkpoint_path = os.path.join(tmp_path, "checkpoint.jsonl")
+        embeddings = MagicMock()
+        embeddings.embed_documents.side_effect = [[[1.0]], Exception("error")]
+        batcher = EmbeddingBatcher(
+            embeddings,
+            WordTokenService(),
+            max_batch_size=1,
+            max_concurrent_requests=1,
+            max_retries=0,
+        )
+
+        with pytest.raises(Exception):
+            batcher.embed_documents(["first", "second"], checkpoint_path)
+
+        with open(checkpoint_path, "r") as f:
+            entries = [json.loads(line) for line in f]
+        assert [entry["embedding"] for entry in entries] == [[1.0]]
+
+    def test_from_model_uses_provider_limits_and_model_config(self):
+        model = EmbeddingModel(
+            id="azure-embeddings",
+            provider="Azure",
+            name="Azure embeddings",
+            config={"requests_per_minute": "120", "max_batch_tokens": 2000},
+        )
+
+        batcher = EmbeddingBatcher.from_model(model, MagicMock(), MagicMock())
+
+        assert batcher.max_batch_size == 16
+        assert batcher.max_batch_tokens == 2000
+        assert batcher.rate_limiter.requests_per_minute == 120
+        assert batcher.rate_limiter.tokens_per_minute is None
+
+
+class TestRateLimiter:
+    def test_acquire_waits_for_requests_budget(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter(
+            requests_per_minute=2, clock=clock, sleep=clock.sleep
+        )
+
+        rate_limiter.acquire(1)
+        clock.now = 10
+        rate_limiter.acquire(1)
+        rate_limiter.acquire(1)
+
+        assert clock.now == 60
+        assert clock.sleeps == [50]
+
+    def test_acquire_waits_for_tokens_budget(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter(
+            tokens_per_minute=100, clock=clock, sleep=clock.sleep
+        )
+
+        rate_limiter.acquire(60)
+        rate_limiter.acquire(40)
+        clock.now = 30
+        rate_limiter.acquire(10)
+
+        assert clock.now == 60
+
+    def test_acquire_sends_request_larger_than_budget_alone(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter(
+            tokens_per_minute=100, clock=clock, sleep=clock.sleep
+        )
+
+        rate_limiter.acquire(500)
+
+        assert clock.sleeps == []
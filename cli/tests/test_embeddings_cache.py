@@ -0,0 +1,76 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+import pickle
+
+from haiven_cli.models.embedding_model import EmbeddingModel
+from haiven_cli.services.embeddings_cache import (
+    CachedEmbeddings,
+    CachedEmbeddingService,
+    EmbeddingsCache,
+)
+from unittest.mock import MagicMock
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.embedded_texts = []
+
+    def embed_documents(self, texts):
+        self.embedded_texts.extend(texts)
+        return [[float(len(text)), 0.5] for text in texts]
+
+    def embed_query(self, text):
+        return [0.0, 0.0]
+
+
+class TestEmbeddingsCache:
+    def test_cached_embeddings_only_embeds_texts_once(self, tmp_path):
+        cache = EmbeddingsCache(os.path.join(tmp_path, "cache.sqlite"))
+        embeddings = FakeEmbeddings()
+        cached_embeddings = CachedEmbeddings(embeddings, cache, "model")
+
+        first_vectors = cached_embeddings.embed_documents(["one", "three", "one"])
+        second_vectors = cached_embeddings.embed_documents(["three", "seven"])
+
+        assert first_vectors == [[3.0, 0.5], [5.0, 0.5], [3.0, 0.5]]
+        assert second_vectors == [[5.0, 0.5], [5.0, 0.5]]
+        assert embeddings.embedded_texts == ["one", "three", "seven"]
+        assert cache.stats() == {"hits": 1, "misses": 3, "hit_rate": 0.25}
+
+    def test_cache_is_kept_across_runs_and_separated_by_model(self, tmp_path):
+        path = os.path.join(tmp_path, "cache", "cache.sqlite")
+        cache = EmbeddingsCache(path)
+        CachedEmbeddings(FakeEmbeddings(), cache, "model").embed_documents(["text"])
+        cache.close()
+
+        cache = EmbeddingsCache(path)
+        embeddings = FakeEmbeddings()
+        CachedEmbeddings(embeddings, cache, "model").embed_documents(["text"])
+        CachedEmbeddings(embeddings, cache, "other model").embed_documents(["text"])
+
+        assert embeddings.embedded_texts == ["text"]
+        assert cache.stats()["hits"] == 1
+
+    def test_cache_can_be_pickled_after_use(self, tmp_path):
+        cache = EmbeddingsCache(os.path.join(tmp_path, "cache.sqlite"))
+        CachedEmbeddings(FakeEmbeddings(), cache, "model").embed_documents(["text"])
+
+        unpickled_cache = pickle.loads(pickle.dumps(cache))
+
+        assert unpickled_cache.get_many("model", ["unknown"]) == {}
+
+    def test_cached_embedding_service_wraps_loaded_embeddings(self, tmp_path):
+        cache = EmbeddingsCache(os.path.join(tmp_path, "cache.sqlite"))
+        embedding_service = MagicMock()
+        embeddings = FakeEmbeddings()
+        embedding_service.load_embeddings.return_value = embeddings
+        model = EmbeddingModel(id="model", provider="openai", name="Model")
+
+        cached_embeddings = CachedEmbeddingService(
+            embedding_service, cache
+        ).load_embeddings(model)
+
+        embedding_service.load_embeddings.assert_called_once_with(model)
+        assert cached_embeddings.embeddings is embeddings
+        assert cached_embeddings.model_id == "model"
+        assert cached_embeddings.embed_query("query") == [0.0, 0.0]
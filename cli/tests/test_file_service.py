@@ -1,8 +1,11 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
 import pytest
+import random
+import re
 import shutil
 
+from concurrent.futures import ThreadPoolExecutor
 from haiven_cli.services.file_service import FileService
 from unittest.mock import patch, MagicMock, PropertyMock
 
@@ -155,6 +158,113 @@ class TestFileService:
         assert first_text in text
         assert second_text in text
 
+    @pytest.mark.parametrize(
+        "text,expected",
+        [
+            ("T h e  q u i c k  f o x", "The quick fox"),
+            ("a b c; d e", "abc; de"),
+            ("team’s  (d e l i v e r y),  2 0 2 4.", "team’s (delivery), 2024."),
+            ("a   b    c", "a  b  c"),
+            (" a b \n c d ", " ab \n cd "),
+            ("", ""),
+        ],
+    )
+    def test_clean_text_with_spaces_between_characters(self, text, expected):
+        assert FileService().clean_text_with_spaces_between_characters(text) == expected
+
+    def test_clean_text_with_spaces_between_characters_matches_lookaround_substitutions(
+        self,
+    ):
+        def clean_with_lookarounds(text):
+            text = re.sub(r"(?<=[\w,.’\-():]) (?=[\w,.’\-():])", "", text)
+            return re.sub(r"  ", " ", text)
+
+        characters = "aZ09é_,.’-():;!?/ \n\t"
+        text_random = random.Random(0)
+        file_service = FileService()
+
+        for _ in range(2000):
+            text = "".join(
+                text_random.choice(characters + "   ")
+                for _ in range(text_random.randint(0, 40))
+            )
+            assert file_service.clean_text_with_spaces_between_characters(
+                text
+            ) == clean_with_lookarounds(text)
+
+    @patch("haiven_cli.services.file_service.PdfReader")
+    def test_get_pages_from_pdf_cleans_text_of_each_page(self, mock_pdf_reader):
+        pdf_file = MagicMock()
+        type(pdf_file).name = PropertyMock(return_value="pdf_file_path.pdf")
+        mock_pdf_reader.return_value = _create_pdf_reader(["a b  c d", "e f"])
+
+        pages = FileService().get_pages_from_pdf(pdf_file, clean_text=True)
+
+        assert [text for text, _ in pages] == ["ab cd", "ef"]
+
+    @patch("haiven_cli.services.file_service.PdfReader")
+    def test_get_pages_from_pdf_yields_pages_of_range(self, mock_pdf_reader):
+        pdf_file = MagicMock()
+        type(pdf_file).name = PropertyMock(return_value="pdf_file_path.pdf")
+        mock_pdf_reader.return_value = _create_pdf_reader(["a", "b", "c", "d"])
+        file_service = FileService()
+
+        pages = file_service.get_pages_from_pdf(pdf_file, first_page=1, last_page=10)
+
+        mock_pdf_reader.assert_not_called()
+        pages = list(pages)
+        assert [text for text, _ in pages] == ["b", "c", "d"]
+        assert [metadata["page"] for _, metadata in pages] == [2, 3, 4]
+        assert pages[0][1]["source"] == "pdf_file_path.pdf"
+
+    @patch("haiven_cli.services.file_service.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("haiven_cli.services.file_service.PdfReader")
+    def test_get_pages_from_pdf_in_parallel_yields_pages_in_order(
+        self, mock_pdf_reader, tmp_path
+    ):
+        pdf_path = os.path.join(tmp_path, "file.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(b"%PDF-")
+        texts = [f"page {page}" for page in range(1, 8)]
+        mock_pdf_reader.side_effect = lambda _: _create_pdf_reader(texts)
+        file_service = FileService()
+
+        pages = list(
+            file_service.get_pages_from_pdf_in_parallel(
+                pdf_path, "https://source", workers=2, pages_per_range=3
+            )
+        )
+
+        assert [text for text, _ in pages] == texts
+        assert [metadata["page"] for _, metadata in pages] == list(range(1, 8))
+        assert {metadata["source"] for _, metadata in pages} == {"https://source"}
+        # One reader to count the pages, then one per range
+        assert mock_pdf_reader.call_count == 4
+
+    def test_get_rows_from_csv_skips_start_rows(self, tmp_path):
+        csv_file = os.path.join(tmp_path, "file.csv")
+        with open(csv_file, "w") as f:
+            f.write("content,metadata.source,metadata.title,metadata.authors\n")
+            for row in range(4):
+                f.write(f'"text, {row}",source {row},title {row},author\n')
+        file_service = FileService()
+
+        rows = list(file_service.get_rows_from_csv(csv_file, start_row=2))
+
+        assert rows == [
+            (
+                "text, 2",
+                {"source": "source 2", "title": "title 2", "authors": "author"},
+            ),
+            (
+                "text, 3",
+                {"source": "source 3", "title": "title 3", "authors": "author"},
+            ),
+        ]
+        assert file_service.get_text_and_metadata_from_csv(csv_file)[0] == [
+            f"text, {row}" for row in range(4)
+        ]
+
     @patch("haiven_cli.services.file_service.os")
     def test_get_files_path_from_directory(self, mock_os):
         source_dir = "source_dir"
@@ -284,3 +394,15 @@ a description of the business context
         assert os.path.exists(f"{kp_root_dir}/contexts/{context_name}/embeddings")
 
         shutil.rmtree(kp_root_dir)
+
+
+def _create_pdf_reader(texts):
+    pages = []
+    for text in texts:
+        page = MagicMock()
+        page.extract_text.return_value = text
+        pages.append(page)
+    pdf_reader = MagicMock()
+    type(pdf_reader).pages = PropertyMock(return_value=pages)
+    type(pdf_reader).metadata = PropertyMock(return_value=None)
+    return pdf_reader
@@ -1,6 +1,21 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import os
+
 import pytest
 
+from langchain.docstore.document import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from haiven_cli.models.embedding_model import EmbeddingModel
+from haiven_cli.services.docstore_service import (
+    hash_document,
+    load_knowledge_base,
+    load_manifest,
+    save_knowledge_base,
+)
+from haiven_cli.services.embedding_batcher import RateLimiter
+from haiven_cli.services.embeddings_cache import CachedEmbeddings, EmbeddingsCache
 from haiven_cli.services.knowledge_service import KnowledgeService
 from unittest.mock import MagicMock, patch
 
@@ -47,82 +62,476 @@ class TestKnowledgeService:
             knowledge_service.index(text, metadatas, embedding_model, ouput_dir)
         assert str(e.value) == "embedding model has no value"
 
+    @patch("haiven_cli.services.knowledge_service.save_manifest")
+    @patch("haiven_cli.services.knowledge_service.save_knowledge_base")
+    @patch("haiven_cli.services.knowledge_service.load_knowledge_base")
     @patch("haiven_cli.services.knowledge_service.FAISS")
-    @patch("haiven_cli.services.knowledge_service.RecursiveCharacterTextSplitter")
-    def test_save_knowledge_to_new_path(self, mock_text_splitter, mock_faiss):
+    @patch("haiven_cli.services.knowledge_service.TokenBoundaryTextSplitter")
+    @patch("haiven_cli.services.knowledge_service.EmbeddingBatcher")
+    def test_save_knowledge_to_new_path(
+        self,
+        mock_batcher,
+        mock_text_splitter,
+        mock_faiss,
+        mock_load,
+        mock_save,
+        mock_save_manifest,
+    ):
         text = "something cool"
         texts = [text]
         metadatas = {}
         embedding_model = MagicMock()
         ouput_dir = "test knowledge base path"
+        source = "file.pdf"
 
         token_service = MagicMock()
 
-        documents = MagicMock()
+        document = Document(page_content="chunk", metadata={"page": 1})
         text_splitter = MagicMock()
-        text_splitter.create_documents.return_value = documents
+        text_splitter.create_documents.return_value = [document]
         mock_text_splitter.return_value = text_splitter
 
         embeddings = MagicMock()
         embedding_service = MagicMock()
         embedding_service.load_embeddings.return_value = embeddings
 
+        embedding_batcher = MagicMock()
+        embedding_batcher.embed_documents.return_value = [[0.1, 0.2]]
+        mock_batcher.from_model.return_value = embedding_batcher
+
         local_db = MagicMock()
-        mock_faiss.from_documents.return_value = local_db
-        mock_faiss.load_local.side_effect = ValueError("Some Error")
+        local_db.index_to_docstore_id = {0: "chunk id"}
+        mock_faiss.from_embeddings.return_value = local_db
+        mock_load.return_value = None
 
         knowledge_service = KnowledgeService(token_service, embedding_service)
-        knowledge_service.index(texts, metadatas, embedding_model, ouput_dir)
+        knowledge_service.index(texts, metadatas, embedding_model, ouput_dir, source)
 
         mock_text_splitter.assert_called_once_with(
             chunk_size=100,
             chunk_overlap=20,
-            length_function=token_service.get_tokens_length,
             separators=["\n\n", "\n", " ", ""],
+            tokenizer=token_service,
         )
         text_splitter.create_documents.assert_called_once_with(texts, metadatas)
         embedding_service.load_embeddings.assert_called_once_with(embedding_model)
-        mock_faiss.from_documents.assert_called_once_with(documents, embeddings)
-        mock_faiss.load_local.assert_called_once_with(ouput_dir, embeddings)
-        local_db.save_local.assert_called_once_with(ouput_dir)
+        mock_load.assert_called_once_with(ouput_dir, embeddings)
+        mock_batcher.from_model.assert_called_once_with(
+            embedding_model, embeddings, token_service
+        )
+        embedding_batcher.embed_documents.assert_called_once_with(
+            ["chunk"], f"{ouput_dir}/embeddings_checkpoint.jsonl"
+        )
+        mock_faiss.from_embeddings.assert_called_once_with(
+            [("chunk", [0.1, 0.2])], embeddings, metadatas=[{"page": 1}]
+        )
+        mock_save.assert_called_once_with(local_db, ouput_dir)
+        mock_save_manifest.assert_called_once_with(
+            ouput_dir,
+            local_db,
+            {"chunk id": {"hash": hash_document(document), "source": "../file.pdf"}},
+        )
 
-    @patch("haiven_cli.services.knowledge_service.FAISS")
-    @patch("haiven_cli.services.knowledge_service.RecursiveCharacterTextSplitter")
-    def test_save_knowledge_to_existing_path(self, mock_text_splitter, mock_faiss):
-        text = "something cool"
-        texts = [text]
-        metadatas = {}
-        embedding_model = MagicMock()
-        ouput_dir = "test knowledge base path"
+    def test_reindexing_only_embeds_new_chunks_and_deletes_vanished_ones(
+        self, tmp_path
+    ):
+        output_dir = os.path.join(tmp_path, "file.kb")
+        embeddings = CountingEmbeddings()
+        knowledge_service = _create_knowledge_service(embeddings)
 
-        token_service = MagicMock()
+        source = os.path.join(tmp_path, "file.pdf")
 
-        documents = MagicMock()
-        text_splitter = MagicMock()
-        text_splitter.create_documents.return_value = documents
-        mock_text_splitter.return_value = text_splitter
+        knowledge_service.create_knowledge_base(
+            _documents("first", "second", "third"),
+            MODEL,
+            output_dir,
+            source,
+        )
+        knowledge_service.create_knowledge_base(
+            _documents("first", "third", "fourth"),
+            MODEL,
+            output_dir,
+            source,
+        )
 
-        embeddings = MagicMock()
-        embedding_service = MagicMock()
-        embedding_service.load_embeddings.return_value = embeddings
+        assert embeddings.embedded_texts == ["first", "second", "third", "fourth"]
+        db = load_knowledge_base(output_dir, embeddings)
+        assert _texts(db) == ["first", "third", "fourth"]
+        assert db.similarity_search("fourth", k=1)[0].page_content == "fourth"
+        manifest = load_manifest(output_dir, db)
+        assert [chunk["source"] for chunk in manifest.values()] == ["../file.pdf"] * 3
 
-        local_db = MagicMock()
-        mock_faiss.from_documents.return_value = local_db
-        db = MagicMock()
-        mock_faiss.load_local.return_value = db
+    def test_reindexing_recognises_the_source_by_its_normalised_path(
+        self, tmp_path, monkeypatch
+    ):
+        os.makedirs(os.path.join(tmp_path, "docs"))
+        output_dir = os.path.join(tmp_path, "knowledge", "file.kb")
+        embeddings = CountingEmbeddings()
+        knowledge_service = _create_knowledge_service(embeddings)
+        monkeypatch.chdir(tmp_path)
 
-        knowledge_service = KnowledgeService(token_service, embedding_service)
-        knowledge_service.index(texts, metadatas, embedding_model, ouput_dir)
+        knowledge_service.create_knowledge_base(
+            _documents("first", "second"), MODEL, output_dir, "./docs/file.pdf"
+        )
+        knowledge_service.create_knowledge_base(
+            _documents("second"), MODEL, output_dir, "docs//file.pdf"
+        )
+        monkeypatch.chdir(os.path.join(tmp_path, "docs"))
+        knowledge_service.create_knowledge_base(
+            _documents("second", "third"), MODEL, output_dir, "file.pdf"
+        )
 
-        mock_text_splitter.assert_called_once_with(
-            chunk_size=100,
-            chunk_overlap=20,
-            length_function=token_service.get_tokens_length,
-            separators=["\n\n", "\n", " ", ""],
+        assert embeddings.embedded_texts == ["first", "second", "third"]
+        db = load_knowledge_base(output_dir, embeddings)
+        assert _texts(db) == ["second", "third"]
+        assert [
+            chunk["source"] for chunk in load_manifest(output_dir, db).values()
+        ] == ["../../docs/file.pdf"] * 2
+
+    def test_reindexing_with_a_manifest_of_sources_as_given(
+        self, tmp_path, monkeypatch
+    ):
+        output_dir = os.path.join(tmp_path, "file.kb")
+        embeddings = CountingEmbeddings()
+        knowledge_service = _create_knowledge_service(embeddings)
+        monkeypatch.chdir(tmp_path)
+        knowledge_service.create_knowledge_base(
+            _documents("first", "second"), MODEL, output_dir, "./file.pdf"
         )
-        text_splitter.create_documents.assert_called_once_with(texts, metadatas)
-        embedding_service.load_embeddings.assert_called_once_with(embedding_model)
-        mock_faiss.from_documents.assert_called_once_with(documents, embeddings)
-        mock_faiss.load_local.assert_called_once_with(ouput_dir, embeddings)
-        db.merge_from.assert_called_once_with(local_db)
-        db.save_local.assert_called_once_with(ouput_dir)
+        # The manifest of an earlier version, with the source as given on the command line
+        manifest_path = os.path.join(output_dir, "manifest.json")
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        with open(manifest_path, "w") as f:
+            json.dump(
+                {
+                    "version": 1,
+                    "chunks": [
+                        {**chunk, "source": "./file.pdf"}
+                        for chunk in manifest["chunks"]
+                    ],
+                },
+                f,
+            )
+
+        knowledge_service.create_knowledge_base(
+            _documents("second"), MODEL, output_dir, "file.pdf"
+        )
+
+        assert embeddings.embedded_texts == ["first", "second"]
+        assert _texts(load_knowledge_base(output_dir, embeddings)) == ["second"]
+
+    def test_reindexing_keeps_chunks_of_other_sources(self, tmp_path):
+        output_dir = os.path.join(tmp_path, "file.kb")
+        embeddings = CountingEmbeddings()
+        knowledge_service = _create_knowledge_service(embeddings)
+
+        knowledge_service.create_knowledge_base(
+            _documents("first", "second"), MODEL, output_dir, "a/file.pdf"
+        )
+        knowledge_service.create_knowledge_base(
+            _documents("other"), MODEL, output_dir, "b/file.pdf"
+        )
+        knowledge_service.create_knowledge_base(
+            _documents("second"), MODEL, output_dir, "a/file.pdf"
+        )
+
+        assert embeddings.embedded_texts == ["first", "second", "other"]
+        assert _texts(load_knowledge_base(output_dir, embeddings)) == [
+            "second",
+            "other",
+        ]
+
+    def test_reindexing_without_manifest_reuses_and_deduplicates_chunks(self, tmp_path):
+        output_dir = os.path.join(tmp_path, "file.kb")
+        embeddings = CountingEmbeddings()
+        db = FAISS.from_documents(
+            _documents("first", "first", "second", "gone"), embeddings
+        )
+        save_knowledge_base(db, output_dir)
+        embeddings.embedded_texts = []
+        knowledge_service = _create_knowledge_service(embeddings)
+
+        knowledge_service.create_knowledge_base(
+            _documents("first", "second", "new"), MODEL, output_dir
+        )
+
+        assert embeddings.embedded_texts == ["new"]
+        assert _texts(load_knowledge_base(output_dir, embeddings)) == [
+            "first",
+            "second",
+            "new",
+        ]
+
+    @patch("haiven_cli.services.knowledge_service.EmbeddingBatcher")
+    def test_cached_chunks_are_not_sent_to_the_embedding_batcher(
+        self, mock_batcher, tmp_path
+    ):
+        embeddings = CountingEmbeddings()
+        cache = EmbeddingsCache(os.path.join(tmp_path, "cache.sqlite"))
+        cached_embeddings = CachedEmbeddings(embeddings, cache, MODEL.id)
+        cached_embeddings.embed_documents(["first"])
+        embedding_batcher = MagicMock()
+        embedding_batcher.embed_documents.side_effect = lambda texts, checkpoint_path: (
+            embeddings.embed_documents(texts)
+        )
+        mock_batcher.from_model.return_value = embedding_batcher
+        knowledge_service = _create_knowledge_service(cached_embeddings)
+        output_dir = os.path.join(tmp_path, "file.kb")
+
+        knowledge_service.create_knowledge_base(
+            _documents("first", "second"), MODEL, output_dir, "file.pdf"
+        )
+
+        assert mock_batcher.from_model.call_args.args[1] is embeddings
+        embedding_batcher.embed_documents.assert_called_once_with(
+            ["second"], f"{output_dir}/embeddings_checkpoint.jsonl"
+        )
+        assert embeddings.embedded_texts == ["first", "second"]
+        assert _texts(load_knowledge_base(output_dir, embeddings)) == [
+            "first",
+            "second",
+        ]
+
+    def test_checkpoint_is_kept_until_the_knowledge_base_is_saved(self, tmp_path):
+        output_dir = os.path.join(tmp_path, "file.kb")
+        checkpoint_path = f"{output_dir}/embeddings_checkpoint.jsonl"
+        embeddings = CountingEmbeddings()
+        knowledge_service = _create_knowledge_service(embeddings)
+
+        with (
+            patch(
+                "haiven_cli.services.knowledge_service.save_knowledge_base",
+                side_effect=OSError("disk full"),
+            ),
+            pytest.raises(OSError),
+        ):
+            knowledge_service.create_knowledge_base(
+                _documents("first", "second"), MODEL, output_dir, "file.pdf"
+            )
+
+        assert os.path.exists(checkpoint_path)
+
+        knowledge_service.create_knowledge_base(
+            _documents("first", "second"), MODEL, output_dir, "file.pdf"
+        )
+
+        assert embeddings.embedded_texts == ["first", "second"]
+        assert not os.path.exists(checkpoint_path)
+        assert _texts(load_knowledge_base(output_dir, embeddings)) == [
+            "first",
+            "second",
+        ]
+
+    def test_index_in_batches_consumes_pages_lazily(self, tmp_path):
+        embeddings = CountingEmbeddings()
+        knowledge_service = _create_knowledge_service(embeddings)
+        embedded_when_read = []
+
+        def pages():
+            for page in range(5):
+                embedded_when_read.append(len(embeddings.embedded_texts))
+                yield f"page {page}", {"page": page}
+
+        with patch.object(
+            knowledge_service, "_create_text_splitter", return_value=RowTextSplitter()
+        ):
+            knowledge_service.index_in_batches(
+                pages(), MODEL, os.path.join(tmp_path, "file.kb"), batch_size=2
+            )
+
+        # A page is only read once the pages of the previous batches are embedded
+        assert embedded_when_read == [0, 0, 2, 2, 4]
+
+    def test_index_in_batches_deletes_vanished_chunks_of_the_source(self, tmp_path):
+        output_dir = os.path.join(tmp_path, "file.kb")
+        embeddings = CountingEmbeddings()
+        knowledge_service = _create_knowledge_service(embeddings)
+        knowledge_service.create_knowledge_base(
+            _documents("other"), MODEL, output_dir, "other.pdf"
+        )
+
+        with patch.object(
+            knowledge_service, "_create_text_splitter", return_value=RowTextSplitter()
+        ):
+            for texts in [["first", "second"], ["first", "third"]]:
+                knowledge_service.index_in_batches(
+                    [(text, {"source": "file"}) for text in texts],
+                    MODEL,
+                    output_dir,
+                    "file.pdf",
+                    batch_size=1,
+                    delete_vanished_chunks=True,
+                )
+
+        assert embeddings.embedded_texts == ["other", "first", "second", "third"]
+        assert _texts(load_knowledge_base(output_dir, embeddings)) == [
+            "other",
+            "first",
+            "third",
+        ]
+
+    def test_index_in_batches_appends_batches_and_resumes_after_saved_rows(
+        self, tmp_path
+    ):
+        output_dir = os.path.join(tmp_path, "file.kb")
+        embeddings = CountingEmbeddings()
+        knowledge_service = _create_knowledge_service(embeddings)
+        rows = [(f"row {row}", {"row": row}) for row in range(10)]
+
+        def interrupted_rows():
+            yield from rows[:7]
+            raise KeyboardInterrupt()
+
+        with (
+            patch.object(
+                knowledge_service,
+                "_create_text_splitter",
+                return_value=RowTextSplitter(),
+            ),
+            pytest.raises(KeyboardInterrupt),
+        ):
+            knowledge_service.index_in_batches(
+                interrupted_rows(),
+                MODEL,
+                output_dir,
+                "file.csv",
+                batch_size=2,
+                save_every_rows=4,
+            )
+
+        assert knowledge_service.get_indexed_rows(output_dir, "file.csv") == 4
+        assert knowledge_service.get_indexed_rows(output_dir, "other.csv") == 0
+        assert _texts(load_knowledge_base(output_dir, embeddings)) == [
+            "row 0",
+            "row 1",
+            "row 2",
+            "row 3",
+        ]
+
+        embeddings.embedded_texts = []
+        with patch.object(
+            knowledge_service, "_create_text_splitter", return_value=RowTextSplitter()
+        ):
+            knowledge_service.index_in_batches(
+                iter(rows[2:]),
+                MODEL,
+                output_dir,
+                "file.csv",
+                batch_size=2,
+                start_row=2,
+                save_every_rows=4,
+            )
+
+        # Rows 4 and 5 were embedded before the interruption, and kept in the checkpoint
+        assert embeddings.embedded_texts == [f"row {row}" for row in range(6, 10)]
+        assert not os.path.exists(f"{output_dir}/embeddings_checkpoint.jsonl")
+        db = load_knowledge_base(output_dir, embeddings)
+        assert _texts(db) == [f"row {row}" for row in range(10)]
+        assert len(load_manifest(output_dir, db)) == 10
+        assert knowledge_service.get_indexed_rows(output_dir, "file.csv") == 0
+
+    def test_rate_limit_covers_all_batches_of_an_ingestion(self, tmp_path):
+        model = EmbeddingModel(
+            id="fake",
+            provider="fake",
+            name="Fake embeddings",
+            config={"requests_per_minute": 1},
+        )
+        clock = FakeClock()
+        knowledge_service = _create_knowledge_service(CountingEmbeddings())
+        rows = [(f"row {row}", {"row": row}) for row in range(3)]
+
+        with (
+            patch(
+                "haiven_cli.services.embedding_batcher.RateLimiter",
+                side_effect=lambda requests_per_minute, tokens_per_minute, sleep: (
+                    RateLimiter(
+                        requests_per_minute,
+                        tokens_per_minute,
+                        clock=clock,
+                        sleep=clock.sleep,
+                    )
+                ),
+            ) as rate_limiter,
+            patch.object(
+                knowledge_service,
+                "_create_text_splitter",
+                return_value=RowTextSplitter(),
+            ),
+        ):
+            knowledge_service.index_in_batches(
+                iter(rows), model, os.path.join(tmp_path, "a.kb"), batch_size=1
+            )
+            knowledge_service.create_knowledge_base(
+                _documents("other"), model, os.path.join(tmp_path, "b.kb"), "b.pdf"
+            )
+
+        rate_limiter.assert_called_once()
+        # One request per minute: the four requests are spread over three minutes
+        assert sum(clock.sleeps) >= 180
+
+    def test_index_in_batches_raises_error_if_there_are_no_rows(self, tmp_path):
+        knowledge_service = _create_knowledge_service(CountingEmbeddings())
+
+        with pytest.raises(ValueError) as e:
+            knowledge_service.index_in_batches(
+                iter([]), MODEL, os.path.join(tmp_path, "file.kb")
+            )
+
+        assert str(e.value) == "file content has no value"
+
+
+MODEL = EmbeddingModel(id="fake", provider="fake", name="Fake embeddings")
+
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    embedded_texts: list = []
+
+    def __init__(self):
+        super().__init__(size=8)
+        self.embedded_texts = []
+
+    def embed_documents(self, texts):
+        self.embedded_texts.extend(texts)
+        return super().embed_documents(texts)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RowTextSplitter:
+    def create_documents(self, texts, metadatas):
+        return [
+            Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(texts, metadatas)
+        ]
+
+
+def _create_knowledge_service(embeddings) -> KnowledgeService:
+    token_service = MagicMock()
+    token_service.get_tokens_lengths.side_effect = lambda texts: [1] * len(texts)
+    embedding_service = MagicMock()
+    embedding_service.load_embeddings.return_value = embeddings
+    return KnowledgeService(token_service, embedding_service)
+
+
+def _documents(*texts):
+    return [Document(page_content=text, metadata={"source": "file"}) for text in texts]
+
+
+def _texts(db):
+    return [
+        db.docstore.search(db.index_to_docstore_id[position]).page_content
+        for position in range(db.index.ntotal)
+    ]
@@ -1,4 +1,6 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import pytest
+
 from unittest.mock import patch, MagicMock, PropertyMock
 from haiven_cli.main import (
     create_context,
@@ -61,7 +63,14 @@ class TestMain:
         app = MagicMock()
         mock_app.return_value = app
 
-        index_file(source_path, embedding_model, config_path, description, output_dir)
+        index_file(
+            source_path,
+            embedding_model,
+            config_path,
+            description,
+            output_dir,
+            embeddings_cache="",
+        )
 
         mock_token_service.assert_called_once_with("cl100k_base")
         mock_knowledge_service.assert_called_once_with(
@@ -75,9 +84,20 @@ class TestMain:
             mock_metadata_service,
         )
         app.index_individual_file.assert_called_once_with(
-            source_path, embedding_model, config_path, output_dir, description, None
+            source_path,
+            embedding_model,
+            config_path,
+            output_dir,
+            description,
+            None,
+            1,
+            False,
+            0,
+            None,
         )
 
+    @patch("haiven_cli.main.CachedEmbeddingService")
+    @patch("haiven_cli.main.EmbeddingsCache")
     @patch("haiven_cli.main.MetadataService")
     @patch("haiven_cli.main.EmbeddingService")
     @patch("haiven_cli.main.CliConfigService")
@@ -96,6 +116,8 @@ class TestMain:
         mock_cli_config_service,
         mock_embedding_service,
         mock_metadata_service,
+        mock_embeddings_cache,
+        mock_cached_embedding_service,
     ):
         source_dir = "source_dir"
         output_dir = "destination_dir"
@@ -123,14 +145,35 @@ class TestMain:
         app = MagicMock()
         mock_app.return_value = app
 
+        embeddings_cache = MagicMock()
+        embeddings_cache.stats.return_value = {
+            "hits": 3,
+            "misses": 1,
+            "hit_rate": 0.75,
+        }
+        mock_embeddings_cache.return_value = embeddings_cache
+        cached_embedding_service = MagicMock()
+        mock_cached_embedding_service.return_value = cached_embedding_service
+
         index_all_files(
-            source_dir, output_dir, embedding_model, description, config_path
+            source_dir,
+            output_dir,
+            embedding_model,
+            description,
+            config_path,
+            4,
+            "cache.sqlite",
         )
 
         mock_token_service.assert_called_once_with("cl100k_base")
+        mock_embeddings_cache.assert_called_once_with("cache.sqlite")
+        mock_cached_embedding_service.assert_called_once_with(
+            mock_embedding_service, embeddings_cache
+        )
         mock_knowledge_service.assert_called_once_with(
-            token_service, mock_embedding_service
+            token_service, cached_embedding_service
         )
+        embeddings_cache.close.assert_called_once()
         mock_config_service.assert_called_once_with(env_file_path=env_file_path)
         mock_app.assert_called_once_with(
             config_service,
@@ -139,9 +182,32 @@ class TestMain:
             mock_metadata_service,
         )
         app.index_all_files.assert_called_once_with(
-            source_dir, embedding_model, config_path, output_dir, description
+            source_dir, embedding_model, config_path, output_dir, description, 4
         )
 
+    @patch("haiven_cli.main.EmbeddingsCache")
+    @patch("haiven_cli.main.CliConfigService")
+    @patch("haiven_cli.main.ConfigService")
+    @patch("haiven_cli.main.App")
+    def test_index_all_files_closes_the_embeddings_cache_when_indexing_fails(
+        self,
+        mock_app,
+        mock_config_service,
+        mock_cli_config_service,
+        mock_embeddings_cache,
+    ):
+        app = MagicMock()
+        app.index_all_files.side_effect = ValueError("indexing failed")
+        mock_app.return_value = app
+        embeddings_cache = MagicMock()
+        embeddings_cache.stats.return_value = {"hits": 0, "misses": 0, "hit_rate": 0}
+        mock_embeddings_cache.return_value = embeddings_cache
+
+        with pytest.raises(ValueError):
+            index_all_files("source_dir", embeddings_cache="cache.sqlite")
+
+        embeddings_cache.close.assert_called_once()
+
     @patch("haiven_cli.main.CliConfigService")
     def test_init(self, mock_cli_config_service):
         cli_config_service = MagicMock()
@@ -1,4 +1,6 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import pickle
+
 from haiven_cli.services.token_service import TokenService
 from unittest.mock import MagicMock, patch
 
@@ -20,3 +22,59 @@ class TestTokenService:
         mock_tiktoken.get_encoding.assert_called_with(encoding)
         tokenizer.encode.assert_called_with(text_splitter, disallowed_special=())
         assert tokens_length == len(tokens)
+
+    @patch("haiven_cli.services.token_service.tiktoken")
+    def test_get_tokens_length_creates_tokenizer_once_and_remembers_counts(
+        self, mock_tiktoken
+    ):
+        tokenizer = MagicMock()
+        tokenizer.encode.return_value = [1, 1]
+        mock_tiktoken.get_encoding.return_value = tokenizer
+
+        token_service = TokenService()
+
+        assert token_service.get_tokens_length("some text") == 2
+        assert token_service.get_tokens_length("some text") == 2
+        assert token_service.get_tokens_length("other text") == 2
+
+        mock_tiktoken.get_encoding.assert_called_once_with("cl100k_base")
+        assert tokenizer.encode.call_count == 2
+
+    @patch("haiven_cli.services.token_service.tiktoken")
+    def test_get_tokens_lengths_encodes_missing_texts_in_one_batch(self, mock_tiktoken):
+        tokenizer = MagicMock()
+        tokenizer.encode.return_value = [1]
+        tokenizer.encode_batch.return_value = [[1, 1], [1, 1, 1]]
+        mock_tiktoken.get_encoding.return_value = tokenizer
+
+        token_service = TokenService()
+        token_service.get_tokens_length("a")
+
+        lengths = token_service.get_tokens_lengths(["bb", "a", "ccc", "bb"])
+
+        assert lengths == [2, 1, 3, 2]
+        tokenizer.encode_batch.assert_called_once_with(
+            ["bb", "ccc"], disallowed_special=()
+        )
+
+    @patch("haiven_cli.services.token_service.tiktoken")
+    def test_decode_with_offsets_uses_tokenizer(self, mock_tiktoken):
+        tokenizer = MagicMock()
+        tokenizer.decode_with_offsets.return_value = ("hello world", [0, 5])
+        mock_tiktoken.get_encoding.return_value = tokenizer
+
+        token_service = TokenService()
+
+        assert token_service.decode_with_offsets([1, 2]) == ("hello world", [0, 5])
+        tokenizer.decode_with_offsets.assert_called_once_with([1, 2])
+
+    @patch("haiven_cli.services.token_service.tiktoken")
+    def test_pickled_token_service_creates_its_own_tokenizer(self, mock_tiktoken):
+        mock_tiktoken.get_encoding.return_value = MagicMock()
+        token_service = TokenService("p50k_base")
+        token_service.get_tokens_length("text")
+
+        unpickled_token_service = pickle.loads(pickle.dumps(token_service))
+
+        assert unpickled_token_service.encoding == "p50k_base"
+        assert unpickled_token_service._tokenizer is None
@@ -0,0 +1,114 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+from unittest.mock import MagicMock
+
+import pytest
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from haiven_cli.services.token_text_splitter import TokenBoundaryTextSplitter
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+SPLITTER_COPIES = [
+    os.path.join(REPOSITORY_DIR, "app", "embeddings", "splitters.py"),
+    os.path.join(
+        REPOSITORY_DIR, "cli", "haiven_cli", "services", "token_text_splitter.py"
+    ),
+]
+
+TEXT = (
+    "The quick brown fox jumps over the lazy dog.\n\n"
+    "Second paragraph is here and\nit has lines.\n\n"
+    "abcdefghijklmnopqrstuvwxyzabcdefghij"
+)
+
+
+class CharacterTokenizer:
+    def __init__(self):
+        self.encode_batch_calls = 0
+
+    def encode_batch(self, texts):
+        self.encode_batch_calls += 1
+        return [[ord(character) for character in text] for text in texts]
+
+    def decode_with_offsets(self, tokens):
+        return "".join(chr(token) for token in tokens), list(range(len(tokens)))
+
+
+class TestTokenBoundaryTextSplitter:
+    def test_split_text_breaks_at_separators_like_recursive_splitter(self):
+        splitter = TokenBoundaryTextSplitter(
+            chunk_size=20, chunk_overlap=6, tokenizer=CharacterTokenizer()
+        )
+        recursive_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=20, chunk_overlap=6, separators=["\n\n", "\n", " ", ""]
+        )
+
+        chunks = splitter.split_text(TEXT)
+
+        assert chunks == recursive_splitter.split_text(TEXT)
+        assert chunks[:3] == [
+            "The quick brown fox",
+            "fox jumps over the",
+            "the lazy dog.",
+        ]
+
+    def test_chunks_are_within_chunk_size_and_cover_the_text(self):
+        splitter = TokenBoundaryTextSplitter(
+            chunk_size=7,
+            chunk_overlap=3,
+            tokenizer=CharacterTokenizer(),
+            add_start_index=True,
+        )
+
+        documents = splitter.create_documents([TEXT])
+
+        covered = set()
+        for document in documents:
+            start_index = document.metadata["start_index"]
+            assert len(document.page_content) <= 7
+            assert TEXT[start_index:].startswith(document.page_content)
+            covered.update(range(start_index, start_index + len(document.page_content)))
+        assert all(
+            TEXT[position].isspace()
+            for position in range(len(TEXT))
+            if position not in covered
+        )
+
+    def test_create_documents_encodes_all_texts_at_once_and_sets_start_index(self):
+        tokenizer = CharacterTokenizer()
+        splitter = TokenBoundaryTextSplitter(
+            chunk_size=20, chunk_overlap=0, tokenizer=tokenizer, add_start_index=True
+        )
+        texts = [TEXT, "  a short text", ""]
+
+        documents = splitter.create_documents(
+            texts, [{"source": "first"}, {"source": "second"}, {"source": "third"}]
+        )
+
+        assert tokenizer.encode_batch_calls == 1
+        assert [document.metadata["source"] for document in documents][-1] == "second"
+        for document in documents:
+            text = texts[0] if document.metadata["source"] == "first" else texts[1]
+            start_index = document.metadata["start_index"]
+            assert text[start_index:].startswith(document.page_content)
+        assert documents[-1].page_content == "a short text"
+        assert documents[-1].metadata["start_index"] == 2
+
+    def test_breaks_after_a_token_that_contains_the_separator(self):
+        tokenizer = MagicMock()
+        tokenizer.encode_batch.return_value = [[1, 2, 3, 4]]
+        tokenizer.decode_with_offsets.return_value = ("one.\n\ntwo", [0, 3, 6, 7])
+        splitter = TokenBoundaryTextSplitter(
+            chunk_size=3, chunk_overlap=0, tokenizer=tokenizer
+        )
+
+        assert splitter.split_text("one.\n\ntwo") == ["one.", "two"]
+
+    @pytest.mark.skipif(
+        not all(os.path.exists(path) for path in SPLITTER_COPIES),
+        reason="needs the app and the cli of the repository",
+    )
+    def test_app_and_cli_have_the_same_splitter(self):
+        app_splitter, cli_splitter = [open(path).read() for path in SPLITTER_COPIES]
+
+        assert app_splitter == cli_splitter
@@ -52,6 +52,15 @@ def app_coverage():
     subprocess.run(command, shell=True)
 
 
+# benchmarks knowledge retrieval on a synthetic knowledge pack
+def app_benchmark():
+    command = """
+    cd app && \
+    poetry run python -m benchmark.knowledge_retrieval --output benchmark_report.json
+    """
+    subprocess.run(command, shell=True)
+
+
 # builds local docker image
 def build_docker_base_image():
     command = """